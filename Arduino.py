@@ -12,19 +12,114 @@ Twitter: @CasualEndvrs
 
 import numpy as np
 from time import sleep as time_sleep
+from time import perf_counter
+import threading
+from queue import Queue, Empty, Full
 import serial
 import serial.tools.list_ports
 from itertools import zip_longest as itertools_zip_longest
+from instrumentation import stage as instrument_stage
+
+# binary sample frame sent by the firmware when binary mode is enabled ("A;1")
+#   uint32 micros() followed by uint16 adc count, little-endian, 6 bytes total
+FRAME_DTYPE = np.dtype([('t', '<u4'), ('adc', '<u2')])
+END_FRAME_ADC = 0xFFFF # adc value of the frame that terminates a binary stream
+ADC_MAX = 1023
+READY_BANNER = b'ready' # printed by the firmware once setup() has finished
+SERIAL_RX_BUFFER = 64 # bytes of serial receive buffer on AVR boards, the limit for pipelined commands
+
+def adc_to_voltage(adc, Vcc) :
+    """
+    Converts raw 10-bit adc counts to volts, as done by the firmware in text mode.
+    
+    Parameters
+    ----------
+    adc : np.ndarray
+        Adc counts returned by Arduino.stream_frames.
+    Vcc : float
+        Supply voltage of the Arduino.
+    
+    Returns
+    -------
+    np.ndarray
+        Voltage across the capacitor.
+    
+    """
+    return Vcc * np.asarray(adc, dtype=float) / ADC_MAX
+
+def parse_sample_lines(data, eol=b'\r\n', element_separator=b',') :
+    """
+    Parses a block of "t,V" text lines into numpy arrays in one pass.
+    
+    Parameters
+    ----------
+    data : bytes
+        Raw bytes read from the Arduino.
+    eol : bytes, optional
+        End of line sequence. The default is b'\r\n'.
+    element_separator : bytes, optional
+        Separator between the time and voltage. The default is b','.
+    
+    Returns
+    -------
+    t : np.ndarray
+        Sample times from the Arduino's micros().
+    v : np.ndarray
+        Sample voltages.
+    ended : bool
+        True if an "end" line was found.
+    remainder : bytes
+        Unparsed bytes, a trailing partial line or everything after "end".
+    
+    """
+    lines = data.split(eol)
+    remainder = lines.pop() # partial line, b'' if data ended on eol
+    
+    ended = False
+    if b'end' in lines :
+        end_idx = lines.index(b'end')
+        remainder = eol.join(lines[end_idx+1:] + [remainder])
+        lines = lines[:end_idx]
+        ended = True
+    
+    # drop blank or corrupted lines, each sample has exactly one separator
+    lines = [ line for line in lines if line.count(element_separator) == 1 ]
+    try :
+        values = np.array(element_separator.join(lines).split(element_separator), 
+                          dtype=float) if len(lines) > 0 else np.empty(0)
+    except ValueError :
+        values = []
+        for line in lines :
+            try :
+                values.extend( [float(ele) for ele in line.split(element_separator)] )
+            except ValueError :
+                pass
+        values = np.array(values, dtype=float)
+    values = values.reshape(-1, 2)
+    
+    return values[:,0], values[:,1], ended, remainder
 
 class Arduino() :
-    def __init__(self, port=None, baud=9600, timeout=0, eol='') :
+    def __init__(self, port=None, baud=9600, timeout=0, eol='', ready_timeout=3.0) :
         self.port = port
         self.baud = baud
+        self.ready_timeout = ready_timeout # seconds to wait for the board after connecting
+        self.ready_latency = None # seconds from opening the port until the board answered
         
         self.timeout = timeout
         self.eol = eol.encode("utf-8")
         
         self.arduino = None
+        
+        self.frame_buffer = b'' # partial binary frame carried between reads
+        self.line_buffer = b'' # partial text line carried between reads
+        
+        self.reader_thread = None
+        self.reader_stop = threading.Event()
+        self.reader_q = None
+        self.reader_error = None # exception that ended the reader thread early
+        self.dropped_samples = 0 # samples discarded because the consumer fell behind
+        self.instrumentation = None # optional instrumentation.Instrumentation, times each stage
     
     def get_avail_ports(self) :
         """
@@ -61,6 +156,8 @@ class Arduino() :
         -------
         str
             Description of connection result.
+            The time taken for the board to become ready is stored in 
+            ready_latency.
         
         """
         if port is None :
@@ -80,14 +177,85 @@ class Arduino() :
         try :
             self.arduino = serial.Serial(port, baud, 
                                 timeout=timeout)
-            time_sleep(0.25)
-            if flush :
-                self.flush_buffer()
-            return 'Success'
+            self.frame_buffer = b''
+            self.line_buffer = b''
         except :
             if port not in self.get_avail_ports() :
                 return 'Nothing connected to point'
             return 'Connection Failure'
+        
+        self.ready_latency = self.wait_until_ready(self.ready_timeout)
+        if self.ready_latency is None :
+            self.arduino.close()
+            self.arduino = None
+            return 'No response from Arduino'
+        if flush :
+            self.flush_buffer()
+        return 'Success'
+    
+    def wait_until_ready(self, deadline=3.0, probe_after=1.5, initial_wait=0.01, max_wait=0.25) :
+        """
+        Waits until the firmware can accept commands.
+        Opening the port resets most boards, the firmware prints READY_BANNER 
+        at the end of setup(). Boards which do not reset never print it, so 
+        if no banner arrived within probe_after the board is probed with 
+        test_connection. Probes sent earlier would reach the bootloader of a 
+        resetting board. The time between probes starts at initial_wait and 
+        doubles up to max_wait.
+        
+        Parameters
+        ----------
+        deadline : float, optional
+            Seconds to wait before giving up. The default is 3.0.
+        probe_after : float, optional
+            Seconds to wait for the banner before the first probe, at least 
+            the bootloader's delay after a reset. The default is 1.5.
+        initial_wait : float, optional
+            Seconds between the first two probes. The default is 0.01.
+        max_wait : float, optional
+            Longest time between probes. The default is 0.25.
+        
+        Returns
+        -------
+        float
+            Seconds until the board answered, None if it did not.
+        
+        """
+        if self.arduino is None :
+            return None
+        
+        t_start = perf_counter()
+        timeout = self.arduino.timeout
+        next_probe = t_start + probe_after
+        wait = initial_wait
+        num_probes = 0
+        latency = None
+        try :
+            while True :
+                now = perf_counter()
+                remaining = deadline - (now - t_start)
+                if remaining <= 0 :
+                    break
+                if now >= next_probe :
+                    # no banner, probe in case the board did not reset
+                    self.send_command( 'test_connection' )
+                    num_probes += 1
+                    next_probe = now + wait
+                    wait = min(2*wait, max_wait)
+                self.arduino.timeout = min(next_probe - now, remaining)
+                line = self.arduino.readline().strip()
+                if line in [READY_BANNER, b'good_connection'] :
+                    latency = perf_counter() - t_start
+                    break
+            
+            if latency is not None and num_probes > 0 :
+                # probes sent while the board was booting may still be answered
+                self.arduino.timeout = 0.02
+                while self.arduino.readline() != b'' :
+                    pass
+        finally :
+            self.arduino.timeout = timeout
+        return latency
     
     def test_connection(self) :
         if self.arduino is not None :
@@ -108,6 +276,7 @@ class Arduino() :
         None.
         
         """
+        self.stop_reader()
         if self.arduino is not None :
             self.arduino.close()
     
@@ -119,41 +288,180 @@ class Arduino() :
         if self.arduino is not None :
             attempts_left = 3
             while True :
-                self.send_command( cmd )
-                response = self.arduino.readline()
+                with instrument_stage(self.instrumentation, 'round_trip') :
+                    self.send_command( cmd )
+                    response = self.arduino.readline()
                 if response != b'' :
-                    response = int( float( response.decode("utf-8").strip() ) )
+                    try :
+                        response = int( float( response.decode("utf-8").strip() ) )
+                    except ValueError :
+                        response = None
                     if response == 1 :
                         return True
                 attempts_left -= 1
                 if attempts_left <= 0 :
                     return False
-                time_sleep(0.1)
+                # stale bytes from an interrupted exchange would answer the retry
+                self.arduino.reset_input_buffer()
                 print( 'attempting again - set' )
             return True
         else :
             return False
     
-    def get_parameter(self, cmd, dtype=None) :
+    def get_parameter(self, cmd, dtype=None, attempts=3, timeout=None) :
+        """
+        Sends a get command and reads its response.
+        
+        Parameters
+        ----------
+        cmd : str
+            Get command, ex. 'g'.
+        dtype : str, optional
+            Type the response is converted to, see convert_type. The default 
+            is None, the response string.
+        attempts : int, optional
+            Number of times the command is sent. The default is 3.
+        timeout : float, optional
+            Seconds to wait for each response. The default is None, the 
+            port's timeout.
+        
+        Returns
+        -------
+        str or converted response, None if the command was not answered.
+        
+        """
         if self.arduino is not None :
-            attempts_left = 3
-            while True :
-                self.send_command( cmd )
-                response = self.arduino.readline()
-                if response != b'' :
-                    response = response.decode("utf-8").strip()
-                    if dtype is not None :
-                        response = self.convert_type(response, dtype)
-                    return response
-                else :
-                    attempts_left -= 1
-                    if attempts_left <= 0 :
-                        return None
-                time_sleep(0.1)
-                # print( 'attempting again - get' )
+            port_timeout = self.arduino.timeout
+            if timeout is not None :
+                self.arduino.timeout = timeout
+            try :
+                attempts_left = attempts
+                while True :
+                    with instrument_stage(self.instrumentation, 'round_trip') :
+                        self.send_command( cmd )
+                        response = self.arduino.readline()
+                    if response != b'' :
+                        response = response.decode("utf-8").strip()
+                        if dtype is not None :
+                            response = self.convert_type(response, dtype)
+                        return response
+                    else :
+                        attempts_left -= 1
+                        if attempts_left <= 0 :
+                            return None
+                    # print( 'attempting again - get' )
+            finally :
+                self.arduino.timeout = port_timeout
         else :
             return None
     
+    def transact(self, cmds, attempts=3, max_write=SERIAL_RX_BUFFER) :
+        """
+        Sends several set/get commands with a single write and matches the
+        responses to the commands in order. Only commands that failed are
+        sent again, so setting several parameters costs about one round trip.
+        Every command must be answered with exactly one line, as the set
+        (ack "1") and get commands are. Experiment commands are not allowed.
+        
+        If fewer responses than commands arrive it is not known which
+        command went unanswered, so every command of that write is treated
+        as failed and the retries send one command per write. Set commands
+        can be repeated safely.
+        
+        Parameters
+        ----------
+        cmds : list of str
+            Commands, ex. ['f;2200', 'h;2.2e-4', 'g'].
+        attempts : int, optional
+            Number of times a command is sent before it is reported as
+            failed. The default is 3.
+        max_write : int, optional
+            Commands are grouped into writes of at most this many bytes so
+            the firmware's serial buffer can't overflow. The default is
+            SERIAL_RX_BUFFER.
+        
+        Returns
+        -------
+        results : list of tuple
+            (success, response) for each command, in the order of cmds.
+            success is True if a set command was acknowledged or a get
+            command was answered, response is the decoded response or None.
+        
+        """
+        results = [ (False, None) ] * len(cmds)
+        if self.arduino is None :
+            return results
+        
+        pending = list( range(len(cmds)) )
+        for _ in range(attempts) :
+            if len(pending) == 0 :
+                break
+            # stale bytes from an interrupted exchange would shift the responses
+            self.arduino.reset_input_buffer()
+            
+            failed = []
+            missing_response = False
+            for group in self._pipeline_groups( [cmds[idx] for idx in pending], max_write ) :
+                group_idx = [ pending[idx] for idx in group ]
+                data = b''.join([ self._encode_command(cmds[idx]) for idx in group_idx ])
+                responses = []
+                with instrument_stage(self.instrumentation, 'transact_round_trip') :
+                    self.arduino.write( data )
+                    while len(responses) < len(group_idx) :
+                        response = self.arduino.readline()
+                        if response == b'' :
+                            break
+                        responses.append( response.decode('utf-8', errors='replace').strip() )
+                
+                if len(responses) < len(group_idx) :
+                    # a response went missing, none of the others can be trusted
+                    failed.extend( group_idx )
+                    missing_response = True
+                    self.arduino.reset_input_buffer()
+                    continue
+                
+                for (idx, response) in zip(group_idx, responses) :
+                    if ';' in cmds[idx] :
+                        try :
+                            success = int( float(response) ) == 1
+                        except ValueError :
+                            success = False
+                    else :
+                        success = response != ''
+                    results[idx] = (success, response)
+                    if not success :
+                        failed.append( idx )
+            pending = failed
+            if missing_response :
+                # isolate the command that is not being answered
+                max_write = 0
+        return results
+    
+    def _pipeline_groups(self, cmds, max_write) :
+        """
+        Splits cmds into runs of indices whose encoded length fits in max_write.
+        """
+        groups = [[]]
+        group_len = 0
+        for (idx, cmd) in enumerate(cmds) :
+            cmd_len = len( self._encode_command(cmd) )
+            if len(groups[-1]) > 0 and group_len + cmd_len > max_write :
+                groups.append( [] )
+                group_len = 0
+            groups[-1].append( idx )
+            group_len += cmd_len
+        return [ group for group in groups if len(group) > 0 ]
+    
+    def _encode_command(self, cmd) :
+        cmd = str(cmd).encode("utf-8")
+        # if len cmd is less than eol, append eol
+        # else: test if last characters of cmd are eol
+        if len(cmd) < len(self.eol) :
+            cmd += self.eol
+        elif cmd[-len(self.eol):] != self.eol :
+            cmd += self.eol
+        return cmd
+    
     def send_command(self, cmd) :
         """
         Sends a simple command to the Arduino.
@@ -170,15 +478,7 @@ class Arduino() :
             False --> Command failed.
         """
         if self.arduino is not None :
-            cmd = str(cmd).encode("utf-8")
-            # if len cmd is less than eol, append eol
-            # else: test if last characters of cmd are eol
-            if len(cmd) < len(self.eol) :
-                cmd += self.eol
-            elif cmd[-len(self.eol):] != self.eol :
-                cmd += self.eol
-            
-            self.arduino.write( cmd )
+            self.arduino.write( self._encode_command(cmd) )
             return True
         else :
             return False
@@ -199,7 +499,8 @@ class Arduino() :
         result = b''
         eol = eol.encode('utf-8')
         while True :
-            result += self.arduino.readline()
+            with instrument_stage(self.instrumentation, 'readline') :
+                result += self.arduino.readline()
             # this requires a timeout break
             if result in [b'\n', b'end\r\n'] :
                 if end_message :
@@ -220,15 +521,16 @@ class Arduino() :
                             for row in responses ]
         
         if response_types is not None :
-            if isinstance(response_types, (list, tuple, np.ndarray)) :
-                num_response_types = len(response_types)
-                responses = [ [ self.convert_type(row[i], response_types[i])
-                                for i in range(num_response_types) ]
-                             for row in responses ]
-            elif isinstance(response_types, str) :
-                responses = [ [ self.convert_type(ele, response_types)
-                                for ele in row ]
-                             for row in responses ]
+            with instrument_stage(self.instrumentation, 'convert_type') :
+                if isinstance(response_types, (list, tuple, np.ndarray)) :
+                    num_response_types = len(response_types)
+                    responses = [ [ self.convert_type(row[i], response_types[i])
+                                    for i in range(num_response_types) ]
+                                 for row in responses ]
+                elif isinstance(response_types, str) :
+                    responses = [ [ self.convert_type(ele, response_types)
+                                    for ele in row ]
+                                 for row in responses ]
         
         if transpose :
             responses = list(map(list, itertools_zip_longest(*responses, fillvalue=None)))
@@ -237,6 +539,239 @@ class Arduino() :
             return responses[0]
         return responses
     
+    def read_block(self, eol='\r\n', element_separator=',') :
+        """
+        Reads every "t,V" line waiting in the serial buffer at once.
+        Complete lines are parsed into numpy arrays together, a trailing 
+        partial line is kept for the next call.
+        
+        Parameters
+        ----------
+        eol : string, optional
+            End of line sequence. The default is '\r\n'.
+        element_separator : string, optional
+            Separator between the time and voltage. The default is ','.
+        
+        Returns
+        -------
+        t : np.ndarray
+            Sample times from the Arduino's micros().
+        v : np.ndarray
+            Sample voltages.
+        ended : bool
+            True if the "end" line was received, the experiment is complete.
+        
+        """
+        if self.arduino is None :
+            return None
+        
+        instr = self.instrumentation
+        # block for at most one timeout on the first byte
+        with instrument_stage(instr, 'serial_read') :
+            chunk = self.arduino.read( max(1, self.arduino.in_waiting) )
+        data = self.line_buffer + chunk
+        with instrument_stage(instr, 'parse') :
+            t, v, ended, self.line_buffer = parse_sample_lines(data, 
+                        eol=eol.encode('utf-8'), 
+                        element_separator=element_separator.encode('utf-8'))
+        if instr is not None :
+            instr.count('bytes_read', len(chunk))
+        return t, v, ended
+    
+    def stream_frames(self, max_frames=None) :
+        """
+        Reads binary sample frames sent while the firmware is in binary mode.
+        All bytes waiting in the serial buffer are read at once and decoded 
+        with a single numpy call. Any trailing partial frame is kept for the 
+        next call.
+        
+        Parameters
+        ----------
+        max_frames : int, optional
+            Maximum number of frames to return. The default is None, which 
+            returns every complete frame available.
+        
+        Returns
+        -------
+        t : np.ndarray
+            Sample times from the Arduino's micros() [uint32].
+        adc : np.ndarray
+            Adc counts of each sample [uint16].
+        ended : bool
+            True if the end frame was received, the stream is complete.
+        
+        """
+        if self.arduino is None :
+            return None
+        
+        instr = self.instrumentation
+        frame_size = FRAME_DTYPE.itemsize
+        data = self.frame_buffer
+        while True :
+            # block for at most one timeout on the first byte
+            with instrument_stage(instr, 'serial_read') :
+                chunk = self.arduino.read( max(1, self.arduino.in_waiting) )
+            if instr is not None :
+                instr.count('bytes_read', len(chunk))
+            data += chunk
+            
+            num_frames = len(data) // frame_size
+            frames = np.frombuffer(data, dtype=FRAME_DTYPE, count=num_frames)
+            end_idx = np.flatnonzero(frames['adc'] == END_FRAME_ADC)
+            ended = end_idx.size > 0
+            
+            if chunk == b'' or ended :
+                break
+            if num_frames > 0 and (max_frames is None or num_frames >= max_frames) :
+                break
+        
+        if ended :
+            num_frames = end_idx[0]
+            self.frame_buffer = b''
+            if max_frames is not None and num_frames > max_frames :
+                num_frames = max_frames
+                ended = False
+                self.frame_buffer = data[num_frames*frame_size:]
+        else :
+            if max_frames is not None :
+                num_frames = min(num_frames, max_frames)
+            self.frame_buffer = data[num_frames*frame_size:]
+        
+        with instrument_stage(instr, 'parse') :
+            frames = frames[:num_frames]
+            t, adc = frames['t'].astype(np.uint32), frames['adc'].astype(np.uint16)
+        return t, adc, ended
+    
+    def start_reader(self, binary=False, max_batches=1000) :
+        """
+        Starts a background thread which continuously drains the serial port 
+        and queues parsed batches of samples. Reading continues no matter how 
+        slow the consumer is. When the queue is full the oldest batch is 
+        discarded and counted in self.dropped_samples.
+        The thread exits on its own once the end of the stream is received.
+        
+        Parameters
+        ----------
+        binary : bool, optional
+            Parse binary frames (stream_frames) instead of text lines 
+            (read_block). The default is False.
+        max_batches : int, optional
+            Maximum number of batches held for the consumer. The default is 1000.
+        
+        Returns
+        -------
+        bool
+            True --> Reader started.
+            False --> Not connected or a reader is already running.
+        
+        """
+        if self.arduino is None or self.reader_thread is not None :
+            return False
+        
+        self.reader_q = Queue(maxsize=max_batches)
+        self.reader_stop.clear()
+        self.reader_error = None
+        self.dropped_samples = 0
+        
+        self.reader_thread = threading.Thread(target=self._reader_loop, 
+                                              args=(binary,), daemon=True)
+        self.reader_thread.start()
+        return True
+    
+    def stop_reader(self) :
+        """
+        Stops the background reader thread and waits for it to finish.
+        
+        Returns
+        -------
+        None.
+        
+        """
+        if self.reader_thread is None :
+            return
+        self.reader_stop.set()
+        self.reader_thread.join()
+        self.reader_thread = None
+    
+    def _reader_loop(self, binary) :
+        read_fn = self.stream_frames if binary else self.read_block
+        while not self.reader_stop.is_set() :
+            try :
+                t, v, ended = read_fn()
+            except Exception as e :
+                # end the stream, the consumer checks reader_error once it 
+                # has the end batch
+                self.reader_error = e
+                t, v, ended = np.empty(0), np.empty(0), True
+            
+            if len(t) > 0 or ended :
+                self._queue_batch( (t, v, ended) )
+            elif self.arduino.timeout == 0 :
+                time_sleep(0.001) # non-blocking port, avoid spinning
+            if ended :
+                break
+    
+    def _queue_batch(self, batch) :
+        instr = self.instrumentation
+        while True :
+            try :
+                self.reader_q.put_nowait( batch )
+                break
+            except Full :
+                try :
+                    dropped = self.reader_q.get_nowait()
+                    self.dropped_samples += len(dropped[0])
+                    if instr is not None :
+                        instr.count('dropped_samples', len(dropped[0]))
+                except Empty :
+                    pass
+        if instr is not None :
+            instr.count('batches')
+            instr.count('samples', len(batch[0]))
+            instr.gauge('queue_depth', self.reader_q.qsize())
+    
+    def read_batches(self, timeout=None) :
+        """
+        Collects every batch queued by the background reader.
+        Waits up to "timeout" seconds for the first batch, then takes all 
+        other queued batches without waiting.
+        
+        Parameters
+        ----------
+        timeout : float, optional
+            Seconds to wait for data. The default is None, wait indefinitely.
+        
+        Returns
+        -------
+        t : np.ndarray
+            Sample times from the Arduino's micros().
+        v : np.ndarray
+            Sample voltages, or adc counts for binary readers.
+        ended : bool
+            True if the end of the stream was received, or the reader 
+            failed, see reader_error.
+        
+        """
+        if self.reader_q is None :
+            return None
+        
+        batches = []
+        try :
+            with instrument_stage(self.instrumentation, 'queue_wait') :
+                batches.append( self.reader_q.get(timeout=timeout) )
+            while True :
+                batches.append( self.reader_q.get_nowait() )
+        except Empty :
+            pass
+        
+        if len(batches) == 0 :
+            return np.empty(0), np.empty(0), False
+        
+        t = np.concatenate([ batch[0] for batch in batches ])
+        v = np.concatenate([ batch[1] for batch in batches ])
+        ended = any([ batch[2] for batch in batches ])
+        return t, v, ended
+    
     def convert_type(self, data, d_type, eol=None) :
         try :
             if data == 'end' :
@@ -10,130 +10,103 @@ Reddit: CasualEndvrs
 Twitter: @CasualEndvrs
 """
 
+from startup_profile import StartupProfile
+startup = StartupProfile() # started before the heavy imports below
+
 from PyQt5.QtCore import *
 from PyQt5.QtWidgets import *
 from PyQt5.QtGui import *
 
-from multiprocessing import Queue
+from queue import Queue
 
 import os
 import sys
+import argparse
 
 import numpy as np
-import lmfit
-
-import matplotlib
-import matplotlib.ticker as ticker
-matplotlib.use('Qt5Agg')
-
-from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
-from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
-from matplotlib.figure import Figure
-import matplotlib.pyplot as plt
-
-import lmfit
 
 from time import sleep as time_sleep
 from time import time as current_time
+from time import perf_counter
 
-from Arduino import Arduino
+from arduino_controller import arduino
+from sample_buffer import SampleRingBuffer, samples_for_duration
+from decimation import MinMaxDecimator
+from capture_file import CaptureWriter, BackgroundCaptureWriter, new_capture_path, finalize_capture, copy_capture, capture_to_csv
+from rc_fit import theoretical_current, OnlineRCEstimator
+from experiment_runner import ExperimentRunner
+from instrumentation import Instrumentation, stage as instrument_stage
+from render_scheduler import RenderScheduler
+from pulse_analysis import PulseAnalyzer
+from frequency_sweep import FrequencySweep, log_durations
 
-def cap_charge(t, Vcc, tc, offset=0) :
-    return Vcc * (1 - np.exp(-(t-offset)/tc) )
+startup.mark('imports')
 
-def cap_discharge(t, Vcc, tc) :
-    return Vcc * np.exp(-t/tc)
+class MainWindow(QMainWindow) :
+    def __init__(self, startup=None, startup_report=None, instrument=None) :
+        """
+        Constructs the main window.
+        Only the introduction tab is built here, the experiment tabs, and
+            with them matplotlib, are built the first time they are shown.
+            Devices are searched for once the window has been painted.
 
-def theoretical_current(t, I_max, tc, offset=0) :
-    return I_max * np.exp(-(t-offset)/tc)
+        Parameters
+        ----------
+        startup : StartupProfile, optional
+            Profile to record the construction phases in. The default is
+            None, a new profile is started.
+        startup_report : str, optional
+            Once start up is complete the profile is printed if this is
+            "-", otherwise it is saved as json to this file. The default
+            is None, no report.
+        instrument : str, optional
+            Folder for acquisition instrumentation reports. If provided each
+            stage of the experiments is timed, a summary is shown in the
+            status bar and a json report is written after each experiment.
+            The default is None, not instrumented.
 
-class arduino() :
-    def __init__(self) :
-        self.connected = False
-        
-        self.port = '/dev/ttyACM0'
-        self.baud = 250000
-        self.serial = Arduino(self.port, self.baud, timeout=1, eol='/')
-        
-        """
-        if self.port not in self.serial.get_avail_ports() :
-            self.port = self.serial.get_avail_ports()[0]
-            self.serial.port = self.port
-        """
-        
-        self.Vcc = -1
-        self.R = -1
-        self.C = -1
-        self.exp_dur_factor = -1
-        self.pulse_duration = -1
-        self.pulse_duty_cycle = -1
-        
-        self.dis_charge_choice = 1
-        
-        self.display_dur = 15
-    
-    def connect(self) :
-        if not self.connected :
-            connection_result = self.serial.connect()
-            
-            if connection_result == 'Success' :
-                self.connected = True
-                attempts = 5
-                while not self.serial.test_connection() :
-                    attempts -= 1
-                    if attempts <= 0 :
-                        return False
-                    time_sleep( 0.15 )
-                self.update_all_parameters()
-            
-            self.serial.send_command('z')
-            
-        return self.connected
-    
-    def disconnect(self) :
-        if self.connected :
-            self.serial.send_command("z")
-            self.serial.disconnect()
-            self.connected = False
-    
-    def update_all_parameters(self) :
-        attempts = 3
-        while True :
-            self.Vcc = self.serial.get_parameter('k', 'f')
-            self.R = self.serial.get_parameter('g', 'f')
-            self.C = self.serial.get_parameter('i', 'f')
-            self.exp_dur_factor = self.serial.get_parameter('m', 'f')
-            self.pulse_duration = self.serial.get_parameter('s', 'i')
-            self.pulse_duty_cycle = self.serial.get_parameter('u', 'i')
-            
-            if -1 in [self.Vcc, self.R, self.C, self.exp_dur_factor, 
-                    self.pulse_duration, self.pulse_duty_cycle] :
-                attempts -= 1
-                if attempts <= 0 :
-                    break
-                time_sleep(0.15)
-            else :
-                break
+        Returns
+        -------
+        None.
 
-class MainWindow(QMainWindow) :
-    def __init__(self) :
+        """
         super().__init__()
         
+        self.startup = startup if startup is not None else StartupProfile()
+        self.startup_report = startup_report
+        self.first_paint_done = False
+        
         title = 'Capacitor Experiments'
         self.setWindowTitle(title)
         
         self.uController = arduino()
         
+        self.instrumentation = None
+        if instrument is not None :
+            self.instrumentation = Instrumentation(dump_dir=instrument)
+            self.uController.serial.instrumentation = self.instrumentation
+            self.status_timer = QTimer(self)
+            self.status_timer.timeout.connect(self.update_status_bar)
+            self.status_timer.start(500)
+        
         main_layout = QVBoxLayout()
         
         self.intro_tab = intro_page(self, self.uController)
-        self.dis_charge_exp_tab = dis_charge_exp_controls(self)
-        self.freq_exp_tab = freq_exp_controls(self)
+        self.startup.mark('intro tab')
+        
+        # tab index: (controls class, tab name), built by experiment_tab
+        self.experiment_tab_classes = {
+            1: (dis_charge_exp_controls, "(Dis)Charge Experiment"),
+            2: (freq_exp_controls, "Pulse Experiment"),
+            }
+        self.experiment_tabs = {}
         
         self.main_tabs = QTabWidget()
         self.main_tabs.addTab(self.intro_tab, "Introduction")
-        self.main_tabs.addTab(self.dis_charge_exp_tab, "(Dis)Charge Experiment")
-        self.main_tabs.addTab(self.freq_exp_tab, "Pulse Experiment")
+        for tab_idx, (_, tab_name) in self.experiment_tab_classes.items() :
+            holder = QWidget()
+            QVBoxLayout(holder).setContentsMargins(0, 0, 0, 0)
+            self.main_tabs.addTab(holder, tab_name)
         
         self.main_tabs.setTabEnabled(1, False)
         self.main_tabs.setTabEnabled(2, False)
@@ -142,15 +115,81 @@ class MainWindow(QMainWindow) :
         
         main_layout.addWidget(self.main_tabs)
         self.setCentralWidget(self.main_tabs)
+        self.startup.mark('main window')
         
         self.show()
+        self.startup.mark('show', milestone='window shown')
+    
+    def paintEvent(self, event) :
+        super().paintEvent(event)
+        if not self.first_paint_done :
+            self.first_paint_done = True
+            self.startup.mark('first paint', milestone='first paint')
+            # leave the paint event before doing any slow work
+            QTimer.singleShot(0, self.after_first_paint)
+    
+    def after_first_paint(self) :
+        """
+        Start up work that doesn't need to delay the window appearing.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.intro_tab.search_for_devices()
+        self.startup.mark('device scan', milestone='ready')
+        
+        if self.startup_report == '-' :
+            print( self.startup.report() )
+        elif self.startup_report is not None :
+            self.startup.save(self.startup_report)
+    
+    def update_status_bar(self) :
+        if self.instrumentation.counters.get('samples', 0) > 0 :
+            self.statusBar().showMessage( self.instrumentation.readout() )
+    
+    def experiment_tab(self, tab_idx) :
+        """
+        Returns the controls of an experiment tab, building them on first use.
+
+        Parameters
+        ----------
+        tab_idx : int
+            Index of the tab in main_tabs.
+
+        Returns
+        -------
+        QWidget
+            dis_charge_exp_controls or freq_exp_controls object.
+
+        """
+        if tab_idx not in self.experiment_tabs :
+            t0 = perf_counter()
+            tab_class, tab_name = self.experiment_tab_classes[tab_idx]
+            controls = tab_class(self)
+            self.main_tabs.widget(tab_idx).layout().addWidget(controls)
+            self.experiment_tabs[tab_idx] = controls
+            self.startup.record(f"build {tab_name} tab", perf_counter()-t0)
+        return self.experiment_tabs[tab_idx]
+    
+    @property
+    def dis_charge_exp_tab(self) :
+        return self.experiment_tab(1)
+    
+    @property
+    def freq_exp_tab(self) :
+        return self.experiment_tab(2)
+    
+    def closeEvent(self, event) :
+        for controls in self.experiment_tabs.values() :
+            controls.discard_capture()
+        super().closeEvent(event)
     
     def tab_changed(self) :
         tab_idx = self.main_tabs.currentIndex()
-        if tab_idx == 1 :
-            self.dis_charge_exp_tab.update_param_lbls()
-        elif tab_idx == 2 :
-            self.freq_exp_tab.update_param_lbls()
+        if tab_idx in self.experiment_tab_classes :
+            self.experiment_tab(tab_idx).update_param_lbls()
 
 class intro_page(QWidget) :
     """
@@ -313,19 +352,30 @@ class intro_page(QWidget) :
         self.intro_text.zoomIn(2)
         self.instruction_tabs.addTab(self.intro_text, "Instruction Text")
         
+        # the schematic is loaded when its tab is first shown
         self.label = QLabel(self)
         self.image_file = os.path.join(os.getcwd(), 'Capacitor Schematic.jpg')
-        self.circuit_image = QPixmap(self.image_file)
-        
-        self.label.setPixmap(self.circuit_image)
+        self.circuit_image = None
         
         self.instruction_tabs.addTab(self.label, "Circuit Diagram")
+        self.instruction_tabs.currentChanged.connect(self.instruction_tab_changed)
         
         self.layout.addWidget(self.instruction_tabs, 2, 0, 1, 4)
         
         self.setLayout(self.layout)
-        
-        self.search_for_devices()
+    
+    def instruction_tab_changed(self) :
+        """
+        Loads the circuit diagram the first time its tab is shown.
+
+        Returns
+        -------
+        None.
+
+        """
+        if self.circuit_image is None and self.instruction_tabs.currentWidget() is self.label :
+            self.circuit_image = QPixmap(self.image_file)
+            self.label.setPixmap(self.circuit_image)
     
     def search_for_devices(self) :
         """
@@ -371,7 +421,8 @@ class intro_page(QWidget) :
         success = self.result_q.get()
         
         if success :
-            self.lbl_connection_status.setText("Connection Status: Connected")
+            latency = self.uController.serial.ready_latency
+            self.lbl_connection_status.setText(f"Connection Status: Connected (board ready after {1000*latency:.0f} ms)")
             self.parent.main_tabs.setTabEnabled(1, True)
             self.parent.main_tabs.setTabEnabled(2, True)
         else :
@@ -383,7 +434,95 @@ class intro_page(QWidget) :
 
 
 
-class dis_charge_exp_controls(QWidget) :
+class capture_controls() :
+    """
+    Capture file handling shared by the experiment tabs.
+    Each experiment writes its samples to a temporary capture file while it
+    runs. The first save as .cap moves that file to its destination, later
+    saves copy the saved file so earlier saves are left in place.
+    The tab's __init__ sets capture_path and capture_is_temp, and the tab
+    extends capture_metadata with its experiment's settings.
+    """
+    def capture_metadata(self) :
+        """
+        Experiment information stored with a capture, see CaptureWriter.
+        The circuit and firmware settings shared by every experiment.
+        """
+        return {
+            'R': self.uController.R, 
+            'C_uF': self.uController.C, 
+            'Vcc': self.uController.Vcc, 
+            'firmware_mode': 'text', 
+            }
+    
+    def new_capture(self, background=False) :
+        """
+        Starts a new temporary capture file for the next experiment.
+
+        Parameters
+        ----------
+        background : bool, optional
+            Use a BackgroundCaptureWriter for open-ended runs. The default 
+            is False.
+
+        Returns
+        -------
+        CaptureWriter
+            Writer for the experiment thread.
+
+        """
+        self.discard_capture()
+        self.capture_path = new_capture_path()
+        self.capture_is_temp = True
+        if background :
+            return BackgroundCaptureWriter(self.capture_path, self.capture_metadata())
+        return CaptureWriter(self.capture_path, self.capture_metadata())
+    
+    def discard_capture(self) :
+        """
+        Forgets the capture of the last experiment, a temporary file is 
+        deleted.
+        """
+        if self.capture_is_temp and self.capture_path is not None and os.path.exists(self.capture_path) :
+            os.remove(self.capture_path)
+        self.capture_path = None
+        self.capture_is_temp = False
+    
+    def save_capture(self, dest) :
+        """
+        Saves the last experiment as a capture file.
+        Without a capture file one is written from xy_data.
+
+        Parameters
+        ----------
+        dest : str
+            Path of the saved file.
+
+        Returns
+        -------
+        None.
+
+        """
+        if self.capture_path is not None and os.path.exists(self.capture_path) :
+            if self.capture_is_temp :
+                # written during the experiment, only move it
+                self.capture_path = finalize_capture(self.capture_path, dest)
+                self.capture_is_temp = False
+            else :
+                copy_capture(self.capture_path, dest)
+            return
+        
+        if len(self.xy_data) == 0 :
+            warning_window = warningWindow(self)
+            warning_window.build_window(title="No Data", msg="There is no experiment data to save yet.")
+            return
+        
+        with CaptureWriter(dest, self.capture_metadata()) as writer :
+            writer.append(self.xy_data[:,0], self.xy_data[:,1])
+        self.capture_path = dest
+        self.capture_is_temp = False
+
+class dis_charge_exp_controls(QWidget, capture_controls) :
     """
     Experimental controls widget.
     The experiment is run here and the results are displayed with a plot.
@@ -412,6 +551,8 @@ class dis_charge_exp_controls(QWidget) :
         self.fil = None
         self.xy_data = []
         self.result_q = Queue()
+        self.capture_path = None # binary capture of the last experiment
+        self.capture_is_temp = False
         
         self.exp_to_run = []
         
@@ -419,6 +560,9 @@ class dis_charge_exp_controls(QWidget) :
         
         self.layout = QGridLayout(self) # plot and progress bar
         
+        # matplotlib is only imported once the first experiment tab is built
+        from plot_canvas import MplCanvas, NavigationToolbar
+        
         self.plot_layout = QGridLayout()
         self.data_plot = MplCanvas(self, width=5, height=4, dpi=100)
         self.data_plot_toolbar = NavigationToolbar(self.data_plot, self)
@@ -527,6 +671,11 @@ class dis_charge_exp_controls(QWidget) :
         self.qcb_dis_charge_choice.currentIndexChanged.connect(self.update_dis_charge_choice)
         self.control_layout.addWidget(self.qcb_dis_charge_choice, row, 0); row += 1
         
+        self.qcb_refine_fit = QCheckBox("Refine fit with lmfit (slower)")
+        self.qcb_refine_fit.setMaximumWidth( max_widget_width )
+        self.qcb_refine_fit.stateChanged.connect(self.update_refine_fit)
+        self.control_layout.addWidget(self.qcb_refine_fit, row, 0); row += 1
+        
         self.btn_run_exp_dis_charge = QPushButton("Run Experiment")
         self.btn_run_exp_dis_charge.setMaximumWidth( max_widget_width )
         self.btn_run_exp_dis_charge.clicked.connect(self.initialize_exp)
@@ -561,7 +710,7 @@ class dis_charge_exp_controls(QWidget) :
         elif status == "5 V" :
             new_Vcc = 5.0
         self.disable_controls()
-        successful = self.uController.serial.set_parameter( f'j;{new_Vcc}' )
+        successful = self.uController.set_parameter( f'j;{new_Vcc}' )
         self.enable_controls()
         if successful :
             self.update_param_lbls()
@@ -604,7 +753,7 @@ class dis_charge_exp_controls(QWidget) :
             warning_window.build_window(title=title, msg=warning_msg)
             return
         else :
-            successful = self.uController.serial.set_parameter( f'f;{new_R:.3f}' )
+            successful = self.uController.set_parameter( f'f;{new_R:.3f}' )
             if successful :
                 self.update_param_lbls()
             else :
@@ -636,7 +785,7 @@ class dis_charge_exp_controls(QWidget) :
             return
         else :
             new_val *= 1e-6
-            successful = self.uController.serial.set_parameter( f'h;{new_val:.3e}' )
+            successful = self.uController.set_parameter( f'h;{new_val:.3e}' )
             if successful :
                 self.update_param_lbls()
             else :
@@ -667,7 +816,7 @@ class dis_charge_exp_controls(QWidget) :
             warning_window.build_window(title=title, msg=warning_msg)
             return
         else :
-            successful = self.uController.serial.set_parameter( f'l;{new_val}' )
+            successful = self.uController.set_parameter( f'l;{new_val}' )
             if successful :
                 self.update_param_lbls()
             else :
@@ -707,6 +856,9 @@ class dis_charge_exp_controls(QWidget) :
         elif status == "Discharge" :
             self.uController.dis_charge_choice = 0
     
+    def update_refine_fit(self) :
+        self.uController.refine_fit = self.qcb_refine_fit.isChecked()
+    
     def exp_prog_update(self, i) :
         self.exp_prog_bar.setValue( i )
     
@@ -725,6 +877,7 @@ class dis_charge_exp_controls(QWidget) :
         self.btn_set_capacitance.setEnabled(False)
         self.btn_set_exp_dur_factor.setEnabled(False)
         self.qcb_dis_charge_choice.setEnabled(False)
+        self.qcb_refine_fit.setEnabled(False)
         self.btn_run_exp_dis_charge.setEnabled(False)
         self.btn_save_data.setEnabled(False)
         self.parent.main_tabs.setTabEnabled(0, False)
@@ -745,6 +898,7 @@ class dis_charge_exp_controls(QWidget) :
         self.btn_set_capacitance.setEnabled(True)
         self.btn_set_exp_dur_factor.setEnabled(True)
         self.qcb_dis_charge_choice.setEnabled(True)
+        self.qcb_refine_fit.setEnabled(True)
         self.btn_run_exp_dis_charge.setEnabled(True)
         self.btn_save_data.setEnabled(True)
         self.parent.main_tabs.setTabEnabled(0, True)
@@ -754,6 +908,14 @@ class dis_charge_exp_controls(QWidget) :
         self.enable_controls()
         if self.uController.dis_charge_choice in [0, 1] :
             self.xy_data = self.result_q.get()
+            self.running_exp.update_plot(fit=True)
+        
+        if self.running_exp.error is not None :
+            # the queued experiments would start on a failed connection
+            self.exp_to_run = []
+            title = "Experiment Error"
+            warning_window = warningWindow(self)
+            warning_window.build_window(title=title, msg=str(self.running_exp.error))
         
         if len(self.exp_to_run) > 0 :
             self.run_dis_charge_exp()
@@ -775,11 +937,24 @@ class dis_charge_exp_controls(QWidget) :
         if 0 in vals :
             self.update_param_lbls()
         
-        self.running_exp = dis_charge_exp(uController=self.uController, result_q=self.result_q, canvas=self.data_plot)
+        capture = None
+        if self.uController.dis_charge_choice in [0, 1] :
+            capture = self.new_capture()
+        else :
+            # preparation runs keep no data
+            self.discard_capture()
+        
+        self.running_exp = dis_charge_exp(uController=self.uController, result_q=self.result_q, canvas=self.data_plot, capture=capture)
         self.running_exp.notifyProgress.connect(self.exp_prog_update)
         self.running_exp.finished.connect(self.exp_complete)
         self.running_exp.start()
     
+    def capture_metadata(self) :
+        metadata = super().capture_metadata()
+        metadata['experiment'] = {0: 'Discharge', 1: 'Charge'}.get(self.uController.dis_charge_choice, '')
+        metadata['exp_dur_factor'] = self.uController.exp_dur_factor
+        return metadata
+    
     def initialize_exp(self) :
         if self.uController.R == 0 or self.uController.C == 0 :
             title = "Resistor/Capacitor Value Entry Error"
@@ -800,30 +975,39 @@ class dis_charge_exp_controls(QWidget) :
         self.run_dis_charge_exp()
     
     def save_data(self) :
-        fil = QFileDialog.getSaveFileName(self, "Select Save File", self.folder, "CSV files (*.csv)")[0]
+        (fil, file_type) = QFileDialog.getSaveFileName(self, "Select Save File", self.folder, "CSV files (*.csv);;Capture files (*.cap)")
         
         if fil == '' :
             return
         
+        ext = 'cap' if file_type.startswith('Capture') else 'csv'
+        
         (self.folder, self.fil) = os.path.split( fil )
         
         fil = self.fil.split('.')
         
         if len(fil) == 1 :
-            self.fil = fil[0] + '.csv'
-        elif fil[-1] != 'csv' :
-            fil[-1] = 'csv'
+            self.fil = fil[0] + '.' + ext
+        elif fil[-1] != ext :
+            fil[-1] = ext
             self.fil = '.'.join(fil)
         
+        if ext == 'cap' :
+            self.save_capture( os.path.join(self.folder, self.fil) )
+            return
+        
+        experiment = {0: 'Discharge', 1: 'Charge'}.get(self.uController.dis_charge_choice, '')
         header = '\n'.join([
             f"Resistor: {self.uController.R} Ohms",
-            f"Capacitor: {self.uController.C} uF"
+            f"Capacitor: {self.uController.C} uF",
+            f"Vcc: {self.uController.Vcc} V",
+            f"Experiment: {experiment}",
             ])
         
         with open(os.path.join(self.folder, self.fil), 'w') as fil :
             np.savetxt(fil, self.xy_data, fmt='%.7e', delimiter=',', newline='\n', header=header, footer='', comments='# ', encoding=None)
 
-class freq_exp_controls(QWidget) :
+class freq_exp_controls(QWidget, capture_controls) :
     def __init__(self, parent) :
         super(QWidget, self).__init__(parent)
         
@@ -835,6 +1019,10 @@ class freq_exp_controls(QWidget) :
         self.fil = None
         self.xy_data = []
         self.result_q = Queue()
+        self.capture_path = None # binary capture of the last experiment
+        self.capture_is_temp = False
+        self.running_sweep = None # sweep_exp thread while a frequency sweep runs
+        self.sweep = None # FrequencySweep of the last sweep
         
         max_widget_width = 300
         
@@ -843,6 +1031,9 @@ class freq_exp_controls(QWidget) :
         self.exp_prog_bar = QProgressBar()
         self.layout.addWidget(self.exp_prog_bar, 5, 0, 1, 3)
         
+        # matplotlib is only imported once the first experiment tab is built
+        from plot_canvas import MplCanvas, NavigationToolbar
+        
         self.plot_layout = QGridLayout()
         self.data_plot = MplCanvas(self, width=5, height=4, dpi=100)
         self.data_plot_toolbar = NavigationToolbar(self.data_plot, self)
@@ -971,6 +1162,12 @@ class freq_exp_controls(QWidget) :
         self.btn_display_dur.clicked.connect(self.update_display_dur)
         self.control_layout.addWidget(self.btn_display_dur, row, 0); row += 1
         
+        self.qcb_stream_pulse = QCheckBox("Stream data to disk (bounded memory)")
+        self.qcb_stream_pulse.setMaximumWidth( max_widget_width )
+        self.qcb_stream_pulse.setChecked( self.uController.stream_pulse )
+        self.qcb_stream_pulse.stateChanged.connect(self.update_stream_pulse)
+        self.control_layout.addWidget(self.qcb_stream_pulse, row, 0); row += 1
+        
         self.btn_run_pulse_exp = QPushButton("Run Experiment")
         self.btn_run_pulse_exp.setMaximumWidth( max_widget_width )
         self.btn_run_pulse_exp.clicked.connect(self.run_pulse_exp)
@@ -985,6 +1182,23 @@ class freq_exp_controls(QWidget) :
         self.control_layout.addWidget(QHLine(), row, 0); row += 1
         
         
+        # Frequency sweep
+        label = QLabel("Frequency Sweep, pulse durations [ms]:")
+        label.setMaximumWidth( max_widget_width )
+        self.control_layout.addWidget(label, row, 0); row += 1
+        
+        self.qle_sweep_durations = QLineEdit( ', '.join([ str(dur) for dur in log_durations(10, 1000, 8) ]) )
+        self.qle_sweep_durations.setMaximumWidth( max_widget_width )
+        self.control_layout.addWidget(self.qle_sweep_durations, row, 0); row += 1
+        
+        self.btn_run_sweep = QPushButton("Run Frequency Sweep")
+        self.btn_run_sweep.setMaximumWidth( max_widget_width )
+        self.btn_run_sweep.clicked.connect(self.run_sweep)
+        self.control_layout.addWidget(self.btn_run_sweep, row, 0); row += 1
+        
+        self.control_layout.addWidget(QHLine(), row, 0); row += 1
+        
+        
         # Save Results
         label = QLabel("Save Current Results")
         label.setMaximumWidth(max_widget_width)
@@ -995,6 +1209,12 @@ class freq_exp_controls(QWidget) :
         self.btn_save_data.clicked.connect(self.save_data)
         self.control_layout.addWidget(self.btn_save_data, row, 0); row += 1
         
+        self.btn_save_sweep = QPushButton("Save Sweep Table")
+        self.btn_save_sweep.setMaximumWidth( max_widget_width )
+        self.btn_save_sweep.clicked.connect(self.save_sweep)
+        self.control_layout.addWidget(self.btn_save_sweep, row, 0); row += 1
+        self.btn_save_sweep.setEnabled(False)
+        
         
         
         self.layout.addLayout(self.control_layout, 0, 1, 1, 2)
@@ -1011,9 +1231,13 @@ class freq_exp_controls(QWidget) :
         self.btn_set_pulse_dur.setEnabled(False)
         self.btn_set_pulse_dc.setEnabled(False)
         self.btn_display_dur.setEnabled(False)
+        self.qcb_stream_pulse.setEnabled(False)
         self.btn_run_pulse_exp.setEnabled(False)
         self.btn_stop_pulse_exp.setEnabled(False)
+        self.qle_sweep_durations.setEnabled(False)
+        self.btn_run_sweep.setEnabled(False)
         self.btn_save_data.setEnabled(False)
+        self.btn_save_sweep.setEnabled(False)
         self.parent.main_tabs.setTabEnabled(0, False)
         self.parent.main_tabs.setTabEnabled(1, False)
     
@@ -1025,9 +1249,13 @@ class freq_exp_controls(QWidget) :
         self.btn_set_pulse_dur.setEnabled(True)
         self.btn_set_pulse_dc.setEnabled(True)
         self.btn_display_dur.setEnabled(True)
+        self.qcb_stream_pulse.setEnabled(True)
         self.btn_run_pulse_exp.setEnabled(True)
         self.btn_stop_pulse_exp.setEnabled(False)
+        self.qle_sweep_durations.setEnabled(True)
+        self.btn_run_sweep.setEnabled(True)
         self.btn_save_data.setEnabled(True)
+        self.btn_save_sweep.setEnabled(self.sweep is not None and len(self.sweep.steps) > 0)
         self.parent.main_tabs.setTabEnabled(0, True)
         self.parent.main_tabs.setTabEnabled(1, True)
     
@@ -1042,7 +1270,7 @@ class freq_exp_controls(QWidget) :
         elif status == "5 V" :
             new_Vcc = 5.0
         self.disable_controls()
-        successful = self.uController.serial.set_parameter( f'j;{new_Vcc}' )
+        successful = self.uController.set_parameter( f'j;{new_Vcc}' )
         self.enable_controls()
         if successful :
             self.update_param_lbls()
@@ -1085,7 +1313,7 @@ class freq_exp_controls(QWidget) :
             warning_window.build_window(title=title, msg=warning_msg)
             return
         else :
-            successful = self.uController.serial.set_parameter( f'f;{new_R:.3f}' )
+            successful = self.uController.set_parameter( f'f;{new_R:.3f}' )
             if successful :
                 self.update_param_lbls()
             else :
@@ -1117,7 +1345,7 @@ class freq_exp_controls(QWidget) :
             return
         else :
             new_val *= 1e-6
-            successful = self.uController.serial.set_parameter( f'h;{new_val:.3e}' )
+            successful = self.uController.set_parameter( f'h;{new_val:.3e}' )
             if successful :
                 self.update_param_lbls()
             else :
@@ -1148,7 +1376,7 @@ class freq_exp_controls(QWidget) :
             warning_window.build_window(title=title, msg=warning_msg)
             return
         else :
-            successful = self.uController.serial.set_parameter( f'r;{new_val:.0f}' )
+            successful = self.uController.set_parameter( f'r;{new_val:.0f}' )
             if successful :
                 self.update_param_lbls()
             else :
@@ -1179,7 +1407,7 @@ class freq_exp_controls(QWidget) :
             warning_window.build_window(title=title, msg=warning_msg)
             return
         else :
-            successful = self.uController.serial.set_parameter( f't;{new_val:.0f}' )
+            successful = self.uController.set_parameter( f't;{new_val:.0f}' )
             if successful :
                 self.update_param_lbls()
             else :
@@ -1213,6 +1441,9 @@ class freq_exp_controls(QWidget) :
             successful = self.uController.display_dur = new_val
             self.update_param_lbls()
     
+    def update_stream_pulse(self) :
+        self.uController.stream_pulse = self.qcb_stream_pulse.isChecked()
+    
     def update_param_lbls(self) :
         self.disable_controls()
         # self.uController.update_all_parameters()
@@ -1240,6 +1471,12 @@ class freq_exp_controls(QWidget) :
         self.enable_controls()
         if self.uController.dis_charge_choice in [0, 1] :
             self.xy_data = self.result_q.get()
+            self.running_exp.update_plot()
+        
+        if self.running_exp.error is not None :
+            title = "Experiment Error"
+            warning_window = warningWindow(self)
+            warning_window.build_window(title=title, msg=str(self.running_exp.error))
     
     def run_pulse_exp(self) :
         if self.uController.R == 0 or self.uController.C == 0 :
@@ -1253,29 +1490,108 @@ class freq_exp_controls(QWidget) :
         self.disable_controls()
         self.btn_stop_pulse_exp.setEnabled(True)
         
-        self.running_exp = pulse_exp(uController=self.uController, result_q=self.result_q, canvas=self.data_plot)
+        # open-ended runs, completed chunks are written by a background thread
+        capture = self.new_capture(background=self.uController.stream_pulse)
+        self.running_exp = pulse_exp(uController=self.uController, result_q=self.result_q, canvas=self.data_plot, capture=capture)
         self.running_exp.finished.connect(self.exp_complete)
         self.running_exp.start()
     
     def stop_experiment(self) :
+        if self.running_sweep is not None :
+            # ends the current step, the steps measured so far are kept
+            self.running_sweep.sweep.request_stop()
+            return
         self.uController.serial.send_command('stop')
     
+    def run_sweep(self) :
+        if self.uController.R == 0 or self.uController.C == 0 :
+            title = "Resistor/Capacitor Value Entry Error"
+            msg = '\n'.join(["Either/both of the values for the resistor and/or capacitor are invalid. ",
+                        "Please update the values for your current ciruit and then try again."])
+            warning_window = warningWindow(self)
+            warning_window.build_window(title=title, msg=msg)
+            return
+        
+        try :
+            durations = [ int(float(dur)) for dur in self.qle_sweep_durations.text().replace(',', ' ').split() ]
+        except ValueError :
+            durations = []
+        if len(durations) == 0 or min(durations) < 10 :
+            title = "Frequency Sweep - Value Error"
+            msg = '\n'.join(["Pulse durations must be a list of integers equal to 10 or greater, ",
+                        "ex. 500, 200, 100, 50, 20, 10"])
+            warning_window = warningWindow(self)
+            warning_window.build_window(title=title, msg=msg)
+            return
+        
+        self.disable_controls()
+        self.btn_stop_pulse_exp.setEnabled(True)
+        self.exp_prog_bar.setValue(0)
+        
+        self.running_sweep = sweep_exp(uController=self.uController, durations=durations)
+        self.sweep = self.running_sweep.sweep
+        self.running_sweep.notifyProgress.connect(self.exp_prog_update)
+        self.running_sweep.stepComplete.connect(self.plot_sweep)
+        self.running_sweep.finished.connect(self.sweep_complete)
+        self.running_sweep.start()
+    
+    def plot_sweep(self) :
+        self.data_plot.clear_axes()
+        self.sweep.plot(fig=self.data_plot.fig)
+        self.data_plot.draw()
+    
+    def sweep_complete(self) :
+        error = self.running_sweep.error
+        self.running_sweep = None
+        self.plot_sweep()
+        # the pulse duration was changed by every step
+        self.update_param_lbls()
+        if error is not None :
+            title = "Frequency Sweep Error"
+            warning_window = warningWindow(self)
+            warning_window.build_window(title=title, msg=str(error))
+    
+    def save_sweep(self) :
+        (fil, _) = QFileDialog.getSaveFileName(self, "Select Save File", self.folder, "CSV files (*.csv)")
+        
+        if fil == '' :
+            return
+        
+        (self.folder, fil) = os.path.split( fil )
+        if not fil.endswith('.csv') :
+            fil += '.csv'
+        
+        self.sweep.save_csv( os.path.join(self.folder, fil) )
+    
+    def capture_metadata(self) :
+        metadata = super().capture_metadata()
+        metadata['experiment'] = 'Pulse'
+        metadata['pulse_duration_ms'] = self.uController.pulse_duration
+        metadata['pulse_duty_cycle'] = self.uController.pulse_duty_cycle
+        return metadata
+    
     def save_data(self) :
-        fil = QFileDialog.getSaveFileName(self, "Select Save File", self.folder, "CSV files (*.csv)")[0]
+        (fil, file_type) = QFileDialog.getSaveFileName(self, "Select Save File", self.folder, "CSV files (*.csv);;Capture files (*.cap)")
         
         if fil == '' :
             return
         
+        ext = 'cap' if file_type.startswith('Capture') else 'csv'
+        
         (self.folder, self.fil) = os.path.split( fil )
         
         fil = self.fil.split('.')
         
         if len(fil) == 1 :
-            self.fil = fil[0] + '.csv'
-        elif fil[-1] != 'csv' :
-            fil[-1] = 'csv'
+            self.fil = fil[0] + '.' + ext
+        elif fil[-1] != ext :
+            fil[-1] = ext
             self.fil = '.'.join(fil)
         
+        if ext == 'cap' :
+            self.save_capture( os.path.join(self.folder, self.fil) )
+            return
+        
         header = '\n'.join([
             f"Resistor: {self.uController.R} Ohms",
             f"Capacitor: {self.uController.C} uF",
@@ -1283,6 +1599,11 @@ class freq_exp_controls(QWidget) :
             f"Pulse Duty Cycle: {self.uController.pulse_duty_cycle} %",
             ])
         
+        if self.capture_path is not None and os.path.exists(self.capture_path) :
+            # long pulse runs are converted from the file in chunks
+            capture_to_csv(self.capture_path, os.path.join(self.folder, self.fil), header=header)
+            return
+        
         with open(os.path.join(self.folder, self.fil), 'w') as fil :
             np.savetxt(fil, self.xy_data, fmt='%.7e', delimiter=',', newline='\n', header=header, footer='', comments='# ', encoding=None)
     
@@ -1335,62 +1656,92 @@ class connect_thread(QThread) :
 
 class dis_charge_exp(QThread) :
     notifyProgress = pyqtSignal(int)
-    def __init__(self, uController, result_q=None, canvas=None) :
+    newMessage = pyqtSignal(str)
+    def __init__(self, uController, result_q=None, canvas=None, capture=None) :
         QThread.__init__(self)
         self.uController = uController
         self.canvas = canvas
+        self.capture = capture # CaptureWriter, samples are written as they arrive
         
         self.result_q = result_q
-        self.x_data = []
-        self.y_data = []
+        self.runner = ExperimentRunner(self.uController)
+        exp_t = self.uController.R * 1e-6*self.uController.C * self.uController.exp_dur_factor
+        self.samples = SampleRingBuffer( samples_for_duration(exp_t) )
+        self.decimator = None
+        self.fit_result = None
+        self.error = None # RuntimeError which ended the experiment early
+        self.tc_estimator = None
+        if self.uController.dis_charge_choice in [0, 1] :
+            self.tc_estimator = OnlineRCEstimator(self.uController.dis_charge_choice, 
+                                                  self.uController.Vcc)
         
         self.font_size = 25
         
-        if len(self.canvas.axes.figure.axes) == 2 :
-            self.canvas.axes.figure.axes[1].cla()
+        # the canvas is only drawn on from the GUI thread, the worker hands 
+        # frames and progress to the scheduler which draws them from there
+        self.scheduler = RenderScheduler(render=None if self.canvas is None else self.canvas.update_live, 
+                                         on_progress=self.notifyProgress.emit, parent=self)
+        self.finished.connect(self.scheduler.stop)
+        self.scheduler.start()
+        if self.canvas is not None :
+            self.canvas.instrumentation = self.runner.instrumentation
+            self.newMessage.connect(self.canvas.show_message)
+            if self.uController.dis_charge_choice in [0, 1] :
+                Vcc = self.uController.Vcc
+                self.canvas.start_live(xlabel='Time [s]', 
+                                       ylabel='Voltage Across Capacitor [V]', 
+                                       font_size=self.font_size, style='.', 
+                                       label='Exp Results', xlim=[0, exp_t], 
+                                       ylim=[-0.05*Vcc, 1.1*Vcc])
+                # two points (min/max) per horizontal pixel
+                self.decimator = MinMaxDecimator( exp_t / self.canvas.axes_pixel_width() )
+    
+    def fit_data(self) :
+        return self.runner.fit(self.samples.x, self.samples.y, self.uController.dis_charge_choice)
+    
+    def live_tc_text(self) :
+        (tc, tc_err) = self.tc_estimator.estimate()
+        if not np.isfinite(tc) :
+            text = "TC (live): waiting for data"
+        else :
+            text = f"TC (live): {tc:.3f} +/- {tc_err:.3f} s"
+        for status_text in [self.runner.sample_loss_text(), self.runner.clock_text()] :
+            if status_text != '' :
+                text += '\n' + status_text
+        return text
     
     def update_plot(self, fit=False) :
-        self.canvas.axes.cla()
-        ln1 = self.canvas.axes.plot(self.x_data, self.y_data, '.', label='Exp Results')
+        """
+        Full redraw of the experiment results. Must be called from the GUI 
+        thread, ex. once the experiment thread has finished.
+        """
+        x_data = self.samples.x
+        y_data = self.samples.y
         
-        if fit and self.uController.dis_charge_choice in [0, 1] :
-            
+        self.canvas.clear_axes()
+        ln1 = self.canvas.axes.plot(x_data, y_data, '.', label='Exp Results')
+        
+        # a failed fit, ex. too few samples, has nothing to draw
+        if fit and self.fit_result is not None and self.fit_result.success and self.uController.dis_charge_choice in [0, 1] :
+            fit_result = self.fit_result
             Vcc = self.uController.Vcc
-            tc = self.uController.R * self.uController.C *1e-6
-            params = lmfit.Parameters()
-            params.add('Vcc', value=Vcc, min=0.8*Vcc, vary=True)
-            params.add('tc', value=tc, min=0.8*tc, max=1.2*tc, vary=True)
-            if self.uController.dis_charge_choice == 0 :
-                model = lmfit.Model( cap_discharge )
-            else :
-                params.add('offset', value=0, vary=True)
-                model = lmfit.Model( cap_charge )
+            ln2 = self.canvas.axes.plot(x_data, fit_result.evaluate(x_data), label='Fit Results')
             
-            fit_result = model.fit(self.y_data, params, t=self.x_data, nan_policy='omit')
-            ln2 = self.canvas.axes.plot(self.x_data, fit_result.best_fit, label='Fit Results')
-            
-            if len(self.canvas.axes.figure.axes) == 1 :
-                ax2 = self.canvas.axes.twinx()
-            else :
-                ax2 = self.canvas.axes.figure.axes[1]
+            ax2 = self.canvas.axes.twinx()
             I_max = 1000 * Vcc / self.uController.R # mA
-            tc = fit_result.params['tc'].value
-            offset = 0
-            if self.uController.dis_charge_choice == 1 :
-                offset = fit_result.params['offset'].value
-            I_t = theoretical_current(np.array(self.x_data), I_max, tc, offset)
-            ln3 = ax2.plot(self.x_data, I_t, 'k--', label='Calculated Current')
+            I_t = theoretical_current(x_data, I_max, fit_result.tc, fit_result.offset)
+            ln3 = ax2.plot(x_data, I_t, 'k--', label='Calculated Current')
             ax2.set_ylabel("Calculated Current [mA]", fontsize=self.font_size)
             ax2.set_ylim([-0.05, 1.15*np.max(I_t)])
             
             ax2.tick_params(axis='y', labelsize=self.font_size-2)
             
-            txt_x = 0.6 * self.x_data[-1] 
+            txt_x = 0.6 * x_data[-1] 
             txt_y = 0.5 * self.uController.Vcc
             txt_dy = 0.05 * self.uController.Vcc
             self.canvas.axes.text(txt_x, txt_y, "Fit Results:", fontsize=self.font_size); txt_y -= txt_dy
-            # self.canvas.axes.text(txt_x, txt_y, f"Vcc: {fit_result.params['Vcc'].value:.3f} V", fontsize=self.font_size); txt_y -= txt_dy
-            self.canvas.axes.text(txt_x, txt_y, f"TC: {fit_result.params['tc'].value:.3f} s", fontsize=self.font_size); txt_y -= txt_dy
+            # self.canvas.axes.text(txt_x, txt_y, f"Vcc: {fit_result.Vcc:.3f} V", fontsize=self.font_size); txt_y -= txt_dy
+            self.canvas.axes.text(txt_x, txt_y, f"TC: {fit_result.tc:.3f} +/- {fit_result.tc_err:.3f} s", fontsize=self.font_size); txt_y -= txt_dy
             
             lns = ln1 + ln2 + ln3
             lbls = [ l.get_label() for l in lns ]
@@ -1402,8 +1753,9 @@ class dis_charge_exp(QThread) :
         self.canvas.axes.set_xlabel( 'Time [s]', fontsize=self.font_size )
         self.canvas.axes.set_ylabel( 'Voltage Across Capacitor [V]', fontsize=self.font_size )
         
-        self.canvas.fig.tight_layout()
-        self.canvas.draw()
+        with instrument_stage(self.runner.instrumentation, 'update_plot') :
+            self.canvas.fig.tight_layout()
+            self.canvas.draw()
     
     def cap_prepping(self) :
         if self.uController.dis_charge_choice in [2] :
@@ -1412,120 +1764,178 @@ class dis_charge_exp(QThread) :
             text = "Discharging Capacitor"
         else :
             text = "invalid experiment choice"
-        self.canvas.axes.cla()
-        self.canvas.axes.text(0.3, 0.45, text, fontsize=self.font_size)
-        self.canvas.draw()
+        self.newMessage.emit(text)
         
-        while True :
-            result = self.uController.serial.get_responses(num_responses=1, transpose=False, response_types="f", end_message=True)
-            
-            if result[0] in [None, 'end'] :
-                break
-            percent_complete = 100 * result[0] / self.uController.Vcc
-            self.notifyProgress.emit( percent_complete )
+        def on_progress(voltage) :
+            self.scheduler.set_progress( int(100 * voltage / self.uController.Vcc) )
+        self.runner.prep( self.uController.dis_charge_choice == 2, on_progress=on_progress )
         
         if self.uController.dis_charge_choice == -1 :
-            self.canvas.axes.cla()
-            self.canvas.axes.text(0.3, 0.45, 'Capacitor discharged.', fontsize=self.font_size)
-            self.canvas.draw()
+            self.newMessage.emit('Capacitor discharged.')
+    
+    def new_batch(self, x, v) :
+        """
+        Called by the runner with each batch of samples.
+        """
+        if self.decimator is not None :
+            self.decimator.add( x, v )
+        self.tc_estimator.update( x, v )
+        
+        self.scheduler.set_progress( int(100*(current_time()-self.t_start)/self.exp_t) )
+        # only build a frame when the scheduler is ready to draw one
+        if self.decimator is not None and self.scheduler.wants_frame() :
+            self.scheduler.submit( *self.decimator.get_points(), self.live_tc_text() )
     
     def run(self) :
-        itr = 0
-        percent_last_update = 0
-        x_offset = 0
-        
-        next_frame_t = current_time()
-        exp_t = self.uController.R * 1e-6*self.uController.C * self.uController.exp_dur_factor
-        t_start = current_time()
+        self.exp_t = self.uController.R * 1e-6*self.uController.C * self.uController.exp_dur_factor
+        self.t_start = current_time()
         
-        if self.uController.dis_charge_choice == -1 :
-            self.uController.serial.send_command('v')
-            self.cap_prepping()
-            result = self.uController.serial.get_responses(num_responses=1, end_message=True)
-            return
-        elif self.uController.dis_charge_choice == 2 :
-            self.uController.serial.send_command('w')
+        if self.uController.dis_charge_choice in [-1, 2] :
             self.cap_prepping()
-            result = self.uController.serial.get_responses(num_responses=1, end_message=True)
             return
-        elif self.uController.dis_charge_choice == 0 :
-            self.uController.serial.send_command('b')
-        elif self.uController.dis_charge_choice == 1 :
-            self.uController.serial.send_command('a')
-        else :
+        elif self.uController.dis_charge_choice not in [0, 1] :
             return False
         
-        while True :
-            result = self.uController.serial.get_responses(num_responses=1, transpose=False, response_types="f", end_message=True)
-            
-            if result[0] == 'end' :
-                break
-            if itr == 0 :
-                x_offset = result[0]/(1000*1000)
-            itr += 1
-            self.x_data.append( result[0]/(1000*1000)-x_offset )
-            self.y_data.append( result[1] )
-            
-            percent_complete = 100*((current_time()-t_start)/exp_t)
-            self.notifyProgress.emit( percent_complete )
-            
-            if self.canvas is not None and current_time() >= next_frame_t :
-                next_frame_t += 0.1
-                self.update_plot()
-        
-        self.notifyProgress.emit( 100 )
-        self.update_plot(True)
+        try :
+            result = self.runner.dis_charge(self.uController.dis_charge_choice, samples=self.samples, 
+                                            capture=self.capture, on_batch=self.new_batch)
+            self.fit_result = result.fit_result
+        except RuntimeError as error :
+            # the samples read before the failure are still plotted
+            self.error = error
+        self.scheduler.set_progress( 100 )
         
         if self.result_q is not None :
-            self.result_q.put( np.transpose([self.x_data, self.y_data]) )
+            self.result_q.put( self.samples.view() )
 
 class pulse_exp(QThread) :
-    def __init__(self, uController, result_q=None, canvas=None) :
+    def __init__(self, uController, result_q=None, canvas=None, capture=None) :
         QThread.__init__(self)
         self.uController = uController
         self.canvas = canvas
+        self.capture = capture # CaptureWriter, samples are written as they arrive
         self.display_dur = 1000*self.uController.display_dur
+        self.error = None # RuntimeError which ended the experiment early
         
         self.result_q = result_q
-        self.x_data = []
-        self.y_data = []
+        self.runner = ExperimentRunner(self.uController)
+        # when streaming the capture file holds the full run, only the 
+        # displayed window is kept in memory
+        self.samples = SampleRingBuffer( samples_for_duration(self.uController.display_dur), 
+                                         wrap=self.uController.stream_pulse and self.capture is not None )
+        self.decimator = None
+        # per cycle min/max/mean/ripple and steady state, updated with each batch
+        self.analyzer = PulseAnalyzer(self.uController.pulse_duration, self.uController.pulse_duty_cycle, 
+                                      Vcc=self.uController.Vcc, 
+                                      tc=self.uController.R * 1e-6*self.uController.C)
         
         self.font_size = 25
+        
+        # the canvas is only drawn on from the GUI thread, the worker hands 
+        # frames to the scheduler which draws them from there
+        self.scheduler = RenderScheduler(render=None if self.canvas is None else self.canvas.update_live, 
+                                         parent=self)
+        self.finished.connect(self.scheduler.stop)
+        self.scheduler.start()
+        if self.canvas is not None :
+            self.canvas.instrumentation = self.runner.instrumentation
+            display_dur = self.uController.display_dur
+            self.canvas.start_live(xlabel='Experiment Duration [seconds]', 
+                                   ylabel='Voltage Across Capacitor [ volts]', 
+                                   font_size=self.font_size, 
+                                   xlim=[0, display_dur], 
+                                   ylim=[-0.05*self.uController.Vcc, 1.1*self.uController.Vcc], 
+                                   x_window=display_dur)
+            # two points (min/max) per horizontal pixel across the display window
+            num_pixels = self.canvas.axes_pixel_width()
+            self.decimator = MinMaxDecimator( display_dur / num_pixels, 
+                                              max_buckets=2*num_pixels )
     
     def update_plot(self) :
-        self.canvas.axes.cla()
-        self.canvas.axes.plot(self.x_data[-self.display_dur:], self.y_data[-self.display_dur:])
-        
+        """
+        Full redraw of the most recent display_dur of data. Must be called 
+        from the GUI thread, ex. once the experiment thread has finished.
+        """
+        xy_data = self.samples.view(self.display_dur)
+        self.canvas.clear_axes()
+        self.canvas.axes.plot(xy_data[:,0], xy_data[:,1])
+
+        steady = self.analyzer.steady_state()
+        if steady is not None :
+            self.canvas.axes.axhline(steady['mean'], color='k', linestyle='--')
+            self.canvas.axes.axhline(steady['min'], color='k', linestyle=':')
+            self.canvas.axes.axhline(steady['max'], color='k', linestyle=':')
+        txt = self.canvas.axes.text(0.02, 0.97, self.live_text(), transform=self.canvas.axes.transAxes,
+                                    fontsize=self.font_size-5, va='top')
+        txt.set_in_layout(False)
+
         self.canvas.axes.set_xlabel('Experiment Duration [seconds]', fontsize=self.font_size)
         self.canvas.axes.set_ylabel('Voltage Across Capacitor [ volts]', fontsize=self.font_size)
         
         self.canvas.axes.tick_params(axis='x', labelsize=self.font_size-2)
         self.canvas.axes.tick_params(axis='y', labelsize=self.font_size-2)
         
-        self.canvas.fig.tight_layout()
-        self.canvas.draw()
+        with instrument_stage(self.runner.instrumentation, 'update_plot') :
+            self.canvas.fig.tight_layout()
+            self.canvas.draw()
     
-    def run(self) :
-        self.uController.serial.send_command('q')
+    def new_batch(self, x, v) :
+        """
+        Called by the runner with each batch of samples.
+        """
+        if self.decimator is not None :
+            self.decimator.add( x, v )
+        self.analyzer.update( x, v )
         
-        next_frame_t = current_time()
-        itr = 0
-        while True :
-            result = self.uController.serial.get_responses(num_responses=1, transpose=False, response_types="f", end_message=True)
-            
-            if result[0] == 'end' :
-                break
-            if itr == 0 :
-                x_offset = result[0]/(1000*1000)
-            itr += 1
-            self.x_data.append( result[0]/(1000*1000)-x_offset )
-            self.y_data.append( result[1] )
-            if self.canvas is not None and current_time() >= next_frame_t :
-                next_frame_t += 0.1
-                self.update_plot()
+        if self.decimator is not None and self.scheduler.wants_frame() :
+            x_min = x[-1] - self.uController.display_dur
+            self.scheduler.submit( *self.decimator.get_points(x_min), self.live_text() )
+    
+    def live_text(self) :
+        text = self.analyzer.summary_text()
+        for status_text in [self.runner.sample_loss_text(), self.runner.clock_text()] :
+            if status_text != '' :
+                text += '\n' + status_text
+        return text
+    
+    def run(self) :
+        # runs until STOP sends "stop" to the Arduino
+        try :
+            self.runner.pulse(samples=self.samples, capture=self.capture, on_batch=self.new_batch)
+        except RuntimeError as error :
+            self.error = error
         
         if self.result_q is not None :
-            self.result_q.put( np.transpose([self.x_data, self.y_data]) )
+            self.result_q.put( self.samples.view() )
+
+class sweep_exp(QThread) :
+    """
+    Runs a FrequencySweep at the current duty cycle. The GUI redraws the
+    Bode plot after each step.
+    """
+    notifyProgress = pyqtSignal(int)
+    stepComplete = pyqtSignal()
+    
+    def __init__(self, uController, durations) :
+        QThread.__init__(self)
+        self.uController = uController
+        self.runner = ExperimentRunner(self.uController)
+        self.sweep = FrequencySweep(self.runner, durations, duty_cycle=self.uController.pulse_duty_cycle)
+        self.error = None
+    
+    def step_complete(self, step) :
+        self.notifyProgress.emit( int(100 * len(self.sweep.steps) / len(self.sweep.durations)) )
+        self.stepComplete.emit()
+    
+    def run(self) :
+        pulse_duration = self.uController.pulse_duration
+        try :
+            self.sweep.run(on_step=self.step_complete)
+        except RuntimeError as error :
+            self.error = error
+        finally :
+            # back to the pulse duration set before the sweep
+            self.runner.configure(pulse_duration=pulse_duration)
 
 
 
@@ -1572,32 +1982,6 @@ class QVLine(QFrame):
         self.setFrameShape(QFrame.VLine)
         self.setFrameShadow(QFrame.Sunken)
 
-class MplCanvas(FigureCanvas) :
-    """
-    """
-    def __init__(self, parent=None, width=5, height=4, dpi=100):
-        """
-
-        Parameters
-        ----------
-        parent : object, optional
-            This is for the parent object. The default is None.
-        width : int, optional
-            Sets the width of the canvas. The default is 5.
-        height : int, optional
-            Sets the height of the canvas. The default is 4.
-        dpi : int, optional
-            Sets the dpi of the canvas. The default is 100.
-
-        Returns
-        -------
-        None.
-
-        """
-        self.fig = Figure(figsize=(width, height), dpi=dpi)
-        self.axes = self.fig.add_subplot(111)
-        super(MplCanvas, self).__init__(self.fig)
-
 class warningWindow(QDialog):
     """
     Default pop up window to display warnings.
@@ -1719,8 +2103,17 @@ class warningWindow(QDialog):
 
 
 if __name__ == '__main__' :
-    app = QApplication(sys.argv)
-    window = MainWindow()
+    parser = argparse.ArgumentParser(description='Capacitor Experiments')
+    parser.add_argument('--startup-report', nargs='?', const='-', default=None, metavar='FILE',
+                        help='print the start up time of each phase, or save it as json to FILE')
+    parser.add_argument('--instrument', nargs='?', const='.', default=None, metavar='DIR',
+                        help='time each acquisition stage, show a summary in the status bar and '
+                             'write a json report to DIR after each experiment (default: current folder)')
+    args, qt_args = parser.parse_known_args()
+    
+    app = QApplication(sys.argv[:1] + qt_args)
+    startup.mark('QApplication')
+    window = MainWindow(startup=startup, startup_report=args.startup_report, instrument=args.instrument)
     app.exec_()
     window.uController.disconnect()
     sys.exit()
@@ -8,11 +8,12 @@ int pulse_width_ms = 100; // duration of pulse
 int pulse_duty_cycle = 50; // percent duty cycle of the pulse
 
 float Vcc = 5.0;
+bool binary_mode = false; // send samples as packed binary frames instead of "t,V" text
+const unsigned int end_frame_adc = 0xFFFF; // adc value marking the final binary frame, never a valid 10-bit reading
 const int measure_volt = A0; // pin used to measure voltage across capacitor
 float cap_volt = 0; // measured voltage across the capacitor
 
 String serial_command; // command to run from pc
-String serial_bit; // part of pc command
 String cmd; // parsed command from pc
 String param; // parsed parameter from pc
 
@@ -23,25 +24,14 @@ void setup() {
   pinMode(8, OUTPUT);
   digitalWrite(8, LOW);
   Serial.setTimeout(1);
+  Serial.println("ready"); // the host waits for this banner instead of a fixed delay
 }
 
 void loop() {
   serial_command = "";
   while (!Serial.available()) {}
-  while (Serial.available()) {
-    if (false) { serial_command = Serial.readString(); }
-    else if (true) { serial_command = Serial.readStringUntil('/'); }
-    else {
-      while (true) {
-        serial_bit = Serial.readString();
-        serial_command.concat( serial_bit );
-        idx = serial_command.indexOf('/');
-        if (idx != -1) {
-          break;
-        }
-      }
-    }
-  }
+  // one command per loop, commands pipelined by the host wait in the serial buffer
+  serial_command = Serial.readStringUntil('/');
   
   idx = serial_command.indexOf(';');
 
@@ -112,6 +102,10 @@ void loop() {
   
   else if (cmd=="z") { set_pwr_low(); } // set pin powering capacitor LOW
   
+  else if (cmd=="A") { binary_mode = (param.toInt() != 0); Serial.println(1); } // set sample output format, 1 --> binary frames, 0 --> text
+  else if (cmd=="B") { Serial.println(binary_mode); } // get sample output format
+  else if (cmd=="C") { dump_parameters(); } // get all parameters in one line: Vcc,R,C[uF],exp_dur,pulse_width_ms,pulse_duty_cycle
+  
   else if (cmd=="test_connection") { Serial.println("good_connection"); } // test connection
   
   
@@ -128,23 +122,19 @@ void run_exp( int exp_type) {
   int dt = 1000.0; // minimum time between each measurement
   
   unsigned long t;
-  float cap_V;
 
   unsigned long t_exp_end = micros() + float(R*C*exp_dur)*float(1000)*float(1000);
 
   digitalWrite(8, exp_type);
   while (true) {
     t = micros();
-    if (t >= next_t) {
-      cap_V = Vcc * analogRead(A0) / 1023;
-      Serial.print( t );
-      Serial.print( ',' );
-      Serial.println( cap_V );
+    if ((long)(t - next_t) >= 0) {
+      send_sample( t, analogRead(A0) );
       next_t += dt;
     }
-    if (t > t_exp_end) { break; }
+    if ((long)(t - t_exp_end) > 0) { break; }
   }
-  Serial.println( "end" );
+  send_end();
 }
 
 void freq_exp() {
@@ -161,31 +151,27 @@ void freq_exp() {
 
   unsigned long dt_serial_check = long(250) * long(1000);
   
-  float cap_V;
   bool pin_state = false;
   
   while (true) {
     t_current = micros();
-    if (t_current >= next_t_measure) {
-      cap_V = Vcc * analogRead(A0) / 1023;
-      Serial.print( t_current );
-      Serial.print( ',' );
-      Serial.println( cap_V );
+    if ((long)(t_current - next_t_measure) >= 0) {
+      send_sample( t_current, analogRead(A0) );
       next_t_measure += dt_measure;
     }
-    if (t_current >= next_t_pulse) {
+    if ((long)(t_current - next_t_pulse) >= 0) {
       pin_state = !pin_state;
       digitalWrite(8, pin_state);
       if (pin_state) { next_t_pulse += dt_on; }
       else {next_t_pulse += dt_off; }
     }
-    if (t_current >= next_serial_check) {
+    if ((long)(t_current - next_serial_check) >= 0) {
       cmd = Serial.readStringUntil('/');
       if (cmd=="stop") { break; }
       next_serial_check += dt_serial_check;
     }
   }
-  Serial.println( "end" );
+  send_end();
 }
 
 void dis_charge_cap(int exp_type) {
@@ -198,19 +184,14 @@ void dis_charge_cap(int exp_type) {
   
   unsigned long t_check_serial = micros(); // time to check serial
   unsigned long dt_serial_check = long(250) * long(1000); // minimum time between each serial check
-
-  float cap_V;
   
   while(true) {
     t_now = micros();
-    if(t_now >= t_measure_next) {
-      cap_V = Vcc * analogRead(A0) / 1023;
-      Serial.print( t_now );
-      Serial.print( ',' );
-      Serial.println( cap_V );
+    if((long)(t_now - t_measure_next) >= 0) {
+      send_sample( t_now, analogRead(A0) );
       t_measure_next += dt_measure;
     }
-    if(t_now >= t_check_serial) {
+    if((long)(t_now - t_check_serial) >= 0) {
       cmd = Serial.readStringUntil('/');
       if (cmd=="stop") { break; }
       t_check_serial += dt_serial_check;
@@ -258,6 +239,35 @@ void verify_cap_charged(bool serial_return) {
 
 void set_pwr_low() { digitalWrite(8, LOW); }
 
+void dump_parameters() {
+  // same values and formatting as the k, g, i, m, s and u commands
+  Serial.print( Vcc ); Serial.print( ',' );
+  Serial.print( R ); Serial.print( ',' );
+  Serial.print( 1e6*C ); Serial.print( ',' );
+  Serial.print( exp_dur ); Serial.print( ',' );
+  Serial.print( pulse_width_ms ); Serial.print( ',' );
+  Serial.println( pulse_duty_cycle );
+}
+
+void send_sample(unsigned long t, unsigned int adc) {
+  // binary frame: uint32 micros followed by uint16 adc count, both little-endian (6 bytes)
+  // text line: "t,V" with V = Vcc * adc / 1023
+  if (binary_mode) {
+    Serial.write( (uint8_t*)&t, 4 );
+    Serial.write( (uint8_t*)&adc, 2 );
+  } else {
+    Serial.print( t );
+    Serial.print( ',' );
+    Serial.println( Vcc * adc / 1023 );
+  }
+}
+
+void send_end() {
+  // binary streams are terminated by a frame carrying end_frame_adc
+  if (binary_mode) { send_sample( micros(), end_frame_adc ); }
+  else { Serial.println( "end" ); }
+}
+
 
 
 
@@ -293,22 +303,18 @@ void run_exp_samples( int exp_type) {
   int dt = 1000.0*1000.0*float(tc)/float(steps_per_tc); // minimum time between each measurement
   
   unsigned long t;
-  float cap_V;
 
   digitalWrite(8, exp_type);
   while (true) {
     t = micros();
-    if (t >= next_t) {
-      cap_V = Vcc * analogRead(A0) / 1023;
-      Serial.print( t );
-      Serial.print( ',' );
-      Serial.println( cap_V );
+    if ((long)(t - next_t) >= 0) {
+      send_sample( t, analogRead(A0) );
       itr += 1;
       next_t += dt;
     }
     if (itr >= total_num_data_points) { break; }
   }
-  Serial.println( "end" );
+  send_end();
 }
 
 
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Experiment parameters of the Arduino, shared by the GUI and the headless
+ExperimentRunner. No Qt imports.
+"""
+
+from Arduino import Arduino
+
+DUMP_PROBE_TIMEOUT = 0.2 # seconds to wait for the first answer to "C"
+
+class arduino() :
+    # cached parameter: (set command, get command, dtype, firmware units of the set command per host unit)
+    # the order of the get commands is the order of the "C" parameter dump
+    parameters = {
+        'Vcc': ('j', 'k', 'f', 1), 
+        'R': ('f', 'g', 'f', 1), 
+        'C': ('h', 'i', 'f', 1e-6), # set in F, get in uF
+        'exp_dur_factor': ('l', 'm', 'i', 1), 
+        'pulse_duration': ('r', 's', 'i', 1), 
+        'pulse_duty_cycle': ('t', 'u', 'i', 1), 
+        }
+    
+    def __init__(self, port='/dev/ttyACM0', baud=250000) :
+        self.connected = False
+        
+        self.port = port
+        self.baud = baud
+        self.serial = Arduino(self.port, self.baud, timeout=1, eol='/')
+        
+        """
+        if self.port not in self.serial.get_avail_ports() :
+            self.port = self.serial.get_avail_ports()[0]
+            self.serial.port = self.port
+        """
+        
+        self.Vcc = -1
+        self.R = -1
+        self.C = -1
+        self.exp_dur_factor = -1
+        self.pulse_duration = -1
+        self.pulse_duty_cycle = -1
+        
+        self.dis_charge_choice = 1
+        self.refine_fit = False # refine the fast fit with lmfit
+        
+        self.display_dur = 15
+        self.stream_pulse = True # keep only the displayed pulse data in memory
+        
+        # parameters whose cached value may differ from the Arduino
+        self.dirty_params = set(self.parameters)
+        # firmware answers the "C" parameter dump, None until probed
+        self.dump_supported = None
+    
+    def connect(self) :
+        if not self.connected :
+            # Arduino.connect returns once the board has answered the handshake
+            connection_result = self.serial.connect(port=self.port)
+            
+            if connection_result == 'Success' :
+                self.connected = True
+                self.dirty_params = set(self.parameters)
+                self.dump_supported = None
+                self.update_all_parameters()
+            
+            self.serial.send_command('z')
+            
+        return self.connected
+    
+    def disconnect(self) :
+        if self.connected :
+            self.serial.send_command("z")
+            self.serial.disconnect()
+            self.connected = False
+    
+    def set_parameter(self, cmd) :
+        """
+        Sets a parameter on the Arduino and, once acknowledged, in the cache.
+        
+        Parameters
+        ----------
+        cmd : str
+            Set command, ex. 'f;2200.000'.
+        
+        Returns
+        -------
+        bool
+            True if the Arduino acknowledged the new value.
+        
+        """
+        successful = self.serial.set_parameter( cmd )
+        self._update_cache( cmd, successful )
+        return successful
+    
+    def set_parameters(self, cmds) :
+        """
+        Sets several parameters with one pipelined exchange, see 
+        Arduino.transact, and updates the cache of those acknowledged.
+        
+        Parameters
+        ----------
+        cmds : list of str
+            Set commands, ex. ['f;2200.000', 'h;2.200e-04'].
+        
+        Returns
+        -------
+        list of bool
+            True for each command the Arduino acknowledged.
+        
+        """
+        results = self.serial.transact( cmds )
+        successful = [ success for (success, _) in results ]
+        for (cmd, success) in zip(cmds, successful) :
+            self._update_cache( cmd, success )
+        return successful
+    
+    def _update_cache(self, cmd, successful) :
+        (set_cmd, _, value) = cmd.partition(';')
+        name = None
+        for (param_name, (param_set_cmd, _, dtype, scale)) in self.parameters.items() :
+            if param_set_cmd == set_cmd :
+                name = param_name
+                break
+        if name is None :
+            return
+        if not successful :
+            # the command may or may not have been applied
+            self.dirty_params.add( name )
+            return
+        
+        try :
+            value = round( float(value) / scale, 6 )
+            if dtype == 'i' :
+                value = int(value)
+            setattr(self, name, value)
+            self.dirty_params.discard( name )
+        except ValueError :
+            self.dirty_params.add( name )
+    
+    def update_all_parameters(self, force=False) :
+        """
+        Refreshes the cached parameters from the Arduino.
+        Nothing is sent unless a cached value is unknown or force is True, 
+        otherwise all parameters are read with one "C" dump. The first refresh 
+        after connecting probes for the dump, firmware without it is read one 
+        parameter at a time.
+        
+        Parameters
+        ----------
+        force : bool, optional
+            Read the parameters even if the cache is clean. The default is False.
+        
+        Returns
+        -------
+        bool
+            True if every parameter is known.
+        
+        """
+        if not force and len(self.dirty_params) == 0 :
+            return True
+        
+        values = None
+        if self.dump_supported is None :
+            # firmware without the dump never answers, probe it once with a 
+            # single short attempt rather than waiting out the retries
+            response = self.serial.get_parameter('C', attempts=1, timeout=DUMP_PROBE_TIMEOUT)
+            self.dump_supported = response is not None
+        elif self.dump_supported :
+            response = self.serial.get_parameter('C')
+        else :
+            response = None
+        
+        if response is not None :
+            values = response.split(',')
+            if len(values) != len(self.parameters) :
+                values = None
+        
+        if values is None :
+            values = [ self.serial.get_parameter(get_cmd) 
+                       for (_, get_cmd, _, _) in self.parameters.values() ]
+        
+        for (name, value) in zip(self.parameters, values) :
+            dtype = self.parameters[name][2]
+            try :
+                value = float(value)
+                setattr(self, name, int(value) if dtype == 'i' else value)
+                self.dirty_params.discard( name )
+            except (TypeError, ValueError) :
+                self.dirty_params.add( name )
+        
+        return len(self.dirty_params) == 0
@@ -0,0 +1,485 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Software stand-in for an Arduino running ard_capacitor_exp.ino.
+A pseudo-terminal is opened which Arduino.connect can attach to like a real
+serial port, commands are answered as the firmware would and the voltage
+across the capacitor is simulated for the configured RC circuit.
+
+Usage:
+    python arduino_emulator.py --R 2200 --C 220 --noise 0.005
+    python arduino_emulator.py --speed 0 --baud 0      # as fast as possible
+"""
+
+import os
+import re
+import sys
+import tty
+import select
+import argparse
+import threading
+from time import sleep as time_sleep
+from time import perf_counter
+
+import numpy as np
+
+from Arduino import ADC_MAX, FRAME_DTYPE, END_FRAME_ADC
+
+_NUMBER_RE = re.compile(r'\s*[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?')
+
+def _leading_number(text) :
+    """
+    Leading numeric part of text, as Arduino's String.toFloat/toInt (atof)
+    read it. 0 if there is none.
+    """
+    match = _NUMBER_RE.match(text)
+    return float(match.group(0)) if match is not None else 0.
+
+def _print_float(value) :
+    # Serial.println(float) prints two decimal places
+    return f'{value:.2f}'
+
+class ArduinoEmulator() :
+    """
+    Emulates the capacitor experiment firmware on a pseudo-terminal.
+
+    The simulated circuit (R, C, Vcc and noise) is separate
+    from the firmware parameters set with the f/h/j commands, as it is with
+    real hardware. Time runs on a virtual micros() clock which advances at
+    "speed" times real time, or as fast as samples can be written if speed
+    is 0. Output is throttled to the serial line rate unless baud is 0.
+    """
+    def __init__(self, R=2200, C=220, Vcc=5.0, noise=0.005,
+                 sample_period=1e-3, baud=250000, speed=1.0, seed=None,
+                 boot_time=0., micros_start=0) :
+        """
+        Constructs the ArduinoEmulator class.
+
+        Parameters
+        ----------
+        R : float, optional
+            Resistance of the simulated circuit in Ohms. The default is 2200.
+        C : float, optional
+            Capacitance of the simulated circuit in uF. The default is 220.
+        Vcc : float, optional
+            Supply voltage of the simulated circuit. The default is 5.0.
+        noise : float, optional
+            RMS noise added to each voltage reading. The default is 0.005.
+        sample_period : float, optional
+            Time between samples in seconds. The default is 1e-3, as the
+            firmware.
+        baud : int, optional
+            Serial line rate used to throttle output, 10 bits per byte.
+            0 disables throttling. The default is 250000.
+        speed : float, optional
+            Rate of the virtual clock relative to real time. 0 runs as fast
+            as possible. The default is 1.0.
+        seed : int, optional
+            Seed for the noise. The default is None.
+        boot_time : float, optional
+            Seconds before setup() prints the ready banner, as the bootloader
+            delay after a reset. The default is 0.
+        micros_start : int, optional
+            Virtual micros() at start up, ex. 2**32 - 5e6 to see micros()
+            wrap after 5 s. The default is 0.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.circuit_R = R
+        self.circuit_C = C
+        self.circuit_Vcc = Vcc
+        self.noise = noise
+        self.dt_us = max( int(round(sample_period*1e6)), 1 )
+        self.baud = baud
+        self.speed = speed
+        self.rng = np.random.default_rng(seed)
+        self.boot_time = boot_time
+        self.micros_start = micros_start
+        
+        # firmware state, with the firmware's initial values
+        self.R = 0.
+        self.C = 0.
+        self.Vcc = 5.0
+        self.exp_dur = 7
+        self.steps_per_tc = 50
+        self.pulse_width_ms = 100
+        self.pulse_duty_cycle = 50
+        self.binary_mode = False
+        self.pin_state = 0
+        self.param = ''
+        
+        # simulated circuit state
+        self.cap_v = 0.
+        self.cap_t = float(micros_start) # virtual micros() of cap_v
+        self.pulse_dts = None # (on, off) durations [us] while pulsing
+        self.next_toggle_us = None
+        self.virtual_us = float(micros_start)
+        
+        self.master_fd = None
+        self.slave_fd = None
+        self.port = None
+        self.rx_buffer = b''
+        self.tx_free_t = 0. # wall time when the simulated line is idle
+        self.bytes_sent = 0
+        
+        self.thread = None
+        self.stop_event = threading.Event()
+    
+    def __enter__(self) :
+        self.start()
+        return self
+    
+    def __exit__(self, *args) :
+        self.stop()
+    
+    def start(self) :
+        """
+        Opens the pseudo-terminal and starts answering commands.
+
+        Returns
+        -------
+        str
+            Port to pass to Arduino.connect, ex. '/dev/pts/3'.
+
+        """
+        if self.thread is not None :
+            return self.port
+        (self.master_fd, self.slave_fd) = os.openpty()
+        tty.setraw(self.slave_fd)
+        # the slave end is held open so the pty survives the host reconnecting
+        self.port = os.ttyname(self.slave_fd)
+        
+        self.wall_t0 = perf_counter()
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self.port
+    
+    def stop(self) :
+        """
+        Stops the emulator and closes the pseudo-terminal.
+
+        Returns
+        -------
+        None.
+
+        """
+        if self.thread is None :
+            return
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+        for fd in [self.master_fd, self.slave_fd] :
+            try :
+                os.close(fd)
+            except OSError :
+                pass
+        self.master_fd = None
+        self.slave_fd = None
+    
+    # ---------- serial io ----------
+    
+    def _read_available(self, timeout=0) :
+        """
+        Moves any bytes sent by the host into rx_buffer.
+        """
+        (readable, _, _) = select.select([self.master_fd], [], [], timeout)
+        if len(readable) == 0 :
+            return False
+        try :
+            data = os.read(self.master_fd, 4096)
+        except OSError :
+            # EIO while no host has the port open
+            time_sleep(0.01)
+            return False
+        self.rx_buffer += data
+        return len(data) > 0
+    
+    def _write(self, data) :
+        """
+        Writes to the host, at no more than the simulated line rate.
+        """
+        if self.baud :
+            now = perf_counter()
+            self.tx_free_t = max(self.tx_free_t, now) + 10*len(data)/self.baud
+            if self.tx_free_t - now > 1e-3 :
+                time_sleep( self.tx_free_t - now )
+        
+        while len(data) > 0 and not self.stop_event.is_set() :
+            (_, writable, _) = select.select([], [self.master_fd], [], 0.1)
+            if len(writable) == 0 :
+                continue
+            num_written = os.write(self.master_fd, data)
+            data = data[num_written:]
+            self.bytes_sent += num_written
+    
+    def _println(self, value) :
+        self._write( f'{value}\r\n'.encode('utf-8') )
+    
+    # ---------- simulated circuit ----------
+    
+    def _now(self) :
+        """
+        Virtual micros(). With speed 0 the clock only advances as samples
+        are produced.
+        """
+        if self.speed :
+            self.virtual_us = max(self.virtual_us,
+                                  self.micros_start + (perf_counter() - self.wall_t0) * self.speed * 1e6)
+        return self.virtual_us
+    
+    def _tc_us(self) :
+        return max( self.circuit_R * self.circuit_C, 1e-6 )
+    
+    def _advance_cap(self, t_us) :
+        target = self.circuit_Vcc * self.pin_state
+        if t_us > self.cap_t :
+            self.cap_v = target + (self.cap_v - target) * np.exp( -(t_us - self.cap_t) / self._tc_us() )
+            self.cap_t = t_us
+    
+    def _cap_voltages(self, times) :
+        """
+        Capacitor voltage at each time in times [us], increasing.
+        During a pulse experiment the pin is switched at next_toggle_us.
+        """
+        v = np.empty( len(times) )
+        start = 0
+        while start < len(times) :
+            toggle = self.next_toggle_us if self.pulse_dts is not None else None
+            end = len(times) if toggle is None else np.searchsorted(times, toggle, side='left')
+            if end > start :
+                target = self.circuit_Vcc * self.pin_state
+                seg = times[start:end]
+                v[start:end] = target + (self.cap_v - target) * np.exp( -(seg - self.cap_t) / self._tc_us() )
+                self.cap_v = v[end-1]
+                self.cap_t = seg[-1]
+            if end < len(times) :
+                self._advance_cap( toggle )
+                self.pin_state = 1 - self.pin_state
+                self.next_toggle_us += self.pulse_dts[0] if self.pin_state else self.pulse_dts[1]
+            start = end
+        return v
+    
+    def _read_adc(self, v) :
+        v = np.asarray(v, dtype=float)
+        if self.noise > 0 :
+            v = v + self.rng.normal(0, self.noise, v.shape)
+        adc = np.rint( v / self.circuit_Vcc * ADC_MAX )
+        return np.clip(adc, 0, ADC_MAX).astype(np.int64)
+    
+    # ---------- firmware output ----------
+    
+    def _send_samples(self, times, adc) :
+        """
+        send_sample for a batch of samples.
+        """
+        t = np.asarray(times).astype(np.uint64) & 0xFFFFFFFF
+        if self.binary_mode :
+            frames = np.empty( len(t), dtype=FRAME_DTYPE )
+            frames['t'] = t
+            frames['adc'] = adc
+            self._write( frames.tobytes() )
+        else :
+            v = self.Vcc * adc / ADC_MAX
+            self._write( ''.join([ f'{ti},{vi:.2f}\r\n' for (ti, vi) in zip(t.tolist(), v.tolist()) ]).encode('utf-8') )
+    
+    def _send_end(self) :
+        if self.binary_mode :
+            self._send_samples( [self._now()], np.array([END_FRAME_ADC]) )
+        else :
+            self._println( 'end' )
+    
+    def _stop_requested(self) :
+        """
+        Serial check of the streaming loops, anything but "stop" is discarded
+        as the firmware's readStringUntil('/') does.
+        """
+        self._read_available()
+        while b'/' in self.rx_buffer :
+            (cmd, self.rx_buffer) = self.rx_buffer.split(b'/', 1)
+            if cmd.strip() == b'stop' :
+                return True
+        return self.stop_event.is_set()
+    
+    def _stream(self, t_end=None, check_stop=False) :
+        """
+        Sends a sample every dt_us from now until t_end [us] or until "stop".
+        """
+        next_t = self._now()
+        while not self.stop_event.is_set() :
+            if self.speed :
+                now = self._now()
+                num_due = int( (now - next_t) // self.dt_us ) + 1
+                if num_due <= 0 :
+                    time_sleep( 0.5e-3 )
+                    continue
+            else :
+                num_due = 1000
+            # bounded batches keep the stop check responsive
+            times = next_t + self.dt_us * np.arange( min(num_due, 1000) )
+            if t_end is not None :
+                times = times[times <= t_end]
+            if len(times) > 0 :
+                self._send_samples( times, self._read_adc(self._cap_voltages(times)) )
+                next_t = times[-1] + self.dt_us
+                if not self.speed :
+                    self.virtual_us = next_t
+            if t_end is not None and next_t > t_end :
+                break
+            if check_stop and self._stop_requested() :
+                break
+    
+    # ---------- firmware commands ----------
+    
+    def run_exp(self, exp_type) :
+        self._advance_cap( self._now() )
+        t_end = self._now() + self.R*self.C*self.exp_dur*1e6
+        self.pin_state = exp_type
+        self._stream( t_end=t_end )
+        self._send_end()
+    
+    def freq_exp(self) :
+        self._advance_cap( self._now() )
+        dt_on = self.pulse_width_ms * self.pulse_duty_cycle * 10
+        dt_off = self.pulse_width_ms * (100 - self.pulse_duty_cycle) * 10
+        # the firmware starts with the pin LOW and switches it at once
+        self.pin_state = 0
+        self.next_toggle_us = self._now()
+        self.pulse_dts = (max(dt_on, 1), max(dt_off, 1))
+        self._stream( check_stop=True )
+        self.pulse_dts = None
+        self._send_end()
+    
+    def dis_charge_cap(self, exp_type) :
+        # as the firmware, the pin is not changed and no end is sent
+        self._advance_cap( self._now() )
+        self._stream( check_stop=True )
+    
+    def verify_cap(self, charged) :
+        self._advance_cap( self._now() )
+        self.pin_state = 1 if charged else 0
+        next_t = self._now()
+        while not self.stop_event.is_set() :
+            if self.speed :
+                now = self._now()
+                if now < next_t :
+                    time_sleep( min((next_t-now)/self.speed/1e6, 5e-3) )
+                    continue
+            else :
+                self.virtual_us = next_t
+            adc = self._read_adc( self._cap_voltages(np.array([next_t])) )[0]
+            self._println( _print_float(self.Vcc*adc/ADC_MAX) )
+            next_t += 5000
+            # the firmware's thresholds, 5 and 3 counts from the rails
+            if (charged and adc > ADC_MAX-5) or (not charged and adc < 3) :
+                self._println( 'end' )
+                break
+        self._println( 'end' )
+    
+    def run_command(self, serial_command) :
+        """
+        Runs one '/' terminated command, as loop() in the firmware.
+
+        Parameters
+        ----------
+        serial_command : str
+            Command without the terminator, ex. 'f;2200'.
+
+        Returns
+        -------
+        None.
+
+        """
+        idx = serial_command.find(';')
+        if idx != -1 :
+            # the firmware keeps the previous param when none is given
+            self.param = serial_command[idx+1:]
+            cmd = serial_command[:idx]
+        else :
+            cmd = serial_command
+        param = self.param
+        
+        if cmd == 'a' : self.run_exp(1)
+        elif cmd == 'b' : self.run_exp(0)
+        elif cmd in ['c', 'd'] :
+            self._advance_cap( self._now() )
+            self.pin_state = 0 if cmd == 'c' else 1
+            self._println(1)
+        elif cmd == 'e' : self._println(self.pin_state)
+        elif cmd == 'f' : self.R = _leading_number(param); self._println(1)
+        elif cmd == 'g' : self._println( _print_float(self.R) )
+        elif cmd == 'h' : self.C = _leading_number(param); self._println(1)
+        elif cmd == 'i' : self._println( _print_float(1e6*self.C) )
+        elif cmd == 'j' : self.Vcc = _leading_number(param); self._println(1)
+        elif cmd == 'k' : self._println( _print_float(self.Vcc) )
+        elif cmd == 'l' : self.exp_dur = int(_leading_number(param)); self._println(1)
+        elif cmd == 'm' : self._println(self.exp_dur)
+        elif cmd == 'n' : self.steps_per_tc = int(_leading_number(param)); self._println(1)
+        elif cmd == 'o' : self._println(self.steps_per_tc)
+        elif cmd == 'p' :
+            self._advance_cap( self._now() )
+            adc = self._read_adc( self.cap_v )
+            self._println( _print_float(self.Vcc*adc/ADC_MAX) )
+        elif cmd == 'q' : self.freq_exp()
+        elif cmd == 'r' : self.pulse_width_ms = int(_leading_number(param)); self._println(1)
+        elif cmd == 's' : self._println(self.pulse_width_ms)
+        elif cmd == 't' : self.pulse_duty_cycle = int(_leading_number(param)); self._println(1)
+        elif cmd == 'u' : self._println(self.pulse_duty_cycle)
+        elif cmd == 'v' : self.verify_cap(False)
+        elif cmd == 'w' : self.verify_cap(True)
+        elif cmd == 'x' : self.dis_charge_cap(1)
+        elif cmd == 'y' : self.dis_charge_cap(0)
+        elif cmd == 'z' :
+            self._advance_cap( self._now() )
+            self.pin_state = 0
+        elif cmd == 'A' : self.binary_mode = int(_leading_number(param)) != 0; self._println(1)
+        elif cmd == 'B' : self._println( int(self.binary_mode) )
+        elif cmd == 'C' :
+            self._println( ','.join([ _print_float(self.Vcc), _print_float(self.R), 
+                                      _print_float(1e6*self.C), str(self.exp_dur), 
+                                      str(self.pulse_width_ms), str(self.pulse_duty_cycle) ]) )
+        elif cmd == 'test_connection' : self._println('good_connection')
+    
+    def _run(self) :
+        # setup(), the host's input buffer holds the banner until it connects
+        if self.stop_event.wait( self.boot_time ) :
+            return
+        self._println( 'ready' )
+        while not self.stop_event.is_set() :
+            if b'/' not in self.rx_buffer :
+                self._read_available(timeout=0.05)
+                continue
+            (cmd, self.rx_buffer) = self.rx_buffer.split(b'/', 1)
+            self.run_command( cmd.decode('utf-8', errors='replace').strip() )
+
+def main(argv=None) :
+    parser = argparse.ArgumentParser(description='Emulate the capacitor experiment Arduino on a pseudo-terminal.')
+    parser.add_argument('--R', type=float, default=2200, help='circuit resistance [Ohms]')
+    parser.add_argument('--C', type=float, default=220, help='circuit capacitance [uF]')
+    parser.add_argument('--Vcc', type=float, default=5.0, help='circuit supply voltage [V]')
+    parser.add_argument('--noise', type=float, default=0.005, help='rms voltage noise [V]')
+    parser.add_argument('--sample-period', type=float, default=1e-3, help='time between samples [s]')
+    parser.add_argument('--baud', type=int, default=250000, help='serial line rate, 0 for unthrottled')
+    parser.add_argument('--speed', type=float, default=1.0, help='clock rate relative to real time, 0 for as fast as possible')
+    parser.add_argument('--seed', type=int, default=None, help='noise seed')
+    parser.add_argument('--micros-start', type=int, default=0, help='micros() at start up, to test wrapping')
+    args = parser.parse_args(argv)
+    
+    emulator = ArduinoEmulator(R=args.R, C=args.C, Vcc=args.Vcc, noise=args.noise, sample_period=args.sample_period,
+                               baud=args.baud, speed=args.speed, seed=args.seed,
+                               micros_start=args.micros_start)
+    port = emulator.start()
+    print( f'Emulated Arduino on {port}, Ctrl-C to stop' )
+    try :
+        while True :
+            time_sleep(1)
+    except KeyboardInterrupt :
+        pass
+    emulator.stop()
+    return 0
+
+if __name__ == '__main__' :
+    sys.exit( main() )
@@ -0,0 +1,502 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+asyncio client for the capacitor experiment firmware.
+The serial port's file descriptor is put in non-blocking mode and watched
+with the event loop's add_reader/add_writer, so one event loop can drive
+any number of boards without threads. Requires an event loop with reader
+callbacks, ex. the default selector loop on Linux and macOS.
+
+Usage:
+    python async_arduino.py --ports /dev/ttyACM0 /dev/ttyACM1 charge
+    python async_arduino.py --emulate 3 --R 2200 --C 22 discharge
+"""
+
+import os
+import sys
+import asyncio
+import argparse
+from time import perf_counter
+
+import numpy as np
+import serial
+
+from Arduino import FRAME_DTYPE, END_FRAME_ADC, READY_BANNER, parse_sample_lines
+
+LINE_EOL = b'\r\n' # the firmware answers with Serial.println
+
+class AsyncArduino() :
+    """
+    Non-blocking Arduino connection.
+    Incoming bytes are split into response lines, or, while an experiment
+    is streaming, parsed into sample batches as they arrive. Commands that
+    expect a response are serialized with a lock so several coroutines can
+    share one board.
+    """
+    def __init__(self, port, baud=250000, eol='/', ready_timeout=3.0, max_batches=1000) :
+        """
+        Constructs the AsyncArduino class.
+
+        Parameters
+        ----------
+        port : str
+            Serial port of the Arduino.
+        baud : int, optional
+            Baud rate. The default is 250000.
+        eol : str, optional
+            Terminator appended to commands. The default is '/'.
+        ready_timeout : float, optional
+            Seconds connect waits for the board. The default is 3.0.
+        max_batches : int, optional
+            Sample batches held for the consumer, the oldest is dropped
+            when full. The default is 1000.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.port = port
+        self.baud = baud
+        self.eol = eol.encode('utf-8')
+        self.ready_timeout = ready_timeout
+        self.ready_latency = None
+        self.max_batches = max_batches
+        
+        self.arduino = None
+        self.fd = None
+        self.loop = None
+        
+        self.rx_buffer = b''
+        self.tx_buffer = b''
+        self.tx_drained = None # future waiting for tx_buffer to empty
+        self.lines = None # asyncio.Queue of response lines
+        self.command_lock = None
+        
+        self.streaming = None # None, 'text' or 'binary'
+        self.batches = None # asyncio.Queue of (t, v, ended)
+        self.dropped_samples = 0
+        self.closed_error = None
+    
+    @property
+    def connected(self) :
+        return self.arduino is not None
+    
+    async def __aenter__(self) :
+        result = await self.connect()
+        if result != 'Success' :
+            raise ConnectionError( f'{self.port}: {result}' )
+        return self
+    
+    async def __aexit__(self, *args) :
+        await self.disconnect()
+    
+    async def connect(self, probe_after=1.5, initial_wait=0.01, max_wait=0.25) :
+        """
+        Opens the port and waits for the firmware, as Arduino.connect and
+        Arduino.wait_until_ready do: it returns on the ready banner, or on
+        an answer to a test_connection probe for boards that don't reset.
+
+        Parameters
+        ----------
+        probe_after : float, optional
+            Seconds to wait for the banner before the first probe, at least
+            the bootloader's delay after a reset. The default is 1.5.
+        initial_wait : float, optional
+            Seconds between the first two probes. The default is 0.01.
+        max_wait : float, optional
+            Longest time between probes. The default is 0.25.
+
+        Returns
+        -------
+        str
+            'Success', or a description of the failure.
+
+        """
+        if self.arduino is not None :
+            return 'Arduino already connected'
+        try :
+            self.arduino = serial.Serial(self.port, self.baud, timeout=0)
+        except (serial.SerialException, OSError) :
+            return 'Connection Failure'
+        
+        self.loop = asyncio.get_running_loop()
+        self.fd = self.arduino.fileno()
+        os.set_blocking(self.fd, False)
+        self.rx_buffer = b''
+        self.tx_buffer = b''
+        self.lines = asyncio.Queue()
+        self.command_lock = asyncio.Lock()
+        self.closed_error = None
+        self.loop.add_reader(self.fd, self._on_readable)
+        
+        t_start = perf_counter()
+        next_probe = t_start + probe_after
+        wait = initial_wait
+        num_probes = 0
+        while True :
+            now = perf_counter()
+            remaining = self.ready_timeout - (now - t_start)
+            if remaining <= 0 :
+                await self.disconnect()
+                return 'No response from Arduino'
+            if now >= next_probe :
+                # no banner, probe in case the board did not reset
+                await self.send_command('test_connection')
+                num_probes += 1
+                next_probe = now + wait
+                wait = min(2*wait, max_wait)
+            line = await self.readline( min(next_probe - now, remaining) )
+            if line in [READY_BANNER, b'good_connection'] :
+                self.ready_latency = perf_counter() - t_start
+                break
+        
+        if num_probes > 0 :
+            # probes sent while the board was booting may still be answered
+            while await self.readline(0.02) is not None :
+                pass
+        return 'Success'
+    
+    async def disconnect(self) :
+        """
+        Stops watching the port and closes it.
+        """
+        if self.arduino is None :
+            return
+        self.loop.remove_reader(self.fd)
+        self.loop.remove_writer(self.fd)
+        if self.tx_drained is not None and not self.tx_drained.done() :
+            self.tx_drained.cancel()
+        self.arduino.close()
+        self.arduino = None
+        self.fd = None
+    
+    def _on_readable(self) :
+        try :
+            data = os.read(self.fd, 65536)
+        except BlockingIOError :
+            return
+        except OSError as e :
+            data = b''
+            self.closed_error = e
+        if data == b'' :
+            # the device went away, end any stream and stop watching the port
+            self.closed_error = self.closed_error or ConnectionError( f'{self.port} closed' )
+            self.loop.remove_reader(self.fd)
+            if self.streaming is not None :
+                self.streaming = None
+                self._queue_batch( (np.empty(0), np.empty(0), True) )
+            return
+        self.rx_buffer += data
+        self._dispatch()
+    
+    def _dispatch(self) :
+        if self.streaming == 'text' :
+            t, v, ended, self.rx_buffer = parse_sample_lines(self.rx_buffer, eol=LINE_EOL)
+            if len(t) > 0 or ended :
+                self._queue_batch( (t, v, ended) )
+            if ended :
+                self.streaming = None
+        elif self.streaming == 'binary' :
+            frame_size = FRAME_DTYPE.itemsize
+            num_frames = len(self.rx_buffer) // frame_size
+            frames = np.frombuffer(self.rx_buffer, dtype=FRAME_DTYPE, count=num_frames)
+            end_idx = np.flatnonzero(frames['adc'] == END_FRAME_ADC)
+            ended = end_idx.size > 0
+            if ended :
+                num_frames = end_idx[0]
+                self.rx_buffer = self.rx_buffer[(num_frames+1)*frame_size:]
+            else :
+                self.rx_buffer = self.rx_buffer[num_frames*frame_size:]
+            frames = frames[:num_frames]
+            if num_frames > 0 or ended :
+                self._queue_batch( (frames['t'].astype(np.uint32), frames['adc'].astype(np.uint16), ended) )
+            if ended :
+                self.streaming = None
+        
+        if self.streaming is None :
+            lines = self.rx_buffer.split(b'\n')
+            self.rx_buffer = lines.pop()
+            for line in lines :
+                self.lines.put_nowait( line.strip() )
+    
+    def _queue_batch(self, batch) :
+        if self.batches is None :
+            return
+        while self.batches.full() :
+            dropped = self.batches.get_nowait()
+            self.dropped_samples += len(dropped[0])
+        self.batches.put_nowait( batch )
+    
+    def _on_writable(self) :
+        try :
+            num_written = os.write(self.fd, self.tx_buffer)
+        except BlockingIOError :
+            return
+        self.tx_buffer = self.tx_buffer[num_written:]
+        if len(self.tx_buffer) == 0 :
+            self.loop.remove_writer(self.fd)
+            if self.tx_drained is not None and not self.tx_drained.done() :
+                self.tx_drained.set_result(None)
+    
+    async def send_command(self, cmd) :
+        """
+        Sends a command, appending eol if needed, and waits until it has
+        been handed to the operating system.
+
+        Parameters
+        ----------
+        cmd : str
+            Command to send.
+
+        Returns
+        -------
+        bool
+            True --> Command was sent.
+            False --> Not connected.
+
+        """
+        if self.arduino is None :
+            return False
+        cmd = str(cmd).encode('utf-8')
+        if cmd[-len(self.eol):] != self.eol :
+            cmd += self.eol
+        
+        if len(self.tx_buffer) == 0 :
+            try :
+                cmd = cmd[os.write(self.fd, cmd):]
+            except BlockingIOError :
+                pass
+        if len(cmd) == 0 :
+            return True
+        
+        # the port is full, finish the write when it becomes writable
+        self.tx_buffer += cmd
+        if self.tx_drained is None or self.tx_drained.done() :
+            self.tx_drained = self.loop.create_future()
+            self.loop.add_writer(self.fd, self._on_writable)
+        await asyncio.shield(self.tx_drained)
+        return True
+    
+    async def readline(self, timeout=1.0) :
+        """
+        Returns the next response line without its line ending, None if
+        nothing arrived within timeout seconds.
+        """
+        try :
+            return await asyncio.wait_for(self.lines.get(), timeout)
+        except asyncio.TimeoutError :
+            return None
+    
+    def _discard_lines(self) :
+        while not self.lines.empty() :
+            self.lines.get_nowait()
+    
+    async def get_parameter(self, cmd, dtype=None, timeout=1.0, attempts=3) :
+        """
+        Sends a get command and returns the response.
+
+        Parameters
+        ----------
+        cmd : str
+            Get command, ex. 'g'.
+        dtype : str, optional
+            'f', 'i' or 's', as Arduino.convert_type. The default is None,
+            the response string.
+        timeout : float, optional
+            Seconds to wait for each attempt. The default is 1.0.
+        attempts : int, optional
+            Number of attempts. The default is 3.
+
+        Returns
+        -------
+        Response converted to dtype, None if there was no valid response.
+
+        """
+        if self.arduino is None :
+            return None
+        async with self.command_lock :
+            for _ in range(attempts) :
+                self._discard_lines()
+                await self.send_command( cmd )
+                line = await self.readline(timeout)
+                if line is None :
+                    continue
+                response = line.decode('utf-8', errors='replace')
+                try :
+                    if dtype in ['i', 'int', 'integer'] :
+                        return int(response)
+                    if dtype in ['f', 'float'] :
+                        return float(response)
+                except ValueError :
+                    continue
+                return response
+        return None
+    
+    async def set_parameter(self, cmd, timeout=1.0, attempts=3) :
+        """
+        Sends a set command, ex. 'f;2200', and waits for the firmware's
+        acknowledgement.
+
+        Returns
+        -------
+        bool
+            True if the firmware acknowledged the new value.
+
+        """
+        if self.arduino is None :
+            return False
+        async with self.command_lock :
+            for _ in range(attempts) :
+                self._discard_lines()
+                await self.send_command( cmd )
+                line = await self.readline(timeout)
+                try :
+                    if line is not None and int( float(line) ) == 1 :
+                        return True
+                except ValueError :
+                    pass
+        return False
+    
+    async def get_all_parameters(self, timeout=1.0) :
+        """
+        Reads every parameter with one "C" dump.
+
+        Returns
+        -------
+        dict
+            Vcc, R, C (uF), exp_dur_factor, pulse_duration and
+            pulse_duty_cycle, None if the dump was not answered.
+
+        """
+        response = await self.get_parameter('C', timeout=timeout)
+        if response is None :
+            return None
+        names = ['Vcc', 'R', 'C', 'exp_dur_factor', 'pulse_duration', 'pulse_duty_cycle']
+        try :
+            values = [ float(ele) for ele in response.split(',') ]
+        except ValueError :
+            return None
+        if len(values) != len(names) :
+            return None
+        params = dict( zip(names, values) )
+        for name in ['exp_dur_factor', 'pulse_duration', 'pulse_duty_cycle'] :
+            params[name] = int(params[name])
+        return params
+    
+    async def stream(self, start_cmd, binary=False, timeout=None) :
+        """
+        Starts an experiment and iterates over its sample batches.
+        Iteration ends once the firmware sends "end". Breaking out of the
+        loop early does not stop the firmware, call stop for that.
+
+        Parameters
+        ----------
+        start_cmd : str
+            Command starting the experiment, ex. 'a' or 'q'.
+        binary : bool, optional
+            The firmware is in binary mode ("A;1"), batches hold adc counts.
+            The default is False, text mode, batches hold volts.
+        timeout : float, optional
+            Seconds to wait for each batch before giving up with
+            asyncio.TimeoutError. The default is None, no limit.
+
+        Yields
+        ------
+        t : np.ndarray
+            Sample times from the Arduino's micros().
+        v : np.ndarray
+            Sample voltages, or adc counts in binary mode.
+
+        """
+        if self.arduino is None :
+            return
+        async with self.command_lock :
+            self._discard_lines()
+            self.batches = asyncio.Queue(maxsize=self.max_batches)
+            self.dropped_samples = 0
+            self.streaming = 'binary' if binary else 'text'
+            try :
+                await self.send_command( start_cmd )
+                while True :
+                    t, v, ended = await asyncio.wait_for(self.batches.get(), timeout)
+                    if len(t) > 0 :
+                        yield t, v
+                    if ended :
+                        break
+                if self.closed_error is not None :
+                    raise self.closed_error
+            finally :
+                self.streaming = None
+                self.batches = None
+    
+    async def stop(self) :
+        """
+        Asks the firmware to end a running experiment, the stream then
+        ends with the firmware's "end".
+        """
+        return await self.send_command('stop')
+
+async def run_boards(ports, experiment, settings) :
+    """
+    Runs a charge or discharge experiment on every board from one event
+    loop. Returns {port: (samples, seconds)}.
+    """
+    async def run_one(port) :
+        async with AsyncArduino(port) as board :
+            for cmd in settings :
+                if not await board.set_parameter(cmd) :
+                    raise RuntimeError( f'{port}: {cmd} was not acknowledged' )
+            num_samples = 0
+            t_start = perf_counter()
+            async for t, v in board.stream( 'a' if experiment == 'charge' else 'b' ) :
+                num_samples += len(t)
+            return num_samples, perf_counter() - t_start
+    
+    results = await asyncio.gather( *[run_one(port) for port in ports], return_exceptions=True )
+    return dict( zip(ports, results) )
+
+def main(argv=None) :
+    parser = argparse.ArgumentParser(description='Run an experiment on several Arduinos from one event loop.')
+    parser.add_argument('experiment', choices=['charge', 'discharge'])
+    parser.add_argument('--ports', nargs='*', default=[], help='serial ports of the Arduinos')
+    parser.add_argument('--emulate', type=int, default=0, metavar='N', help='add N emulated Arduinos')
+    parser.add_argument('--R', type=float, default=None, help='resistance [Ohms]')
+    parser.add_argument('--C', type=float, default=None, help='capacitance [uF]')
+    parser.add_argument('--factor', type=int, default=None, help='experiment duration as a multiple of R*C')
+    args = parser.parse_args(argv)
+    
+    settings = []
+    if args.R is not None :
+        settings.append( f'f;{args.R:.3f}' )
+    if args.C is not None :
+        settings.append( f'h;{args.C*1e-6:.3e}' )
+    if args.factor is not None :
+        settings.append( f'l;{args.factor}' )
+    
+    emulators = []
+    ports = list(args.ports)
+    if args.emulate > 0 :
+        from arduino_emulator import ArduinoEmulator
+        circuit = { key: value for (key, value) in [('R', args.R), ('C', args.C)] if value is not None }
+        emulators = [ ArduinoEmulator(**circuit) for _ in range(args.emulate) ]
+        ports += [ emulator.start() for emulator in emulators ]
+    
+    try :
+        results = asyncio.run( run_boards(ports, args.experiment, settings) )
+    finally :
+        for emulator in emulators :
+            emulator.stop()
+    
+    failed = 0
+    for port, result in results.items() :
+        if isinstance(result, Exception) :
+            print( f'{port}: failed, {result}' )
+            failed += 1
+        else :
+            num_samples, elapsed = result
+            print( f'{port}: {num_samples} samples in {elapsed:.2f} s' )
+    return 1 if failed > 0 else 0
+
+if __name__ == '__main__' :
+    sys.exit( main() )
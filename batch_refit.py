@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Refits saved (dis)charge experiment files without the GUI.
+
+Usage:
+    python batch_refit.py captures/ -o summary.csv
+    python batch_refit.py run1.csv run2.csv --workers 4 --lmfit
+"""
+
+import os
+import sys
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from rc_fit import fit_rc_response, refine_with_lmfit
+
+SUMMARY_COLUMNS = [
+    'file', 'mode', 'R_ohms', 'C_uF', 'nominal_tc_s', 'fitted_tc_s',
+    'tc_err_s', 'Vcc_V', 'offset_s', 'rms_residual_V', 'max_residual_V',
+    'num_samples', 'status',
+    ]
+
+def parse_header(fil) :
+    """
+    Reads the "# key: value unit" header lines written by save_data.
+
+    Parameters
+    ----------
+    fil : str
+        Path of the saved csv file.
+
+    Returns
+    -------
+    header : dict
+        Header values keyed by name, ex. {'Resistor': 2200.0, 'Capacitor': 220.0}.
+        Values are floats where possible, otherwise strings.
+
+    """
+    header = {}
+    with open(fil, 'r') as f :
+        for line in f :
+            if not line.startswith('#') :
+                break
+            line = line.lstrip('#').strip()
+            if ':' not in line :
+                continue
+            (key, value) = line.split(':', 1)
+            value = value.strip()
+            try :
+                header[key.strip()] = float( value.split()[0] )
+            except (ValueError, IndexError) :
+                header[key.strip()] = value
+    return header
+
+def refit_file(fil, refine=False) :
+    """
+    Loads one saved experiment and fits it with the same models as the GUI.
+
+    Parameters
+    ----------
+    fil : str
+        Path of the saved csv file.
+    refine : bool, optional
+        Refine the fit with lmfit. The default is False.
+
+    Returns
+    -------
+    dict
+        One row of the summary table, keys are SUMMARY_COLUMNS.
+
+    """
+    row = { key: np.nan for key in SUMMARY_COLUMNS }
+    row['file'] = fil
+    row['mode'] = ''
+    
+    try :
+        header = parse_header(fil)
+        if 'Pulse Duration' in header :
+            row['status'] = 'skipped: pulse experiment'
+            return row
+        
+        data = np.loadtxt(fil, delimiter=',', comments='#', ndmin=2)
+        (t, v) = (data[:,0], data[:,1])
+    except Exception as e :
+        row['status'] = f'error: {e}'
+        return row
+    
+    R = header.get('Resistor', np.nan)
+    C = header.get('Capacitor', np.nan)
+    nominal_tc = R * C * 1e-6
+    
+    # older files do not record the experiment type, a charge curve rises
+    mode = str( header.get('Experiment', '') ).lower()
+    if mode not in ['charge', 'discharge'] :
+        mode = 'charge' if v[-1] > v[0] else 'discharge'
+    
+    tc_guess = nominal_tc if np.isfinite(nominal_tc) and nominal_tc > 0 else None
+    fit_result = fit_rc_response(t, v, mode, tc_guess=tc_guess)
+    if refine and fit_result.success :
+        Vcc_nominal = header.get('Vcc', None)
+        fit_result = refine_with_lmfit(t, v, mode, fit_result,
+                                       Vcc_nominal=Vcc_nominal,
+                                       tc_nominal=tc_guess)
+    
+    row.update({
+        'mode': mode,
+        'R_ohms': R,
+        'C_uF': C,
+        'nominal_tc_s': nominal_tc,
+        'fitted_tc_s': fit_result.tc,
+        'tc_err_s': fit_result.tc_err,
+        'Vcc_V': fit_result.Vcc,
+        'offset_s': fit_result.offset,
+        'rms_residual_V': fit_result.rms_residual,
+        'max_residual_V': np.nan if fit_result.residual is None else np.max(np.abs(fit_result.residual)),
+        'num_samples': len(t),
+        'status': 'ok' if fit_result.success else 'fit failed',
+        })
+    return row
+
+def _refit_file_star(args) :
+    return refit_file(*args)
+
+def find_files(paths, recursive=False) :
+    """
+    Expands directories into the csv files they contain.
+
+    Parameters
+    ----------
+    paths : list
+        Files and/or directories.
+    recursive : bool, optional
+        Search sub-directories. The default is False.
+
+    Returns
+    -------
+    files : list
+        Sorted list of csv files.
+
+    """
+    files = []
+    for path in paths :
+        if not os.path.isdir(path) :
+            files.append( path )
+        elif recursive :
+            for (root, dirs, fils) in os.walk(path) :
+                files.extend([ os.path.join(root, fil) for fil in fils
+                               if fil.lower().endswith('.csv') ])
+        else :
+            files.extend([ os.path.join(path, fil) for fil in os.listdir(path)
+                           if fil.lower().endswith('.csv') ])
+    return sorted(files)
+
+def refit_files(files, refine=False, workers=None) :
+    """
+    Refits many files in parallel, one process per core.
+
+    Parameters
+    ----------
+    files : list
+        Saved csv files.
+    refine : bool, optional
+        Refine each fit with lmfit. The default is False.
+    workers : int, optional
+        Number of processes. The default is None, one per core.
+
+    Returns
+    -------
+    rows : list
+        Summary rows in the same order as files.
+
+    """
+    if workers == 1 :
+        return [ refit_file(fil, refine) for fil in files ]
+    
+    if workers is None :
+        workers = os.cpu_count() or 1
+    chunksize = max( 1, len(files) // (4*workers) )
+    with ProcessPoolExecutor(max_workers=workers) as executor :
+        return list( executor.map(_refit_file_star,
+                                  [ (fil, refine) for fil in files ],
+                                  chunksize=chunksize) )
+
+def write_summary(rows, fil) :
+    """
+    Writes the summary table as a csv file.
+
+    Parameters
+    ----------
+    rows : list
+        Rows returned by refit_files.
+    fil : str
+        Output path, '-' writes to stdout.
+
+    Returns
+    -------
+    None.
+
+    """
+    lines = [ ','.join(SUMMARY_COLUMNS) ]
+    for row in rows :
+        values = []
+        for key in SUMMARY_COLUMNS :
+            value = row[key]
+            if isinstance(value, float) :
+                values.append( f'{value:.7e}' )
+            else :
+                # keep commas in paths and messages from splitting the column
+                values.append( str(value).replace(',', ';') )
+        lines.append( ','.join(values) )
+    
+    text = '\n'.join(lines) + '\n'
+    if fil == '-' :
+        sys.stdout.write(text)
+    else :
+        with open(fil, 'w') as f :
+            f.write(text)
+
+def main(argv=None) :
+    parser = argparse.ArgumentParser(description='Refit saved (dis)charge experiment csv files.')
+    parser.add_argument('paths', nargs='+', help='csv files and/or directories containing them')
+    parser.add_argument('-o', '--output', default='refit_summary.csv', help="summary csv file, '-' for stdout")
+    parser.add_argument('-r', '--recursive', action='store_true', help='search directories recursively')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='number of processes, default one per core')
+    parser.add_argument('--lmfit', action='store_true', help='refine each fit with lmfit')
+    args = parser.parse_args(argv)
+    
+    files = find_files(args.paths, args.recursive)
+    if len(files) == 0 :
+        print( 'No csv files found' )
+        return 1
+    
+    rows = refit_files(files, refine=args.lmfit, workers=args.workers)
+    write_summary(rows, args.output)
+    
+    num_ok = sum([ row['status'] == 'ok' for row in rows ])
+    if args.output != '-' :
+        print( f'{num_ok} of {len(rows)} files fit, summary written to {args.output}' )
+    return 0
+
+if __name__ == '__main__' :
+    sys.exit( main() )
@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Acquisition throughput and latency benchmarks.
+The dis_charge_exp and pulse_exp threads of the GUI are run against the
+emulated Arduino, arduino_emulator.py, so no hardware is needed.
+
+Two scenarios are run for each experiment:
+    realtime : the emulator runs at 1 kHz and 250000 baud, as the firmware.
+               Per-sample latency is measured from the time a sample is taken
+               to the time the experiment thread receives it.
+    stress   : the emulator sends samples as fast as the host reads them,
+               this measures the maximum sustained samples/s.
+
+Usage:
+    python bench_acquisition.py -o bench.json
+    python bench_acquisition.py --quick --compare bench_old.json
+"""
+
+import os
+import sys
+import json
+import timeit
+import argparse
+import platform
+import importlib.util
+from time import perf_counter
+from time import sleep as time_sleep
+from time import time as current_time
+from itertools import zip_longest as itertools_zip_longest
+
+import numpy as np
+
+from Arduino import Arduino, parse_sample_lines
+from arduino_emulator import ArduinoEmulator
+
+GUI_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Capacitor Experiment.py')
+
+SCENARIOS = {
+    'realtime': {'speed': 1.0, 'baud': 250000},
+    'stress': {'speed': 0, 'baud': 0},
+    }
+
+def load_gui() :
+    """
+    Imports the GUI module, its file name is not a valid module name.
+    """
+    spec = importlib.util.spec_from_file_location('capacitor_experiment', GUI_FILE)
+    gui = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(gui)
+    return gui
+
+def percentiles(values, scale=1.) :
+    """
+    Summary statistics of a list of timings.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        Measured values.
+    scale : float, optional
+        Factor applied to the values, ex. 1e3 for s --> ms. The default is 1.
+
+    Returns
+    -------
+    dict
+        count, mean, p50, p90, p99 and max. None if there are no values.
+
+    """
+    values = np.asarray(values, dtype=float) * scale
+    if len(values) == 0 :
+        return None
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return {
+        'count': int(len(values)),
+        'mean': float(np.mean(values)),
+        'p50': float(p50),
+        'p90': float(p90),
+        'p99': float(p99),
+        'max': float(np.max(values)),
+        }
+
+def count_gaps(t, dt_us) :
+    """
+    Number of samples missing from a stream of micros() timestamps.
+    """
+    if len(t) < 2 :
+        return 0
+    diffs = np.diff( np.asarray(t, dtype=np.int64) ) % 2**32
+    return int( np.sum(np.maximum(np.rint(diffs / dt_us) - 1, 0)) )
+
+class AcquisitionProbe() :
+    """
+    Wraps Arduino.read_batches and MplCanvas.update_live of one experiment
+    to record when each sample arrives and how long each frame takes.
+    """
+    def __init__(self, serial, emulator, canvas=None) :
+        self.emulator = emulator
+        self.batches = []
+        self.frame_times = []
+        
+        read_batches = serial.read_batches
+        def timed_read_batches(*args, **kwargs) :
+            (t, v, ended) = read_batches(*args, **kwargs)
+            if len(t) > 0 :
+                self.batches.append( (perf_counter(), np.array(t, dtype=np.int64)) )
+            return t, v, ended
+        serial.read_batches = timed_read_batches
+        
+        if canvas is not None :
+            update_live = canvas.update_live
+            def timed_update_live(*args, **kwargs) :
+                t0 = perf_counter()
+                update_live(*args, **kwargs)
+                self.frame_times.append( perf_counter() - t0 )
+            canvas.update_live = timed_update_live
+    
+    def timestamps(self) :
+        if len(self.batches) == 0 :
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([ t for (_, t) in self.batches ])
+    
+    def latencies(self) :
+        """
+        Receive time minus sample time, only meaningful while the emulator's
+        clock runs at real time.
+        """
+        if not self.emulator.speed :
+            return np.empty(0)
+        lat = []
+        for (t_recv, t) in self.batches :
+            # micros() wraps every ~71 minutes, unwrap against the first sample
+            t = np.unwrap(t, period=2**32) if len(t) > 1 else t
+            t_sample = self.emulator.wall_t0 + t / (1e6 * self.emulator.speed)
+            lat.append( t_recv - t_sample )
+        return np.concatenate(lat)
+
+def make_uController(gui, port, R, C, exp_dur_factor, display_dur) :
+    uController = gui.arduino()
+    uController.serial = Arduino(port, uController.baud, timeout=1, eol='/')
+    uController.port = port
+    if uController.serial.connect() != 'Success' :
+        raise RuntimeError(f'Could not connect to the emulator on {port}')
+    uController.connected = True
+    
+    uController.serial.set_parameter( f'f;{R:.3f}' )
+    uController.serial.set_parameter( f'h;{C*1e-6:.3e}' )
+    uController.serial.set_parameter( f'l;{exp_dur_factor}' )
+    uController.Vcc = 5.0
+    uController.R = R
+    uController.C = C
+    uController.exp_dur_factor = exp_dur_factor
+    uController.pulse_duration = 100
+    uController.pulse_duty_cycle = 50
+    uController.display_dur = display_dur
+    uController.dis_charge_choice = 1
+    uController.stream_pulse = True
+    return uController
+
+def bench_experiment(gui, app, experiment, scenario, duration, plot=True) :
+    """
+    Runs one experiment thread against the emulator.
+
+    Parameters
+    ----------
+    gui : module
+        The GUI module, from load_gui.
+    app : QApplication
+        Application used to process the plot signals.
+    experiment : str
+        'dis_charge' or 'pulse'.
+    scenario : str
+        Key of SCENARIOS.
+    duration : float
+        Wall clock duration of the experiment in seconds, approximate for
+        the stress scenario of dis_charge.
+    plot : bool, optional
+        Draw the live plot. The default is True.
+
+    Returns
+    -------
+    dict
+        Benchmark results.
+
+    """
+    emulator = ArduinoEmulator(R=2200, C=220, noise=0.005, seed=0, **SCENARIOS[scenario])
+    port = emulator.start()
+    try :
+        R, C = 2200, 220
+        tc = R * C * 1e-6
+        if experiment == 'dis_charge' and not emulator.speed :
+            # the stress run streams about 1e5-1e6 samples/s, size the run
+            # so it still takes roughly "duration" seconds
+            exp_dur_factor = max( int(round(2e5 * duration * 1e-3 / tc)), 1 )
+        else :
+            exp_dur_factor = max( int(round(duration / tc)), 1 )
+        uController = make_uController(gui, port, R, C, exp_dur_factor, display_dur=5)
+        
+        canvas = None
+        if plot :
+            from plot_canvas import MplCanvas
+            canvas = MplCanvas(None, width=8, height=6, dpi=100)
+            canvas.resize(800, 600)
+            canvas.show()
+        probe = AcquisitionProbe(uController.serial, emulator, canvas)
+        
+        if experiment == 'dis_charge' :
+            exp = gui.dis_charge_exp(uController=uController, canvas=canvas)
+        else :
+            exp = gui.pulse_exp(uController=uController, canvas=canvas)
+        
+        t_start = perf_counter()
+        exp.start()
+        stop_sent = False
+        while exp.isRunning() :
+            app.processEvents()
+            if experiment == 'pulse' and not stop_sent and perf_counter() - t_start >= duration :
+                uController.serial.send_command('stop')
+                stop_sent = True
+            time_sleep(1e-3)
+        exp.wait()
+        app.processEvents()
+        elapsed = perf_counter() - t_start
+        
+        t = probe.timestamps()
+        num_samples = len(t)
+        result = {
+            'experiment': experiment,
+            'scenario': scenario,
+            'plot': plot,
+            'elapsed_s': elapsed,
+            'samples': num_samples,
+            'samples_per_s': num_samples / elapsed if elapsed > 0 else None,
+            'dropped_samples': int(uController.serial.dropped_samples),
+            'missing_samples': count_gaps(t, emulator.dt_us),
+            'latency_ms': percentiles(probe.latencies(), 1e3),
+            'frame_ms': percentiles(probe.frame_times, 1e3),
+            'bytes_received': int(emulator.bytes_sent),
+            }
+        
+        uController.serial.disconnect()
+        if canvas is not None :
+            canvas.close()
+        return result
+    finally :
+        emulator.stop()
+
+def _timeit(stmt, number) :
+    timer = timeit.Timer(stmt)
+    best = min( timer.repeat(repeat=5, number=number) )
+    return {'number': number, 'us_per_call': 1e6 * best / number}
+
+def bench_micro(quick=False) :
+    """
+    Microbenchmarks of the host side serial helpers.
+
+    Returns
+    -------
+    dict
+        Best of 5 time per call in microseconds.
+
+    """
+    number = 200 if quick else 2000
+    results = {}
+    
+    emulator = ArduinoEmulator(speed=0, baud=0)
+    port = emulator.start()
+    try :
+        serial = Arduino(port, 250000, timeout=1, eol='/')
+        serial.connect()
+        # 'z' has no response, only the write is timed
+        results['send_command'] = _timeit(lambda : serial.send_command('z'), number)
+        
+        # one round trip per parameter against one pipelined write
+        cmds = [ 'j;5.00', 'f;2200.000', 'h;2.200e-04', 'l;5' ]
+        results['set_4_parameters_sequential'] = _timeit(
+            lambda : [ serial.set_parameter(cmd) for cmd in cmds ], number // 10 )
+        results['set_4_parameters_transact'] = _timeit(lambda : serial.transact(cmds), number // 10)
+        serial.disconnect()
+    finally :
+        emulator.stop()
+    
+    results['convert_type_float'] = _timeit(lambda : serial.convert_type('2.4853', 'f'), 10*number)
+    results['convert_type_int'] = _timeit(lambda : serial.convert_type('1234567', 'i'), 10*number)
+    
+    rows = [ [ 1000*i, 2.4853 ] for i in range(1000) ]
+    results['transpose_1000_rows'] = _timeit(
+        lambda : list(map(list, itertools_zip_longest(*rows, fillvalue=None))), number // 10 )
+    
+    block = b''.join([ f'{1000*i},{5*i/1000:.2f}\r\n'.encode('utf-8') for i in range(1000) ])
+    results['parse_sample_lines_1000'] = _timeit(lambda : parse_sample_lines(block), number // 10)
+    
+    return results
+
+def git_version() :
+    try :
+        import subprocess
+        out = subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True,
+                             text=True, cwd=os.path.dirname(GUI_FILE), timeout=10)
+        return out.stdout.strip() or None
+    except Exception :
+        return None
+
+def run_suite(quick=False, plot=True) :
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PyQt5.QtWidgets import QApplication
+    app = QApplication.instance() or QApplication([])
+    gui = load_gui()
+    
+    duration = 1.0 if quick else 3.0
+    runs = []
+    for experiment in ['dis_charge', 'pulse'] :
+        for scenario in SCENARIOS :
+            runs.append( bench_experiment(gui, app, experiment, scenario, duration, plot) )
+    
+    return {
+        'version': git_version(),
+        'created': current_time(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'numpy': np.__version__,
+        'quick': quick,
+        'experiments': runs,
+        'micro': bench_micro(quick),
+        }
+
+def compare(new, old) :
+    """
+    Prints the change of the main figures relative to an earlier run.
+    """
+    def key(run) :
+        return (run['experiment'], run['scenario'], run['plot'])
+    old_runs = { key(run): run for run in old.get('experiments', []) }
+    
+    print( f"Compared with {old.get('version')}:" )
+    for run in new['experiments'] :
+        ref = old_runs.get( key(run) )
+        if ref is None :
+            continue
+        items = [('samples/s', run['samples_per_s'], ref['samples_per_s'])]
+        for name in ['latency_ms', 'frame_ms'] :
+            if run[name] is not None and ref[name] is not None :
+                items.append( (f'{name} p99', run[name]['p99'], ref[name]['p99']) )
+        text = ', '.join([ f'{name} {value:.4g} ({value/ref_value:.2f}x)'
+                           for (name, value, ref_value) in items if value and ref_value ])
+        print( f"    {run['experiment']:>10} {run['scenario']:>8}: {text}" )
+    for (name, res) in new['micro'].items() :
+        ref = old.get('micro', {}).get(name)
+        if ref is not None :
+            print( f"    {name}: {res['us_per_call']:.3g} us ({res['us_per_call']/ref['us_per_call']:.2f}x)" )
+
+def main(argv=None) :
+    parser = argparse.ArgumentParser(description='Benchmark acquisition throughput and latency against the emulated Arduino.')
+    parser.add_argument('-o', '--output', default='bench_acquisition.json', help="results json file, '-' for stdout")
+    parser.add_argument('--quick', action='store_true', help='shorter runs')
+    parser.add_argument('--no-plot', action='store_true', help='do not draw the live plot')
+    parser.add_argument('--compare', default=None, help='earlier results json to compare against')
+    args = parser.parse_args(argv)
+    
+    results = run_suite(quick=args.quick, plot=not args.no_plot)
+    
+    text = json.dumps(results, indent=2)
+    if args.output == '-' :
+        print( text )
+    else :
+        with open(args.output, 'w') as f :
+            f.write(text + '\n')
+        for run in results['experiments'] :
+            latency = run['latency_ms']
+            latency = '' if latency is None else f", latency p50/p99 {latency['p50']:.1f}/{latency['p99']:.1f} ms"
+            print( f"{run['experiment']:>10} {run['scenario']:>8}: {run['samples_per_s']:.0f} samples/s, "
+                   f"{run['dropped_samples']} dropped, {run['missing_samples']} missing{latency}" )
+        print( f'Results written to {args.output}' )
+    
+    if args.compare is not None :
+        with open(args.compare, 'r') as f :
+            compare(results, json.load(f))
+    return 0
+
+if __name__ == '__main__' :
+    sys.exit( main() )
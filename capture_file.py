@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Append-only binary capture files.
+
+File layout:
+    8 bytes     magic, b'CAPEXP01'
+    4 bytes     uint32 little-endian, length of the metadata block
+    n bytes     utf-8 JSON metadata, space padded so the samples start on a
+                16 byte boundary
+    remainder   samples, CAPTURE_DTYPE records
+"""
+
+import os
+import json
+import shutil
+import tempfile
+import threading
+from queue import Queue
+from time import time as current_time
+
+import numpy as np
+
+CAPTURE_MAGIC = b'CAPEXP01'
+# time since the start of the experiment [s], voltage across the capacitor [V]
+CAPTURE_DTYPE = np.dtype([('t', '<f8'), ('v', '<f4')])
+
+def new_capture_path(folder=None) :
+    """
+    Creates an empty temporary file for a capture.
+
+    Parameters
+    ----------
+    folder : str, optional
+        Folder for the file. The default is None, the system temp folder.
+
+    Returns
+    -------
+    str
+        Path of the new file.
+
+    """
+    (fd, path) = tempfile.mkstemp(prefix='capexp_', suffix='.cap', dir=folder)
+    os.close(fd)
+    return path
+
+class CaptureWriter() :
+    """
+    Writes samples to a capture file as they are acquired.
+    Nothing is held in memory, each batch is written straight to the file.
+    """
+    def __init__(self, fil, metadata=None) :
+        """
+        Constructs the CaptureWriter class and writes the file header.
+
+        Parameters
+        ----------
+        fil : str
+            Path of the capture file, it is overwritten.
+        metadata : dict, optional
+            JSON serializable experiment information, ex. R, C, Vcc, pulse
+            parameters and firmware mode. The default is None.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.fil = fil
+        self.metadata = dict(metadata) if metadata is not None else {}
+        self.metadata.setdefault('created', current_time())
+        self.metadata['sample_format'] = CAPTURE_DTYPE.descr
+        self.num_samples = 0
+        
+        meta = json.dumps(self.metadata).encode('utf-8')
+        header_len = len(CAPTURE_MAGIC) + 4 + len(meta)
+        meta += b' ' * (-header_len % 16)
+        
+        self.f = open(self.fil, 'wb')
+        self.f.write( CAPTURE_MAGIC )
+        self.f.write( np.uint32(len(meta)).astype('<u4').tobytes() )
+        self.f.write( meta )
+    
+    def __enter__(self) :
+        return self
+    
+    def __exit__(self, *args) :
+        self.close()
+    
+    def append(self, t, v) :
+        """
+        Appends a batch of samples to the file.
+
+        Parameters
+        ----------
+        t : np.ndarray
+            Sample times in seconds.
+        v : np.ndarray
+            Sample voltages.
+
+        Returns
+        -------
+        None.
+
+        """
+        if self.f is None or len(t) == 0 :
+            return
+        records = np.empty( len(t), dtype=CAPTURE_DTYPE )
+        records['t'] = t
+        records['v'] = v
+        self._write_records( records )
+        self.num_samples += len(t)
+    
+    def _write_records(self, records) :
+        self.f.write( records.tobytes() )
+    
+    def flush(self) :
+        if self.f is not None :
+            self.f.flush()
+    
+    def close(self) :
+        if self.f is not None :
+            self.f.close()
+            self.f = None
+
+class BackgroundCaptureWriter(CaptureWriter) :
+    """
+    CaptureWriter for open-ended experiments.
+    Samples are collected into fixed size chunks and completed chunks are 
+    written by a background thread, the acquisition thread does not wait on 
+    the disk. Memory use is bounded by chunk_size * (max_chunks + 1) samples, 
+    if the disk falls that far behind append blocks until a chunk is written.
+    """
+    def __init__(self, fil, metadata=None, chunk_size=16384, max_chunks=16) :
+        """
+        Constructs the BackgroundCaptureWriter class, writes the file header
+        and starts the writer thread.
+
+        Parameters
+        ----------
+        fil : str
+            Path of the capture file, it is overwritten.
+        metadata : dict, optional
+            JSON serializable experiment information. The default is None.
+        chunk_size : int, optional
+            Number of samples written at a time. The default is 16384.
+        max_chunks : int, optional
+            Number of completed chunks which may wait to be written.
+            The default is 16.
+
+        Returns
+        -------
+        None.
+
+        """
+        super().__init__(fil, metadata)
+        self.chunk_size = max( int(chunk_size), 1 )
+        self.chunk = np.empty( self.chunk_size, dtype=CAPTURE_DTYPE )
+        self.chunk_len = 0
+        
+        self.write_q = Queue( maxsize=max(int(max_chunks), 1) )
+        self.write_error = None
+        self.writer_thread = threading.Thread(target=self._writer_loop, daemon=True)
+        self.writer_thread.start()
+    
+    def _writer_loop(self) :
+        while True :
+            records = self.write_q.get()
+            try :
+                if records is None :
+                    return
+                if self.write_error is None :
+                    self.f.write( records.tobytes() )
+            except OSError as e :
+                # reported by flush/close, the acquisition keeps running
+                self.write_error = e
+            finally :
+                self.write_q.task_done()
+    
+    def _write_records(self, records) :
+        start = 0
+        while start < len(records) :
+            num_copy = min( self.chunk_size - self.chunk_len, len(records) - start )
+            self.chunk[self.chunk_len:self.chunk_len+num_copy] = records[start:start+num_copy]
+            self.chunk_len += num_copy
+            start += num_copy
+            if self.chunk_len == self.chunk_size :
+                self.write_q.put( self.chunk )
+                self.chunk = np.empty( self.chunk_size, dtype=CAPTURE_DTYPE )
+                self.chunk_len = 0
+    
+    def _queue_partial_chunk(self) :
+        if self.chunk_len > 0 :
+            self.write_q.put( self.chunk[:self.chunk_len].copy() )
+            self.chunk_len = 0
+    
+    def flush(self) :
+        """
+        Writes all samples appended so far, waiting for the writer thread.
+        """
+        if self.f is None :
+            return
+        self._queue_partial_chunk()
+        self.write_q.join()
+        self.f.flush()
+        if self.write_error is not None :
+            raise self.write_error
+    
+    def close(self) :
+        if self.f is None :
+            return
+        self._queue_partial_chunk()
+        self.write_q.put( None )
+        self.writer_thread.join()
+        super().close()
+        if self.write_error is not None :
+            raise self.write_error
+
+def read_metadata(fil) :
+    """
+    Reads the metadata of a capture file.
+
+    Parameters
+    ----------
+    fil : str
+        Path of the capture file.
+
+    Returns
+    -------
+    metadata : dict
+        Experiment information stored with the capture.
+    offset : int
+        Byte offset of the first sample.
+
+    """
+    with open(fil, 'rb') as f :
+        magic = f.read( len(CAPTURE_MAGIC) )
+        if magic != CAPTURE_MAGIC :
+            raise ValueError(f'{fil} is not a capture file')
+        meta_len = int( np.frombuffer(f.read(4), dtype='<u4')[0] )
+        metadata = json.loads( f.read(meta_len).decode('utf-8') )
+    return metadata, len(CAPTURE_MAGIC) + 4 + meta_len
+
+def open_capture(fil) :
+    """
+    Opens a capture file without loading the samples into memory.
+
+    Parameters
+    ----------
+    fil : str
+        Path of the capture file.
+
+    Returns
+    -------
+    metadata : dict
+        Experiment information stored with the capture.
+    samples : np.memmap
+        Read-only CAPTURE_DTYPE records, samples['t'] and samples['v'].
+
+    """
+    (metadata, offset) = read_metadata(fil)
+    num_samples = (os.path.getsize(fil) - offset) // CAPTURE_DTYPE.itemsize
+    if num_samples == 0 :
+        return metadata, np.empty(0, dtype=CAPTURE_DTYPE)
+    samples = np.memmap(fil, dtype=CAPTURE_DTYPE, mode='r', offset=offset,
+                        shape=(num_samples,))
+    return metadata, samples
+
+def finalize_capture(fil, dest) :
+    """
+    Moves a finished capture to its final location.
+    On the same file system this is a rename, no data is copied.
+
+    Parameters
+    ----------
+    fil : str
+        Path of the capture file.
+    dest : str
+        Destination path.
+
+    Returns
+    -------
+    str
+        Destination path.
+
+    """
+    try :
+        os.replace(fil, dest)
+    except OSError :
+        shutil.move(fil, dest)
+    return dest
+
+def copy_capture(fil, dest) :
+    """
+    Copies a saved capture, ex. when it is saved a second time.
+
+    Parameters
+    ----------
+    fil : str
+        Path of the capture file.
+    dest : str
+        Destination path.
+
+    Returns
+    -------
+    str
+        Destination path.
+
+    """
+    if not (os.path.exists(dest) and os.path.samefile(fil, dest)) :
+        shutil.copyfile(fil, dest)
+    return dest
+
+def capture_to_csv(fil, dest, header='', chunk_size=100000) :
+    """
+    Exports a capture to the csv format written by the GUI's save_data.
+    The samples are converted in chunks, memory use does not depend on the
+    length of the capture.
+
+    Parameters
+    ----------
+    fil : str
+        Path of the capture file.
+    dest : str
+        Path of the csv file.
+    header : str, optional
+        Header lines, written as "# " comments. The default is ''.
+    chunk_size : int, optional
+        Number of samples converted at a time. The default is 100000.
+
+    Returns
+    -------
+    None.
+
+    """
+    (metadata, samples) = open_capture(fil)
+    with open(dest, 'w') as f :
+        if header != '' :
+            f.write( ''.join([ f'# {line}\n' for line in header.split('\n') ]) )
+        for start in range(0, len(samples), chunk_size) :
+            chunk = samples[start:start+chunk_size]
+            np.savetxt(f, np.column_stack((chunk['t'], chunk['v'])), fmt='%.7e',
+                       delimiter=',', newline='\n')
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Min/max decimation of samples for the live plots.
+"""
+
+import numpy as np
+
+from sample_buffer import SampleRingBuffer
+
+def minmax_decimate(x, y, bucket_width, x_start=0) :
+    """
+    Reduces samples to the min and max of each bucket of width "bucket_width".
+    Up to two points per bucket are returned, in time order, so the plotted
+    envelope matches the full data at the given resolution.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        Sample times, must be increasing.
+    y : np.ndarray
+        Sample values.
+    bucket_width : float
+        Width of a bucket in units of x, ex. the x range of one pixel.
+    x_start : float, optional
+        x value where the first bucket starts. The default is 0.
+
+    Returns
+    -------
+    x_dec : np.ndarray
+        Decimated times.
+    y_dec : np.ndarray
+        Decimated values.
+
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if len(x) == 0 :
+        return np.empty(0), np.empty(0)
+    
+    bucket_ids = np.floor( (x-x_start) / bucket_width ).astype(np.int64)
+    starts = np.flatnonzero( np.r_[True, bucket_ids[1:] != bucket_ids[:-1]] )
+    ends = np.r_[starts[1:], len(x)]
+    
+    # index of the min/max of each bucket, found with one sort over all buckets
+    num_buckets = len(starts)
+    bucket_of_sample = np.repeat( np.arange(num_buckets), ends-starts )
+    order = np.lexsort( (y, bucket_of_sample) )
+    idx_min = order[starts]
+    idx_max = order[ends-1]
+    
+    idx = np.empty( 2*num_buckets, dtype=np.int64 )
+    first_is_min = idx_min <= idx_max
+    idx[0::2] = np.where(first_is_min, idx_min, idx_max)
+    idx[1::2] = np.where(first_is_min, idx_max, idx_min)
+    
+    # buckets with a single sample only need one point
+    keep = np.ones( 2*num_buckets, dtype=bool )
+    keep[1::2] = idx_min != idx_max
+    idx = idx[keep]
+    
+    return x[idx], y[idx]
+
+class MinMaxDecimator() :
+    """
+    Incremental min/max decimation for live plots.
+    Buckets are aligned to fixed multiples of the bucket width, so buckets
+    which have been completed never change. Each batch of new samples only
+    costs work proportional to its own length, independent of the sample
+    rate or the total length of the experiment.
+    """
+    def __init__(self, bucket_width, max_buckets=None) :
+        """
+        Constructs the MinMaxDecimator class.
+
+        Parameters
+        ----------
+        bucket_width : float
+            Width of a bucket in units of x, about the x range of one pixel.
+        max_buckets : int, optional
+            Keep only the most recent buckets, ex. for a scrolling window.
+            The default is None, keep all buckets.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.bucket_width = bucket_width
+        
+        if max_buckets is None :
+            self.points = SampleRingBuffer( 2048 )
+        else :
+            self.points = SampleRingBuffer( 2*max_buckets, wrap=True )
+        
+        # samples of the bucket which is still being filled
+        self.open_x = np.empty(0)
+        self.open_y = np.empty(0)
+    
+    def add(self, x, y) :
+        """
+        Adds a batch of new samples.
+
+        Parameters
+        ----------
+        x : np.ndarray
+            Sample times, increasing and after any previously added sample.
+        y : np.ndarray
+            Sample values.
+
+        Returns
+        -------
+        None.
+
+        """
+        if len(x) == 0 :
+            return
+        x = np.concatenate( (self.open_x, x) )
+        y = np.concatenate( (self.open_y, y) )
+        
+        # the bucket of the last sample may still receive samples
+        last_bucket_start = np.floor( x[-1] / self.bucket_width ) * self.bucket_width
+        num_complete = np.searchsorted( x, last_bucket_start, side='left' )
+        
+        x_dec, y_dec = minmax_decimate( x[:num_complete], y[:num_complete],
+                                        self.bucket_width )
+        self.points.append( x_dec, y_dec )
+        
+        self.open_x = x[num_complete:]
+        self.open_y = y[num_complete:]
+    
+    def get_points(self, x_min=None) :
+        """
+        Decimated points, including the bucket still being filled.
+
+        Parameters
+        ----------
+        x_min : float, optional
+            Only return points at or after x_min. The default is None.
+
+        Returns
+        -------
+        x : np.ndarray
+            Decimated times.
+        y : np.ndarray
+            Decimated values.
+
+        """
+        xy = self.points.view()
+        x_open, y_open = minmax_decimate( self.open_x, self.open_y, self.bucket_width )
+        x = np.concatenate( (xy[:,0], x_open) )
+        y = np.concatenate( (xy[:,1], y_open) )
+        
+        if x_min is not None :
+            start = np.searchsorted( x, x_min, side='left' )
+            x = x[start:]
+            y = y[start:]
+        
+        return x, y
@@ -0,0 +1,601 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Runs experiments without the GUI, no Qt imports.
+The GUI's experiment threads use the same ExperimentRunner.
+
+Usage:
+    python experiment_runner.py --port /dev/ttyACM0 --R 2200 --C 220 charge -o charge.csv
+    python experiment_runner.py --port /dev/ttyACM0 pulse --duration 60 --capture pulse.cap
+    python experiment_runner.py --emulate --R 2200 --C 22 discharge
+    python experiment_runner.py --emulate --instrument . charge
+"""
+
+import os
+import sys
+import signal
+import argparse
+from time import time as current_time
+
+import numpy as np
+
+from arduino_controller import arduino
+from sample_buffer import SampleRingBuffer, samples_for_duration
+from capture_file import CaptureWriter, BackgroundCaptureWriter, capture_to_csv
+from rc_fit import fit_rc_response, refine_with_lmfit
+from sample_clock import SampleClock
+from instrumentation import Instrumentation, stage as instrument_stage
+
+EXPERIMENT_NAMES = {'a': 'Charge', 'b': 'Discharge', 'q': 'Pulse'} # start command: experiment
+
+class ExperimentResult() :
+    """
+    Samples and fit results of one experiment.
+    """
+    def __init__(self, experiment, t, v, fit_result=None, metadata=None,
+                 capture_path=None, dropped_samples=0, missing_samples=0, gaps=None,
+                 clock_rate=np.nan, clock_drift_ppm=np.nan,
+                 instrumentation=None, instrumentation_path=None) :
+        self.experiment = experiment # 'Charge', 'Discharge' or 'Pulse'
+        self.t = t # seconds since the first sample
+        self.v = v # voltage across the capacitor
+        self.fit_result = fit_result # RCFitResult, None for pulse experiments
+        self.metadata = {} if metadata is None else metadata
+        self.capture_path = capture_path # every sample, when a capture was written
+        self.dropped_samples = dropped_samples # discarded by the host, the reader queue was full
+        self.missing_samples = missing_samples # never received, found from gaps in micros()
+        self.gaps = [] if gaps is None else gaps # (start [s], duration [s], missing samples)
+        self.clock_rate = clock_rate # device seconds per host second, nan for runs under 1 s
+        self.clock_drift_ppm = clock_drift_ppm # device clock error relative to the host
+        self.instrumentation = instrumentation # Instrumentation.snapshot() of the run, if instrumented
+        self.instrumentation_path = instrumentation_path # json dump of the snapshot
+    
+    @property
+    def xy(self) :
+        return np.column_stack((self.t, self.v))
+    
+    def header(self) :
+        """
+        Header lines in the format written by the GUI's save_data.
+        """
+        md = self.metadata
+        lines = [
+            f"Resistor: {md.get('R')} Ohms",
+            f"Capacitor: {md.get('C_uF')} uF",
+            ]
+        if self.experiment == 'Pulse' :
+            lines += [
+                f"Pulse Duration: {md.get('pulse_duration_ms')} ms",
+                f"Pulse Duty Cycle: {md.get('pulse_duty_cycle')} %",
+                ]
+        else :
+            lines += [
+                f"Vcc: {md.get('Vcc')} V",
+                f"Experiment: {self.experiment}",
+                ]
+        return '\n'.join(lines)
+    
+    def save_csv(self, fil) :
+        """
+        Saves the samples as csv, the format read by batch_refit.py.
+        If a capture was written the full capture is exported.
+
+        Parameters
+        ----------
+        fil : str
+            Path of the csv file.
+
+        Returns
+        -------
+        None.
+
+        """
+        if self.capture_path is not None and os.path.exists(self.capture_path) :
+            capture_to_csv(self.capture_path, fil, header=self.header())
+            return
+        with open(fil, 'w') as f :
+            np.savetxt(f, self.xy, fmt='%.7e', delimiter=',', newline='\n',
+                       header=self.header(), footer='', comments='# ', encoding=None)
+
+class ExperimentRunner() :
+    """
+    Runs charge, discharge, prep and pulse experiments on an Arduino.
+    Everything blocks until the experiment has finished. Progress is
+    reported through optional callbacks, which are called from the thread
+    running the experiment.
+    """
+    def __init__(self, uController) :
+        """
+        Constructs the ExperimentRunner class.
+
+        Parameters
+        ----------
+        uController : arduino
+            Connected parameter wrapper, see arduino_controller.py.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.uController = uController
+        self.stop_requested = False
+        self.clock = SampleClock() # unwraps micros() and finds gaps, reset for each experiment
+    
+    @property
+    def instrumentation(self) :
+        """
+        Instrumentation attached to the Arduino, None when not instrumented.
+        """
+        return self.uController.serial.instrumentation
+    
+    def end_instrumentation(self) :
+        """
+        Ends the instrumented run started by acquire, written to json if the
+        instrumentation has a dump_dir.
+
+        Returns
+        -------
+        dict
+            Instrumentation.snapshot(), None when not instrumented.
+        str
+            Path of the json dump, None if nothing was written.
+
+        """
+        instr = self.instrumentation
+        if instr is None :
+            return None, None
+        fil = instr.end_run()
+        return instr.snapshot(), fil
+    
+    def configure(self, R=None, C=None, Vcc=None, exp_dur_factor=None,
+                  pulse_duration=None, pulse_duty_cycle=None) :
+        """
+        Sets the given parameters on the Arduino, others are left unchanged.
+
+        Parameters
+        ----------
+        R : float, optional
+            Resistance in Ohms.
+        C : float, optional
+            Capacitance in uF.
+        Vcc : float, optional
+            Supply voltage.
+        exp_dur_factor : int, optional
+            Experiment duration as a multiple of R*C.
+        pulse_duration : int, optional
+            Pulse duration in ms.
+        pulse_duty_cycle : int, optional
+            Pulse duty cycle in %.
+
+        Returns
+        -------
+        bool
+            True if every parameter was acknowledged.
+
+        """
+        cmds = []
+        if Vcc is not None :
+            cmds.append( f'j;{Vcc}' )
+        if R is not None :
+            cmds.append( f'f;{R:.3f}' )
+        if C is not None :
+            cmds.append( f'h;{C*1e-6:.3e}' )
+        if exp_dur_factor is not None :
+            cmds.append( f'l;{int(exp_dur_factor)}' )
+        if pulse_duration is not None :
+            cmds.append( f'r;{pulse_duration:.0f}' )
+        if pulse_duty_cycle is not None :
+            cmds.append( f't;{pulse_duty_cycle:.0f}' )
+        
+        # one pipelined write, only unacknowledged commands are resent
+        successful = all( self.uController.set_parameters(cmds) ) if len(cmds) > 0 else True
+        self.uController.update_all_parameters()
+        return successful
+    
+    def request_stop(self) :
+        """
+        Ends an open-ended experiment, ex. a pulse experiment without a
+        duration. May be called from another thread.
+        """
+        self.stop_requested = True
+    
+    def metadata(self, experiment) :
+        uController = self.uController
+        metadata = {
+            'experiment': experiment,
+            'R': uController.R,
+            'C_uF': uController.C,
+            'Vcc': uController.Vcc,
+            'firmware_mode': 'text',
+            }
+        if experiment == 'Pulse' :
+            metadata['pulse_duration_ms'] = uController.pulse_duration
+            metadata['pulse_duty_cycle'] = uController.pulse_duty_cycle
+        else :
+            metadata['exp_dur_factor'] = uController.exp_dur_factor
+        return metadata
+    
+    def acquire(self, start_cmd, samples, on_batch=None, capture=None, duration=None) :
+        """
+        Starts an experiment and collects its samples until the Arduino
+        sends "end".
+
+        Parameters
+        ----------
+        start_cmd : str
+            Command starting the experiment, ex. 'a'.
+        samples : SampleRingBuffer
+            Buffer the samples are appended to, times in seconds since the
+            first sample. micros() wraps are unwrapped by self.clock.
+        on_batch : callable, optional
+            Called as on_batch(t, v) with each batch of new samples.
+        capture : CaptureWriter, optional
+            Samples are also written to the capture, it is closed at the end.
+        duration : float, optional
+            Seconds after which "stop" is sent, for experiments which run
+            until stopped. The default is None.
+
+        Returns
+        -------
+        samples : SampleRingBuffer
+            The filled buffer.
+
+        Raises
+        ------
+        RuntimeError
+            If reading from the serial port failed before the experiment
+            ended. The samples read until then are in samples.
+
+        """
+        serial = self.uController.serial
+        instr = serial.instrumentation
+        self.stop_requested = False
+        self.clock.reset()
+        stop_sent = False
+        if instr is not None :
+            instr.reset( run_name=EXPERIMENT_NAMES.get(start_cmd, start_cmd) )
+        
+        serial.start_reader()
+        serial.send_command( start_cmd )
+        t_start = current_time()
+        try :
+            while True :
+                t, v, ended = serial.read_batches(timeout=0.1)
+                
+                if len(t) > 0 :
+                    with instrument_stage(instr, 'timestamps') :
+                        x = self.clock.process( t, current_time() )
+                    with instrument_stage(instr, 'append') :
+                        samples.append( x, v )
+                    if capture is not None :
+                        with instrument_stage(instr, 'capture') :
+                            capture.append( x, v )
+                    if on_batch is not None :
+                        with instrument_stage(instr, 'on_batch') :
+                            on_batch( x, v )
+                    if instr is not None :
+                        instr.intervals( x )
+                
+                if ended :
+                    break
+                
+                if not stop_sent and ( self.stop_requested or
+                        (duration is not None and current_time() - t_start >= duration) ) :
+                    serial.send_command('stop')
+                    stop_sent = True
+        finally :
+            serial.stop_reader()
+            if capture is not None :
+                capture.close()
+        
+        if serial.reader_error is not None :
+            # the samples read before the failure are kept in samples
+            raise RuntimeError( f'Reading from the Arduino failed: {serial.reader_error}' ) from serial.reader_error
+        return samples
+    
+    def sample_loss(self) :
+        """
+        Samples lost so far in the current or last experiment, may be
+        called from another thread while acquiring.
+
+        Returns
+        -------
+        dict
+            dropped_samples : discarded by the host because the reader
+                queue was full, the host is falling behind.
+            missing_samples : never received, from gaps in the timestamps.
+            gaps : (start [s], duration [s], missing samples) of the most
+                recent gaps.
+
+        """
+        return {'dropped_samples': self.uController.serial.dropped_samples,
+                'missing_samples': self.clock.missing_samples,
+                'gaps': list(self.clock.gaps)}
+    
+    def sample_loss_text(self) :
+        """
+        One line summary of sample_loss for live displays, empty while
+        nothing has been lost.
+        """
+        loss = self.sample_loss()
+        if loss['dropped_samples'] == 0 and loss['missing_samples'] == 0 :
+            return ''
+        return f"Lost samples: {loss['dropped_samples']} dropped, {loss['missing_samples']} missing"
+    
+    def clock_stats(self) :
+        """
+        Device clock rate estimated against host time in the current or
+        last experiment, see SampleClock.clock_rate. May be called from
+        another thread while acquiring.
+
+        Returns
+        -------
+        dict
+            clock_rate : device seconds per host second, nan until the
+                run spans 1 s.
+            clock_drift_ppm : device clock error relative to the host in
+                parts per million.
+
+        """
+        return {'clock_rate': self.clock.clock_rate,
+                'clock_drift_ppm': self.clock.clock_drift_ppm}
+    
+    def clock_text(self) :
+        """
+        One line summary of clock_stats for live displays, empty until the
+        clock rate is known.
+        """
+        drift = self.clock_stats()['clock_drift_ppm']
+        if not np.isfinite(drift) :
+            return ''
+        return f"Clock drift: {drift:+.0f} ppm"
+    
+    def fit(self, t, v, mode, refine=None) :
+        """
+        Fits a charge or discharge curve, as the GUI does.
+
+        Parameters
+        ----------
+        t : np.ndarray
+            Sample times in seconds.
+        v : np.ndarray
+            Voltage across the capacitor.
+        mode : int or str
+            1/'charge' or 0/'discharge'.
+        refine : bool, optional
+            Refine the fit with lmfit. The default is None,
+            uController.refine_fit.
+
+        Returns
+        -------
+        RCFitResult
+            Fit results.
+
+        """
+        if refine is None :
+            refine = self.uController.refine_fit
+        instr = self.instrumentation
+        tc = self.uController.R * self.uController.C * 1e-6
+        with instrument_stage(instr, 'fit') :
+            fit_result = fit_rc_response(t, v, mode, tc_guess=tc)
+        if refine :
+            with instrument_stage(instr, 'lmfit') :
+                fit_result = refine_with_lmfit(t, v, mode, fit_result,
+                                               Vcc_nominal=self.uController.Vcc,
+                                               tc_nominal=tc)
+        return fit_result
+    
+    def dis_charge(self, mode, samples=None, capture=None, on_batch=None, fit=True) :
+        """
+        Runs a charge or discharge experiment.
+
+        Parameters
+        ----------
+        mode : int
+            1 --> charge, 0 --> discharge, as dis_charge_choice.
+        samples : SampleRingBuffer, optional
+            Buffer for the samples. The default is None, one sized for the
+            experiment duration.
+        capture : CaptureWriter, optional
+            Capture the samples are written to. The default is None.
+        on_batch : callable, optional
+            Called as on_batch(t, v) with each batch of new samples.
+        fit : bool, optional
+            Fit the results. The default is True.
+
+        Returns
+        -------
+        ExperimentResult
+            Samples and fit results.
+
+        """
+        experiment = {0: 'Discharge', 1: 'Charge'}[mode]
+        if samples is None :
+            exp_t = self.uController.R * 1e-6*self.uController.C * self.uController.exp_dur_factor
+            samples = SampleRingBuffer( samples_for_duration(exp_t) )
+        
+        self.acquire( 'a' if mode == 1 else 'b', samples, on_batch=on_batch, capture=capture )
+        
+        fit_result = None
+        if fit and len(samples) > 0 :
+            fit_result = self.fit(samples.x, samples.y, mode)
+        snapshot, snapshot_path = self.end_instrumentation()
+        return ExperimentResult(experiment, samples.x, samples.y, fit_result,
+                                metadata=self.metadata(experiment),
+                                capture_path=None if capture is None else capture.fil,
+                                instrumentation=snapshot, instrumentation_path=snapshot_path,
+                                **self.sample_loss(), **self.clock_stats())
+    
+    def charge(self, **kwargs) :
+        return self.dis_charge(1, **kwargs)
+    
+    def discharge(self, **kwargs) :
+        return self.dis_charge(0, **kwargs)
+    
+    def prep(self, charged, on_progress=None) :
+        """
+        Charges or discharges the capacitor before an experiment.
+
+        Parameters
+        ----------
+        charged : bool
+            True --> charge the capacitor, False --> discharge it.
+        on_progress : callable, optional
+            Called as on_progress(voltage) with each reading.
+
+        Returns
+        -------
+        np.ndarray
+            Voltages read while preparing, one every 5 ms.
+
+        """
+        serial = self.uController.serial
+        serial.send_command( 'w' if charged else 'v' )
+        
+        voltages = []
+        while True :
+            result = serial.get_responses(num_responses=1, transpose=False, response_types="f", end_message=True)
+            if result[0] in [None, 'end'] :
+                break
+            voltages.append( result[0] )
+            if on_progress is not None :
+                on_progress( result[0] )
+        # the firmware sends a second "end"
+        serial.get_responses(num_responses=1, end_message=True)
+        return np.array(voltages, dtype=float)
+    
+    def pulse(self, duration=None, samples=None, capture=None, on_batch=None) :
+        """
+        Runs a pulse experiment.
+
+        Parameters
+        ----------
+        duration : float, optional
+            Seconds to run for. The default is None, until request_stop is
+            called or "stop" is sent by someone else.
+        samples : SampleRingBuffer, optional
+            Buffer for the samples. The default is None, the display_dur
+            window when streaming to a capture, otherwise every sample.
+        capture : CaptureWriter, optional
+            Capture the samples are written to. The default is None.
+        on_batch : callable, optional
+            Called as on_batch(t, v) with each batch of new samples.
+
+        Returns
+        -------
+        ExperimentResult
+            Samples, only the most recent window when streaming.
+
+        """
+        if samples is None :
+            stream = self.uController.stream_pulse and capture is not None
+            num_samples = self.uController.display_dur if stream else (duration or 60)
+            samples = SampleRingBuffer( samples_for_duration(num_samples), wrap=stream )
+        
+        self.acquire( 'q', samples, on_batch=on_batch, capture=capture, duration=duration )
+        
+        snapshot, snapshot_path = self.end_instrumentation()
+        return ExperimentResult('Pulse', samples.x, samples.y,
+                                metadata=self.metadata('Pulse'),
+                                capture_path=None if capture is None else capture.fil,
+                                instrumentation=snapshot, instrumentation_path=snapshot_path,
+                                **self.sample_loss(), **self.clock_stats())
+
+def main(argv=None) :
+    parser = argparse.ArgumentParser(description='Run a capacitor experiment without the GUI.')
+    parser.add_argument('experiment', choices=['charge', 'discharge', 'prep-charge', 'prep-discharge', 'pulse'])
+    parser.add_argument('-p', '--port', default='/dev/ttyACM0', help='serial port of the Arduino')
+    parser.add_argument('-b', '--baud', type=int, default=250000, help='baud rate')
+    parser.add_argument('--emulate', action='store_true', help='run against the emulated Arduino, see arduino_emulator.py')
+    parser.add_argument('--R', type=float, default=None, help='resistance [Ohms]')
+    parser.add_argument('--C', type=float, default=None, help='capacitance [uF]')
+    parser.add_argument('--Vcc', type=float, default=None, help='supply voltage [V]')
+    parser.add_argument('--factor', type=int, default=None, help='(dis)charge duration as a multiple of R*C')
+    parser.add_argument('--pulse-ms', type=int, default=None, help='pulse duration [ms]')
+    parser.add_argument('--duty', type=int, default=None, help='pulse duty cycle [%%]')
+    parser.add_argument('--duration', type=float, default=None, help='pulse experiment duration [s], default until Ctrl-C')
+    parser.add_argument('--no-prep', action='store_true', help='do not charge/discharge the capacitor before a (dis)charge experiment')
+    parser.add_argument('--lmfit', action='store_true', help='refine the fit with lmfit')
+    parser.add_argument('-o', '--output', default=None, help='csv file for the results')
+    parser.add_argument('--capture', default=None, help='binary capture file written during the experiment')
+    parser.add_argument('--instrument', nargs='?', const='.', default=None, metavar='DIR',
+                        help='time each acquisition stage and write a json report to DIR (default: current folder)')
+    args = parser.parse_args(argv)
+    
+    emulator = None
+    if args.emulate :
+        from arduino_emulator import ArduinoEmulator
+        circuit = { key: value for (key, value) in [('R', args.R), ('C', args.C), ('Vcc', args.Vcc)]
+                    if value is not None }
+        emulator = ArduinoEmulator(**circuit)
+        args.port = emulator.start()
+    
+    uController = arduino(args.port, args.baud)
+    if args.instrument is not None :
+        uController.serial.instrumentation = Instrumentation(dump_dir=args.instrument)
+    try :
+        if not uController.connect() :
+            print( f'Could not connect to an Arduino on {args.port}' )
+            return 1
+        print( f'Connected to {args.port}, board ready after {1000*uController.serial.ready_latency:.0f} ms' )
+        
+        runner = ExperimentRunner(uController)
+        uController.refine_fit = args.lmfit
+        if not runner.configure(R=args.R, C=args.C, Vcc=args.Vcc, exp_dur_factor=args.factor,
+                                pulse_duration=args.pulse_ms, pulse_duty_cycle=args.duty) :
+            print( 'The Arduino did not acknowledge every parameter' )
+            return 1
+        
+        if args.experiment.startswith('prep') :
+            voltages = runner.prep( args.experiment == 'prep-charge' )
+            final_v = voltages[-1] if len(voltages) > 0 else np.nan
+            print( f'Capacitor at {final_v:.2f} V after {5*len(voltages)} ms' )
+            return 0
+        
+        experiment = {'charge': 'Charge', 'discharge': 'Discharge', 'pulse': 'Pulse'}[args.experiment]
+        capture = None
+        if args.capture is not None :
+            writer = BackgroundCaptureWriter if experiment == 'Pulse' else CaptureWriter
+            capture = writer(args.capture, runner.metadata(experiment))
+        
+        t_start = current_time()
+        try :
+            if experiment == 'Pulse' :
+                # Ctrl-C ends the experiment cleanly, the firmware pulses until told to stop
+                signal.signal( signal.SIGINT, lambda signum, frame : runner.request_stop() )
+                result = runner.pulse(duration=args.duration, capture=capture)
+                signal.signal( signal.SIGINT, signal.default_int_handler )
+            else :
+                mode = 1 if experiment == 'Charge' else 0
+                if not args.no_prep :
+                    # as the GUI, start a charge from empty and a discharge from full
+                    runner.prep( charged=(mode == 0) )
+                result = runner.dis_charge(mode, capture=capture)
+        except RuntimeError as error :
+            print( f'{experiment} failed: {error}' )
+            return 1
+        elapsed = current_time() - t_start
+        
+        print( f'{experiment}: {len(result.t)} samples in {elapsed:.2f} s, {result.dropped_samples} dropped, '
+               f'{result.missing_samples} missing in {len(result.gaps)} gaps' )
+        if np.isfinite(result.clock_drift_ppm) :
+            print( f'Device clock: {result.clock_rate:.6f} s per host s, {result.clock_drift_ppm:+.0f} ppm' )
+        if result.instrumentation is not None :
+            print( f'Instrumentation: {uController.serial.instrumentation.readout()}' )
+            print( f'Instrumentation report written to {result.instrumentation_path}' )
+        if result.fit_result is not None :
+            fit_result = result.fit_result
+            print( f'TC: {fit_result.tc:.4f} +/- {fit_result.tc_err:.4f} s, Vcc: {fit_result.Vcc:.3f} V, '
+                   f'rms residual: {fit_result.rms_residual:.4f} V' )
+        if args.output is not None :
+            result.save_csv(args.output)
+            print( f'Results written to {args.output}' )
+        return 0
+    finally :
+        uController.disconnect()
+        if emulator is not None :
+            emulator.stop()
+
+if __name__ == '__main__' :
+    sys.exit( main() )
@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Measures the frequency response of the RC circuit with the pulse experiment.
+For each pulse duration the pulse experiment runs until PulseAnalyzer finds
+steady state plus a few cycles to measure, then the next duration is set.
+The duty cycle is the same for every step so the average voltage doesn't
+change and later steps settle almost at once.
+The sweep can also be run from the pulse experiment tab of the GUI.
+
+Usage:
+    python frequency_sweep.py --port /dev/ttyACM0 --durations 500 200 100 50 20 10 -o bode.csv --plot bode.png
+    python frequency_sweep.py --emulate --R 2200 --C 22 --min-ms 5 --max-ms 1000 --points 12
+"""
+
+import sys
+import signal
+import argparse
+from time import time as current_time
+
+import numpy as np
+
+from arduino_controller import arduino
+from experiment_runner import ExperimentRunner
+from sample_buffer import SampleRingBuffer, samples_for_duration
+from pulse_analysis import PulseAnalyzer
+
+def square_wave_coefficient(duty_cycle, Vcc) :
+    """
+    First complex Fourier coefficient of the drive signal, Vcc for the
+    first duty_cycle % of each period and 0 for the rest.
+    """
+    D = duty_cycle / 100
+    return Vcc * (1 - np.exp(-2j*np.pi*D)) / (2j*np.pi)
+
+def fundamental_response(x, v, period, duty_cycle, Vcc) :
+    """
+    Gain and phase of the circuit at the pulse frequency.
+    The first Fourier coefficient of the response is computed over a whole
+    number of cycles and divided by that of the drive signal.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        Sample times [s], cycles start at multiples of period.
+    v : np.ndarray
+        Voltage across the capacitor.
+    period : float
+        Pulse period [s].
+    duty_cycle : float
+        Percent of the period the pin is HIGH.
+    Vcc : float
+        Supply voltage.
+
+    Returns
+    -------
+    complex
+        Transfer function H(f), nan if x doesn't span a whole cycle.
+    int
+        Number of cycles used.
+
+    """
+    if len(x) == 0 :
+        return complex(np.nan, np.nan), 0
+    k_first = np.ceil( x[0] / period - 1e-9 )
+    k_last = np.floor( x[-1] / period + 1e-9 )
+    num_cycles = int(k_last - k_first)
+    if num_cycles < 1 :
+        return complex(np.nan, np.nan), 0
+    start, end = np.searchsorted( x, [k_first*period - 1e-9, k_last*period - 1e-9] )
+    x = x[start:end]
+    v = v[start:end]
+    c_out = np.mean( v * np.exp(-2j*np.pi*x/period) )
+    return c_out / square_wave_coefficient(duty_cycle, Vcc), num_cycles
+
+class SweepStep() :
+    """
+    Result of one pulse duration.
+    """
+    def __init__(self, pulse_duration, duty_cycle, H, cycles, steady, mean, ripple,
+                 v_min, v_max, t_steady, t_step) :
+        self.pulse_duration = pulse_duration # ms
+        self.frequency = 1000 / pulse_duration # Hz
+        self.duty_cycle = duty_cycle
+        self.H = H # transfer function at the pulse frequency
+        self.cycles = cycles # cycles used for H
+        self.steady = steady # False if the step timed out before steady state
+        self.mean = mean # average voltage over the measured cycles
+        self.ripple = ripple # average peak to peak voltage of a cycle
+        self.v_min = v_min
+        self.v_max = v_max
+        self.t_steady = t_steady # experiment time when steady state started [s]
+        self.t_step = t_step # wall time of the step [s]
+    
+    @property
+    def gain(self) :
+        return np.abs(self.H)
+    
+    @property
+    def gain_db(self) :
+        return 20 * np.log10(self.gain)
+    
+    @property
+    def phase_deg(self) :
+        return np.degrees( np.angle(self.H) )
+
+class FrequencySweep() :
+    """
+    Runs pulse experiments over a list of pulse durations, see module
+    description.
+    """
+    def __init__(self, runner, durations, duty_cycle=50, steady_cycles=3, measure_cycles=6,
+                 min_measure_time=0.2, max_step_time=60., steady_tol=0.02) :
+        """
+        Constructs the FrequencySweep class.
+
+        Parameters
+        ----------
+        runner : ExperimentRunner
+            Runner of a connected Arduino, R, C and Vcc are already set.
+        durations : list of int
+            Pulse durations [ms], one step each, run in the given order.
+        duty_cycle : int, optional
+            Duty cycle of every step [%]. The default is 50.
+        steady_cycles : int, optional
+            Minimum PulseAnalyzer window in cycles. The default is 3.
+        measure_cycles : int, optional
+            Steady cycles measured before the step ends. The default is 6.
+        min_measure_time : float, optional
+            Steady time measured before the step ends [s], for short
+            durations. The default is 0.2.
+        max_step_time : float, optional
+            A step is stopped after this many seconds even if it isn't
+            steady. The default is 60.
+        steady_tol : float, optional
+            Steady state tolerance, see PulseAnalyzer. The default is 0.02.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.runner = runner
+        self.durations = [ int(dur) for dur in durations ]
+        self.duty_cycle = duty_cycle
+        self.steady_cycles = steady_cycles
+        self.measure_cycles = measure_cycles
+        self.min_measure_time = min_measure_time
+        self.max_step_time = max_step_time
+        self.steady_tol = steady_tol
+        self.steps = []
+        self.stop_requested = False
+    
+    def request_stop(self) :
+        """
+        Ends the current step early and skips the rest, the partial step is
+        kept. May be called from another thread.
+        """
+        self.stop_requested = True
+        self.runner.request_stop()
+    
+    def run(self, on_step=None) :
+        """
+        Runs every step.
+
+        Parameters
+        ----------
+        on_step : callable, optional
+            Called as on_step(step) after each step. The default is None.
+
+        Returns
+        -------
+        list of SweepStep
+            Results in the order of durations.
+
+        """
+        self.steps = []
+        self.stop_requested = False
+        for pulse_duration in self.durations :
+            if self.stop_requested :
+                break
+            step = self.run_step(pulse_duration)
+            self.steps.append( step )
+            if on_step is not None :
+                on_step( step )
+        return self.steps
+    
+    def run_step(self, pulse_duration) :
+        """
+        Runs the pulse experiment at one pulse duration until steady state
+        has been measured for long enough.
+        """
+        uController = self.runner.uController
+        if not self.runner.configure(pulse_duration=pulse_duration, pulse_duty_cycle=self.duty_cycle) :
+            raise RuntimeError( f'The Arduino did not acknowledge pulse duration {pulse_duration} ms' )
+        
+        period = pulse_duration / 1000
+        Vcc = uController.Vcc
+        analyzer = PulseAnalyzer(pulse_duration, self.duty_cycle, Vcc=Vcc,
+                                 tc=uController.R * 1e-6*uController.C,
+                                 steady_tol=self.steady_tol, steady_cycles=self.steady_cycles)
+        measure_time = max( self.measure_cycles*period, self.min_measure_time )
+        samples = SampleRingBuffer( samples_for_duration(self.max_step_time), wrap=True )
+        
+        def on_batch(x, v) :
+            analyzer.update( x, v )
+            if analyzer.steady and x[-1] - analyzer.cycle_start(analyzer.steady_since) >= measure_time \
+                    and analyzer.steady_num >= self.measure_cycles :
+                self.runner.request_stop()
+            elif self.stop_requested :
+                # the runner clears its flag when a step starts, ask again
+                self.runner.request_stop()
+        
+        t_start = current_time()
+        self.runner.pulse(duration=self.max_step_time, samples=samples, on_batch=on_batch)
+        t_step = current_time() - t_start
+        
+        # batch analysis of the steady part, or the second half if it never settled
+        steady = analyzer.steady_state()
+        x, v = samples.x, samples.y
+        if steady is not None :
+            t_from = steady['t_start']
+            summary = steady
+        else :
+            t_from = x[len(x)//2] if len(x) > 0 else 0.
+            cycles = analyzer.cycles()
+            sel = cycles['t_start'] >= t_from
+            summary = {
+                'mean': np.mean(cycles['mean'][sel]) if np.any(sel) else np.nan,
+                'ripple': np.mean(cycles['ripple'][sel]) if np.any(sel) else np.nan,
+                'min': np.min(cycles['min'][sel]) if np.any(sel) else np.nan,
+                'max': np.max(cycles['max'][sel]) if np.any(sel) else np.nan,
+                }
+        start = np.searchsorted(x, t_from)
+        H, num_cycles = fundamental_response(x[start:], v[start:], period, self.duty_cycle, Vcc)
+        
+        return SweepStep(pulse_duration, self.duty_cycle, H, num_cycles, steady is not None,
+                         summary['mean'], summary['ripple'], summary['min'], summary['max'],
+                         t_steady=None if steady is None else steady['t_start'], t_step=t_step)
+    
+    def theoretical_response(self, frequency) :
+        """
+        H(f) = 1 / (1 + i 2 pi f R C) of an ideal RC low pass filter.
+        """
+        uController = self.runner.uController
+        tc = uController.R * 1e-6*uController.C
+        return 1 / (1 + 2j*np.pi*np.asarray(frequency)*tc)
+    
+    def table(self) :
+        """
+        Bode table, one row per step.
+
+        Returns
+        -------
+        list of str
+            Column names.
+        np.ndarray
+            One row per step.
+
+        """
+        columns = ['frequency_Hz', 'pulse_ms', 'gain', 'gain_dB', 'phase_deg', 'ideal_gain_dB',
+                   'ideal_phase_deg', 'mean_V', 'ripple_V', 'min_V', 'max_V', 'cycles', 'steady', 'step_s']
+        rows = []
+        for step in self.steps :
+            H_ideal = self.theoretical_response(step.frequency)
+            rows.append( [step.frequency, step.pulse_duration, step.gain, step.gain_db, step.phase_deg,
+                          20*np.log10(np.abs(H_ideal)), np.degrees(np.angle(H_ideal)),
+                          step.mean, step.ripple, step.v_min, step.v_max, step.cycles,
+                          float(step.steady), step.t_step] )
+        return columns, np.array(rows, dtype=float).reshape(-1, len(columns))
+    
+    def format_table(self) :
+        (columns, rows) = self.table()
+        lines = [ f"{'f [Hz]':>9} {'ms':>6} {'gain dB':>8} {'phase':>7} {'ideal dB':>9} {'ideal ph':>9} "
+                  f"{'mean V':>7} {'ripple V':>9} {'cycles':>6} {'steady':>6} {'step s':>7}" ]
+        for row in rows :
+            lines.append( f"{row[0]:9.2f} {row[1]:6.0f} {row[3]:8.2f} {row[4]:7.1f} {row[5]:9.2f} {row[6]:9.1f} "
+                          f"{row[7]:7.3f} {row[8]:9.3f} {row[11]:6.0f} {'yes' if row[12] else 'no':>6} {row[13]:7.2f}" )
+        return '\n'.join(lines)
+    
+    def save_csv(self, fil) :
+        (columns, rows) = self.table()
+        uController = self.runner.uController
+        header = '\n'.join([ f"Resistor: {uController.R} Ohms",
+                             f"Capacitor: {uController.C} uF",
+                             f"Vcc: {uController.Vcc} V",
+                             f"Pulse Duty Cycle: {self.duty_cycle} %",
+                             ','.join(columns) ])
+        np.savetxt(fil, rows, fmt='%.7e', delimiter=',', newline='\n',
+                   header=header, footer='', comments='# ', encoding=None)
+    
+    def plot(self, fil=None, fig=None) :
+        """
+        Bode plot of the measured and ideal response.
+
+        Parameters
+        ----------
+        fil : str, optional
+            Image file to save the plot to. The default is None.
+        fig : matplotlib.figure.Figure, optional
+            Figure to draw on, ex. an MplCanvas figure. The default is
+            None, a new figure.
+
+        Returns
+        -------
+        matplotlib.figure.Figure
+            The figure.
+
+        """
+        from matplotlib.figure import Figure
+        
+        (columns, rows) = self.table()
+        if fig is None :
+            fig = Figure(figsize=(8, 7))
+        fig.clear()
+        (ax_gain, ax_phase) = fig.subplots(2, 1, sharex=True)
+        
+        order = np.argsort(rows[:,0])
+        f = rows[order,0]
+        if len(f) > 0 :
+            f_ideal = np.logspace( np.log10(f.min()/2), np.log10(2*f.max()), 200 )
+            H_ideal = self.theoretical_response(f_ideal)
+            ax_gain.semilogx(f_ideal, 20*np.log10(np.abs(H_ideal)), 'k--', label='Ideal RC')
+            ax_phase.semilogx(f_ideal, np.degrees(np.angle(H_ideal)), 'k--', label='Ideal RC')
+        ax_gain.semilogx(f, rows[order,3], 'o-', label='Measured')
+        ax_phase.semilogx(f, rows[order,4], 'o-', label='Measured')
+        
+        ax_gain.set_ylabel('Gain [dB]')
+        ax_phase.set_ylabel('Phase [deg]')
+        ax_phase.set_xlabel('Frequency [Hz]')
+        ax_gain.legend(loc=0)
+        ax_gain.grid(True, which='both', alpha=0.3)
+        ax_phase.grid(True, which='both', alpha=0.3)
+        fig.tight_layout()
+        
+        if fil is not None :
+            fig.savefig(fil)
+        return fig
+
+def log_durations(min_ms, max_ms, points) :
+    """
+    Pulse durations evenly spaced in log(frequency), rounded to whole ms,
+    longest first.
+    """
+    durations = np.unique( np.rint(np.logspace(np.log10(min_ms), np.log10(max_ms), points)).astype(int) )
+    return durations[::-1].tolist()
+
+def main(argv=None) :
+    parser = argparse.ArgumentParser(description='Measure the frequency response of the RC circuit.')
+    parser.add_argument('-p', '--port', default='/dev/ttyACM0', help='serial port of the Arduino')
+    parser.add_argument('-b', '--baud', type=int, default=250000, help='baud rate')
+    parser.add_argument('--emulate', action='store_true', help='run against the emulated Arduino, see arduino_emulator.py')
+    parser.add_argument('--R', type=float, default=None, help='resistance [Ohms]')
+    parser.add_argument('--C', type=float, default=None, help='capacitance [uF]')
+    parser.add_argument('--Vcc', type=float, default=None, help='supply voltage [V]')
+    parser.add_argument('--durations', type=int, nargs='*', default=None, help='pulse durations [ms]')
+    parser.add_argument('--min-ms', type=int, default=10, help='shortest pulse duration [ms], when --durations is not given')
+    parser.add_argument('--max-ms', type=int, default=1000, help='longest pulse duration [ms], when --durations is not given')
+    parser.add_argument('--points', type=int, default=10, help='number of pulse durations, when --durations is not given')
+    parser.add_argument('--duty', type=int, default=50, help='pulse duty cycle [%%]')
+    parser.add_argument('--measure-cycles', type=int, default=6, help='steady cycles measured per step')
+    parser.add_argument('--max-step', type=float, default=60., help='longest time per step [s]')
+    parser.add_argument('-o', '--output', default=None, help='csv file for the Bode table')
+    parser.add_argument('--plot', default=None, help='image file for the Bode plot')
+    args = parser.parse_args(argv)
+    
+    durations = args.durations if args.durations else log_durations(args.min_ms, args.max_ms, args.points)
+    if min(durations) < 4 :
+        print( 'Pulse durations below 4 ms have too few samples per cycle, 1 sample per ms' )
+        return 1
+    
+    emulator = None
+    if args.emulate :
+        from arduino_emulator import ArduinoEmulator
+        circuit = { key: value for (key, value) in [('R', args.R), ('C', args.C), ('Vcc', args.Vcc)]
+                    if value is not None }
+        emulator = ArduinoEmulator(**circuit)
+        args.port = emulator.start()
+    
+    uController = arduino(args.port, args.baud)
+    try :
+        if not uController.connect() :
+            print( f'Could not connect to an Arduino on {args.port}' )
+            return 1
+        runner = ExperimentRunner(uController)
+        if not runner.configure(R=args.R, C=args.C, Vcc=args.Vcc) :
+            print( 'The Arduino did not acknowledge every parameter' )
+            return 1
+        
+        sweep = FrequencySweep(runner, durations, duty_cycle=args.duty,
+                               measure_cycles=args.measure_cycles, max_step_time=args.max_step)
+        # Ctrl-C cuts the current step short, keeps it and skips the remaining steps
+        signal.signal( signal.SIGINT, lambda signum, frame : sweep.request_stop() )
+        t_start = current_time()
+        sweep.run( on_step=lambda step : print( f'{step.pulse_duration} ms: {step.gain_db:.2f} dB, '
+                                                f'{step.phase_deg:.1f} deg in {step.t_step:.2f} s' ) )
+        signal.signal( signal.SIGINT, signal.default_int_handler )
+        
+        print( f'Sweep of {len(sweep.steps)} steps in {current_time()-t_start:.1f} s' )
+        print( sweep.format_table() )
+        if args.output is not None :
+            sweep.save_csv(args.output)
+            print( f'Bode table written to {args.output}' )
+        if args.plot is not None :
+            sweep.plot(args.plot)
+            print( f'Bode plot written to {args.plot}' )
+        return 0
+    finally :
+        uController.disconnect()
+        if emulator is not None :
+            emulator.stop()
+
+if __name__ == '__main__' :
+    sys.exit( main() )
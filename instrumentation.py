@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Opt-in per stage instrumentation of the acquisition pipeline.
+An Instrumentation object is attached to Arduino.instrumentation, the
+Arduino, ExperimentRunner and GUI then time their stages with it. Without
+one every hook is a single "is None" check.
+"""
+
+import os
+import json
+import math
+import threading
+from contextlib import nullcontext
+from time import perf_counter
+from time import time as current_time
+
+import numpy as np
+
+NULL_STAGE = nullcontext() # returned by stage when instrumentation is off
+
+# latency histogram: 10 log spaced bins per decade from 100 ns to 100 s
+HIST_MIN_EXP = -7
+HIST_BINS_PER_DECADE = 10
+HIST_NUM_BINS = 9 * HIST_BINS_PER_DECADE
+
+# inter-sample dt histogram edges [us] around the firmware's 1000 us period
+DT_TARGET_US = 1000
+DT_EDGES_US = [0, 500, 900, 990, 999.5, 1000.5, 1010, 1100, 1500, 2000, 5000, 1e4, 1e5, np.inf]
+
+class StageStats() :
+    """
+    Count, total, min/max and a log spaced latency histogram of one stage.
+    """
+    def __init__(self) :
+        self.count = 0
+        self.total = 0.
+        self.min = np.inf
+        self.max = 0.
+        self.hist = [0] * HIST_NUM_BINS
+    
+    def record(self, duration) :
+        self.count += 1
+        self.total += duration
+        if duration < self.min :
+            self.min = duration
+        if duration > self.max :
+            self.max = duration
+        idx = int( (math.log10(duration) - HIST_MIN_EXP) * HIST_BINS_PER_DECADE ) if duration > 0 else 0
+        self.hist[ min(max(idx, 0), HIST_NUM_BINS-1) ] += 1
+    
+    def percentile(self, q) :
+        """
+        Upper edge of the histogram bin holding the q-th percentile, in s.
+        """
+        if self.count == 0 :
+            return np.nan
+        target = q / 100 * self.count
+        cumulative = 0
+        for (idx, num) in enumerate(self.hist) :
+            cumulative += num
+            if cumulative >= target :
+                return min( 10**(HIST_MIN_EXP + (idx+1)/HIST_BINS_PER_DECADE), self.max )
+        return self.max
+    
+    def as_dict(self) :
+        if self.count == 0 :
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'total_s': self.total,
+            'mean_us': 1e6 * self.total / self.count,
+            'min_us': 1e6 * self.min,
+            'p50_us': 1e6 * self.percentile(50),
+            'p99_us': 1e6 * self.percentile(99),
+            'max_us': 1e6 * self.max,
+            }
+
+class _StageTimer() :
+    def __init__(self, stats) :
+        self.stats = stats
+    
+    def __enter__(self) :
+        self.t_start = perf_counter()
+        return self
+    
+    def __exit__(self, *args) :
+        self.stats.record( perf_counter() - self.t_start )
+        return False
+
+class Instrumentation() :
+    """
+    Counters, gauges and latency histograms of the acquisition stages.
+    Updates come from the reader thread, the experiment thread and the GUI
+    thread. Each stage is only updated from one thread, the counters may be
+    off by a few under contention, which is acceptable for diagnostics.
+    """
+    def __init__(self, dump_dir=None) :
+        """
+        Constructs the Instrumentation class.
+
+        Parameters
+        ----------
+        dump_dir : str, optional
+            If provided end_run writes a json snapshot to this directory.
+            The default is None.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.dump_dir = dump_dir
+        self.lock = threading.Lock() # only taken to create new stages/counters
+        self.reset()
+    
+    def reset(self, run_name=None) :
+        """
+        Clears all statistics, ex. at the start of an experiment.
+        """
+        self.run_name = run_name
+        self.t_start = perf_counter()
+        self.wall_start = current_time()
+        self.t_end = None
+        self.stages = {}
+        self.counters = {}
+        self.gauges = {} # name: [last, max]
+        self.dt_hist = np.zeros( len(DT_EDGES_US)-1, dtype=np.int64 )
+        self.dt_last_x = None
+        self.dt_sum = 0.
+        self.dt_sum_sq = 0.
+        self.dt_count = 0
+    
+    def _stats(self, name) :
+        stats = self.stages.get(name)
+        if stats is None :
+            with self.lock :
+                stats = self.stages.setdefault(name, StageStats())
+        return stats
+    
+    def stage(self, name) :
+        """
+        Context manager timing one pass through a stage.
+        """
+        return _StageTimer( self._stats(name) )
+    
+    def record(self, name, duration) :
+        """
+        Records a duration in seconds measured by the caller.
+        """
+        self._stats(name).record(duration)
+    
+    def count(self, name, num=1) :
+        self.counters[name] = self.counters.get(name, 0) + num
+    
+    def gauge(self, name, value) :
+        """
+        Records the current value of a level, ex. the queue depth.
+        """
+        last_max = self.gauges.get(name)
+        if last_max is None :
+            self.gauges[name] = [value, value]
+        else :
+            last_max[0] = value
+            if value > last_max[1] :
+                last_max[1] = value
+    
+    def intervals(self, x) :
+        """
+        Adds the inter-sample intervals of a batch of sample times.
+
+        Parameters
+        ----------
+        x : np.ndarray
+            Unwrapped sample times in seconds, continuing the previous batch.
+
+        Returns
+        -------
+        None.
+
+        """
+        if len(x) == 0 :
+            return
+        prev = x[0] if self.dt_last_x is None else self.dt_last_x
+        dt_us = 1e6 * np.diff(x, prepend=prev)
+        if self.dt_last_x is None :
+            dt_us = dt_us[1:]
+        self.dt_last_x = x[-1]
+        if len(dt_us) == 0 :
+            return
+        self.dt_hist += np.histogram(dt_us, bins=DT_EDGES_US)[0]
+        self.dt_sum += float( dt_us.sum() )
+        self.dt_sum_sq += float( (dt_us**2).sum() )
+        self.dt_count += len(dt_us)
+    
+    def elapsed(self) :
+        t_end = self.t_end if self.t_end is not None else perf_counter()
+        return t_end - self.t_start
+    
+    def snapshot(self) :
+        """
+        Returns every statistic as a json serializable dictionary.
+        """
+        elapsed = self.elapsed()
+        counters = dict(self.counters)
+        rates = { f'{name}_per_s': num / elapsed for (name, num) in counters.items() } if elapsed > 0 else {}
+        
+        dt = {'target_us': DT_TARGET_US, 'count': self.dt_count}
+        if self.dt_count > 0 :
+            mean = self.dt_sum / self.dt_count
+            dt['mean_us'] = mean
+            dt['std_us'] = math.sqrt( max(self.dt_sum_sq / self.dt_count - mean**2, 0.) )
+            dt['histogram'] = { f'{lo:g}-{hi:g}' : int(num)
+                                for (lo, hi, num) in zip(DT_EDGES_US[:-1], DT_EDGES_US[1:], self.dt_hist) }
+        
+        return {
+            'run': self.run_name,
+            'started': self.wall_start,
+            'elapsed_s': elapsed,
+            'stages': { name: stats.as_dict() for (name, stats) in list(self.stages.items()) },
+            'counters': counters,
+            'rates': rates,
+            'gauges': { name: {'last': last, 'max': peak} for (name, (last, peak)) in list(self.gauges.items()) },
+            'sample_dt': dt,
+            }
+    
+    def readout(self) :
+        """
+        Compact one line summary for a status bar.
+        """
+        elapsed = max( self.elapsed(), 1e-9 )
+        parts = [ f"{self.counters.get('bytes_read', 0) / elapsed / 1000:.1f} kB/s",
+                  f"{self.counters.get('samples', 0) / elapsed:.0f} samples/s" ]
+        if 'queue_depth' in self.gauges :
+            (last, peak) = self.gauges['queue_depth']
+            parts.append( f"queue {last} (max {peak})" )
+        for name in ['parse', 'on_batch', 'draw'] :
+            stats = self.stages.get(name)
+            if stats is not None and stats.count > 0 :
+                parts.append( f"{name} p99 {1e6*stats.percentile(99):.0f} us" )
+        if self.dt_count > 0 :
+            mean = self.dt_sum / self.dt_count
+            std = math.sqrt( max(self.dt_sum_sq / self.dt_count - mean**2, 0.) )
+            parts.append( f"dt {mean:.0f}+/-{std:.0f} us" )
+        dropped = self.counters.get('dropped_samples', 0)
+        if dropped > 0 :
+            parts.append( f"{dropped} dropped" )
+        return ' | '.join(parts)
+    
+    def dump(self, fil) :
+        """
+        Writes snapshot to a json file.
+        """
+        with open(fil, 'w') as f :
+            json.dump( self.snapshot(), f, indent=2 )
+    
+    def end_run(self) :
+        """
+        Stops the run clock and, if dump_dir is set, writes the snapshot.
+
+        Returns
+        -------
+        str
+            Path of the json file, None if nothing was written.
+
+        """
+        self.t_end = perf_counter()
+        if self.dump_dir is None :
+            return None
+        name = self.run_name if self.run_name is not None else 'run'
+        stamp = np.datetime_as_string( np.datetime64(int(self.wall_start), 's') ).replace(':', '-')
+        fil = os.path.join( self.dump_dir, f'instrumentation_{name}_{stamp}.json' )
+        self.dump(fil)
+        return fil
+
+def stage(instrumentation, name) :
+    """
+    instrumentation.stage(name), or a no-op context when it is None.
+    """
+    if instrumentation is None :
+        return NULL_STAGE
+    return instrumentation.stage(name)
@@ -0,0 +1,523 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Runs the same experiment on several Arduinos at once.
+Each board is connected, configured and read by its own process running an
+ExperimentRunner, so reading and parsing scale with the number of boards
+rather than sharing one interpreter. The session collects the samples into
+one buffer per board and a combined view of all of them.
+
+Usage:
+    python multi_session.py --ports /dev/ttyACM0 /dev/ttyACM1 --R 2200 --C 220 charge -o rigs.csv
+    python multi_session.py --emulate 6 --R 2200 --C 22 pulse --duration 10
+"""
+
+import os
+import sys
+import signal
+import argparse
+import threading
+import multiprocessing
+from queue import Empty
+from time import time as current_time
+
+import numpy as np
+
+from arduino_controller import arduino
+from sample_buffer import SampleRingBuffer, samples_for_duration
+from capture_file import CaptureWriter, BackgroundCaptureWriter
+from experiment_runner import ExperimentRunner, ExperimentResult
+
+EXPERIMENTS = ['charge', 'discharge', 'pulse']
+
+def _device_worker(label, port, baud, settings, experiment, options, data_q, start_event, stop_event) :
+    """
+    Runs one experiment on one Arduino, in its own process.
+    Messages put on data_q are tuples starting with the message type and
+    the device label:
+        ('ready', label, ready_latency)
+        ('batch', label, t, v)
+        ('result', label, fit_result, metadata, capture_path, sample_loss, clock_stats)
+        ('error', label, message)
+        ('done', label)
+
+    Parameters
+    ----------
+    label : str
+        Name of the device in the session.
+    port : str
+        Serial port, None to start an emulated Arduino in this process.
+    baud : int
+        Baud rate.
+    settings : dict
+        Keyword arguments for ExperimentRunner.configure.
+    experiment : str
+        'charge', 'discharge' or 'pulse'.
+    options : dict
+        prep : bool, charge/discharge the capacitor first.
+        duration : float or None, pulse experiment duration in seconds.
+        capture_dir : str or None, directory for a capture file per device.
+        refine_fit : bool, refine the fit with lmfit.
+        emulator : dict, keyword arguments for ArduinoEmulator when port
+            is None.
+    data_q : multiprocessing.Queue
+        Messages to the session.
+    start_event : multiprocessing.Event
+        Set by the session once every device is ready.
+    stop_event : multiprocessing.Event
+        Set by the session to end the experiment, or to abort before it
+        has started.
+
+    Returns
+    -------
+    None.
+
+    """
+    # Ctrl-C is handled by the session, which stops every device
+    signal.signal( signal.SIGINT, signal.SIG_IGN )
+    
+    emulator = None
+    uController = None
+    try :
+        if port is None :
+            from arduino_emulator import ArduinoEmulator
+            emulator = ArduinoEmulator(**options.get('emulator', {}))
+            port = emulator.start()
+        
+        uController = arduino(port, baud)
+        if not uController.connect() :
+            data_q.put( ('error', label, f'Could not connect to an Arduino on {port}') )
+            return
+        uController.refine_fit = options.get('refine_fit', False)
+        
+        runner = ExperimentRunner(uController)
+        if not runner.configure(**settings) :
+            data_q.put( ('error', label, 'The Arduino did not acknowledge every parameter') )
+            return
+        
+        mode = {'charge': 1, 'discharge': 0}.get(experiment)
+        if mode is not None and options.get('prep', True) :
+            runner.prep( charged=(mode == 0) )
+        
+        data_q.put( ('ready', label, uController.serial.ready_latency) )
+        while not start_event.wait(0.1) :
+            if stop_event.is_set() :
+                return
+        
+        # forward a stop from the session to the runner, the watcher must
+        # not be left waiting on stop_event when this process exits or
+        # stop_event.set() blocks in the session
+        experiment_done = threading.Event()
+        def watch_stop() :
+            while not experiment_done.wait(0.05) :
+                if stop_event.is_set() :
+                    runner.request_stop()
+                    break
+        watcher = threading.Thread(target=watch_stop, daemon=True)
+        watcher.start()
+        
+        capture = None
+        if options.get('capture_dir') is not None :
+            name = ''.join( [c if c.isalnum() else '_' for c in label] )
+            fil = os.path.join( options['capture_dir'], f'{name}.cap' )
+            writer = BackgroundCaptureWriter if mode is None else CaptureWriter
+            metadata = runner.metadata( 'Pulse' if mode is None else experiment.capitalize() )
+            metadata['device'] = label
+            capture = writer(fil, metadata)
+        
+        on_batch = lambda t, v : data_q.put( ('batch', label, t, v) )
+        try :
+            if mode is None :
+                # the session keeps the samples, the worker only needs a small buffer
+                samples = SampleRingBuffer( samples_for_duration(1), wrap=True )
+                result = runner.pulse(duration=options.get('duration'), samples=samples,
+                                      capture=capture, on_batch=on_batch)
+            else :
+                result = runner.dis_charge(mode, capture=capture, on_batch=on_batch)
+        finally :
+            experiment_done.set()
+            watcher.join()
+        data_q.put( ('result', label, result.fit_result, result.metadata,
+                     result.capture_path, runner.sample_loss(), runner.clock_stats()) )
+    except Exception as e :
+        data_q.put( ('error', label, f'{type(e).__name__}: {e}') )
+    finally :
+        if uController is not None :
+            uController.disconnect()
+        if emulator is not None :
+            emulator.stop()
+        data_q.put( ('done', label) )
+
+class DeviceState() :
+    """
+    Samples and status of one device in a MultiArduinoSession.
+    """
+    def __init__(self, label, port, window=None) :
+        self.label = label
+        self.port = port # None for an emulated device
+        self.samples = SampleRingBuffer( samples_for_duration(window), wrap=True ) \
+                        if window is not None else SampleRingBuffer( samples_for_duration(60) )
+        self.status = 'starting' # starting, ready, running, finished, failed
+        self.error = None
+        self.ready_latency = None
+        self.result = None # ExperimentResult once finished
+        self.process = None
+
+class MultiArduinoSession() :
+    """
+    Connects to several Arduinos and runs an experiment on all of them in
+    parallel, one process per board.
+    Samples arrive in the process that owns the session, poll must be
+    called regularly (run does this) to move them into the per-device
+    buffers.
+    """
+    def __init__(self, ports, baud=250000, emulate=0, emulator_kwargs=None, **settings) :
+        """
+        Constructs the MultiArduinoSession class.
+
+        Parameters
+        ----------
+        ports : list of str
+            Serial ports of the Arduinos.
+        baud : int, optional
+            Baud rate. The default is 250000.
+        emulate : int, optional
+            Number of emulated Arduinos to add, see arduino_emulator.py.
+            Each emulator runs in its device's process. The default is 0.
+        emulator_kwargs : dict, optional
+            Keyword arguments for ArduinoEmulator. The default is None.
+        **settings :
+            Parameters for ExperimentRunner.configure, ex. R=2200, C=220.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.baud = baud
+        self.settings = settings
+        self.emulator_kwargs = {} if emulator_kwargs is None else emulator_kwargs
+        
+        self.ports = { port: port for port in ports } # label: port
+        for idx in range(emulate) :
+            self.ports[f'emulated-{idx}'] = None
+        
+        # spawn so the workers don't inherit the GUI's Qt state
+        self.context = multiprocessing.get_context('spawn')
+        self.devices = {}
+        self.data_q = None
+        self.start_event = None
+        self.stop_event = None
+        self.experiment = None
+        self.t_start = None
+        self.t_end = None
+    
+    @property
+    def labels(self) :
+        return list(self.ports)
+    
+    def start(self, experiment, prep=True, duration=None, capture_dir=None,
+              refine_fit=False, window=None, ready_timeout=30) :
+        """
+        Starts a worker per device and, once every device is connected and
+        configured, starts the experiment on all of them together.
+        Devices that fail to connect are marked failed and left out.
+
+        Parameters
+        ----------
+        experiment : str
+            'charge', 'discharge' or 'pulse'.
+        prep : bool, optional
+            Discharge the capacitor before a charge experiment, charge it
+            before a discharge. The default is True.
+        duration : float, optional
+            Pulse experiment duration in seconds. The default is None,
+            until stop is called.
+        capture_dir : str, optional
+            Each device writes every sample to <capture_dir>/<label>.cap.
+            The default is None.
+        refine_fit : bool, optional
+            Refine the fits with lmfit. The default is False.
+        window : float, optional
+            Keep only the most recent "window" seconds of samples per
+            device. The default is None, keep every sample.
+        ready_timeout : float, optional
+            Seconds to wait for the devices to connect and prep.
+            The default is 30.
+
+        Returns
+        -------
+        list of str
+            Labels of the devices running the experiment.
+
+        """
+        if experiment not in EXPERIMENTS :
+            raise ValueError( f'Unknown experiment "{experiment}", expected one of {EXPERIMENTS}' )
+        self.experiment = experiment
+        self.data_q = self.context.Queue()
+        self.start_event = self.context.Event()
+        self.stop_event = self.context.Event()
+        
+        options = {'prep': prep, 'duration': duration, 'capture_dir': capture_dir,
+                   'refine_fit': refine_fit, 'emulator': self.emulator_kwargs}
+        self.devices = {}
+        for label, port in self.ports.items() :
+            device = DeviceState(label, port, window)
+            device.process = self.context.Process(
+                target=_device_worker, name=f'device {label}', daemon=True,
+                args=(label, port, self.baud, self.settings, experiment, options,
+                      self.data_q, self.start_event, self.stop_event) )
+            device.process.start()
+            self.devices[label] = device
+        
+        t_limit = current_time() + ready_timeout
+        while any( [device.status == 'starting' for device in self.devices.values()] ) :
+            if current_time() > t_limit :
+                for device in self.devices.values() :
+                    if device.status == 'starting' :
+                        device.status = 'failed'
+                        device.error = 'Not ready in time'
+                break
+            self.poll(timeout=0.1)
+        
+        running = [ label for label, device in self.devices.items() if device.status == 'ready' ]
+        for label in running :
+            self.devices[label].status = 'running'
+        self.t_start = current_time()
+        self.start_event.set()
+        return running
+    
+    def poll(self, timeout=0) :
+        """
+        Moves the samples sent by the workers into the device buffers.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            Seconds to wait for the first message. The default is 0.
+
+        Returns
+        -------
+        set of str
+            Labels of the devices with new samples.
+
+        """
+        # a worker flushes its messages before exiting, check for exited
+        # workers before draining the queue so none of their messages are missed
+        exited = [ device for device in self.devices.values()
+                   if device.process is not None and device.process.exitcode is not None ]
+        
+        updated = set()
+        try :
+            msg = self.data_q.get(timeout=timeout) if timeout > 0 else self.data_q.get_nowait()
+            while True :
+                self._handle(msg, updated)
+                msg = self.data_q.get_nowait()
+        except Empty :
+            pass
+        
+        for device in exited :
+            if device.status in ['starting', 'ready', 'running'] :
+                device.status = 'failed'
+                device.error = f'Worker exited unexpectedly, exit code {device.process.exitcode}'
+        return updated
+    
+    def _handle(self, msg, updated) :
+        kind, label = msg[0], msg[1]
+        device = self.devices[label]
+        if kind == 'batch' :
+            device.samples.append( msg[2], msg[3] )
+            updated.add(label)
+        elif kind == 'ready' :
+            device.status = 'ready'
+            device.ready_latency = msg[2]
+        elif kind == 'result' :
+            _, _, fit_result, metadata, capture_path, sample_loss, clock_stats = msg
+            metadata['device'] = label
+            device.result = ExperimentResult(metadata['experiment'], device.samples.x, device.samples.y,
+                                             fit_result, metadata=metadata, capture_path=capture_path,
+                                             **sample_loss, **clock_stats)
+            device.status = 'finished'
+        elif kind == 'error' :
+            device.status = 'failed'
+            device.error = msg[2]
+        elif kind == 'done' :
+            if device.status not in ['finished', 'failed'] :
+                device.status = 'failed'
+                device.error = device.error or 'Worker ended without a result'
+            device.process.join(timeout=1)
+    
+    @property
+    def running(self) :
+        return any( [device.status in ['ready', 'running'] for device in self.devices.values()] )
+    
+    def stop(self) :
+        """
+        Ends the experiment on every device. May be called from another
+        thread, ex. a signal handler.
+        """
+        if self.stop_event is not None :
+            self.stop_event.set()
+    
+    def run(self, experiment, on_update=None, **kwargs) :
+        """
+        Runs an experiment on every device and waits for it to finish.
+
+        Parameters
+        ----------
+        experiment : str
+            'charge', 'discharge' or 'pulse'.
+        on_update : callable, optional
+            Called as on_update(session, updated_labels) after new samples
+            arrive. The default is None.
+        **kwargs :
+            Passed to start.
+
+        Returns
+        -------
+        dict
+            label: ExperimentResult of every device that finished.
+
+        """
+        self.start(experiment, **kwargs)
+        try :
+            while self.running :
+                updated = self.poll(timeout=0.1)
+                if on_update is not None and len(updated) > 0 :
+                    on_update(self, updated)
+        finally :
+            self.stop()
+            self.t_end = current_time()
+            for device in self.devices.values() :
+                device.process.join(timeout=5)
+        return self.results()
+    
+    def results(self) :
+        return { label: device.result for label, device in self.devices.items()
+                 if device.result is not None }
+    
+    def combined(self) :
+        """
+        Samples of every device in one time-ordered table.
+
+        Returns
+        -------
+        device_idx : np.ndarray
+            Index of the device in labels of each sample.
+        t : np.ndarray
+            Sample times, seconds since each device's first sample.
+        v : np.ndarray
+            Voltages.
+
+        """
+        labels = self.labels
+        parts = [ (idx, self.devices[label].samples) for idx, label in enumerate(labels)
+                  if label in self.devices ]
+        device_idx = np.concatenate( [np.full(len(samples), idx) for idx, samples in parts] + [np.empty(0, int)] )
+        t = np.concatenate( [samples.x for _, samples in parts] + [np.empty(0)] )
+        v = np.concatenate( [samples.y for _, samples in parts] + [np.empty(0)] )
+        order = np.argsort(t, kind='stable')
+        return device_idx[order], t[order], v[order]
+    
+    def throughput(self) :
+        """
+        Samples per second of each device and of the whole session.
+
+        Returns
+        -------
+        dict
+            label: samples/s, and 'total'.
+
+        """
+        t_end = self.t_end if self.t_end is not None else current_time()
+        elapsed = max( t_end - self.t_start, 1e-9 ) if self.t_start is not None else np.nan
+        rates = { label: device.samples.num_appended / elapsed for label, device in self.devices.items() }
+        rates['total'] = sum( rates.values() )
+        return rates
+    
+    def save_csv(self, fil) :
+        """
+        Saves the combined view as csv, columns: device index, time, voltage.
+
+        Parameters
+        ----------
+        fil : str
+            Path of the csv file.
+
+        Returns
+        -------
+        None.
+
+        """
+        device_idx, t, v = self.combined()
+        header = [ f"Experiment: {self.experiment}", f"Settings: {self.settings}" ]
+        header += [ f"Device {idx}: {label}" for idx, label in enumerate(self.labels) ]
+        header += [ "device,time,voltage" ]
+        with open(fil, 'w') as f :
+            np.savetxt(f, np.column_stack((device_idx, t, v)), fmt=['%d', '%.7e', '%.7e'],
+                       delimiter=',', newline='\n', header='\n'.join(header), comments='# ')
+
+def main(argv=None) :
+    parser = argparse.ArgumentParser(description='Run an experiment on several Arduinos at once.')
+    parser.add_argument('experiment', choices=EXPERIMENTS)
+    parser.add_argument('--ports', nargs='*', default=[], help='serial ports of the Arduinos')
+    parser.add_argument('-b', '--baud', type=int, default=250000, help='baud rate')
+    parser.add_argument('--emulate', type=int, default=0, metavar='N', help='add N emulated Arduinos')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='speed of the emulated Arduinos, 0 streams as fast as possible')
+    parser.add_argument('--R', type=float, default=None, help='resistance [Ohms]')
+    parser.add_argument('--C', type=float, default=None, help='capacitance [uF]')
+    parser.add_argument('--Vcc', type=float, default=None, help='supply voltage [V]')
+    parser.add_argument('--factor', type=int, default=None, help='(dis)charge duration as a multiple of R*C')
+    parser.add_argument('--pulse-ms', type=int, default=None, help='pulse duration [ms]')
+    parser.add_argument('--duty', type=int, default=None, help='pulse duty cycle [%%]')
+    parser.add_argument('--duration', type=float, default=None, help='pulse experiment duration [s], default until Ctrl-C')
+    parser.add_argument('--no-prep', action='store_true', help='do not charge/discharge the capacitors first')
+    parser.add_argument('--lmfit', action='store_true', help='refine the fits with lmfit')
+    parser.add_argument('-o', '--output', default=None, help='csv file for the combined results')
+    parser.add_argument('--capture-dir', default=None, help='directory for one capture file per device')
+    args = parser.parse_args(argv)
+    
+    if len(args.ports) == 0 and args.emulate == 0 :
+        parser.error('give --ports and/or --emulate')
+    
+    emulator_kwargs = { key: value for (key, value) in [('R', args.R), ('C', args.C), ('Vcc', args.Vcc)]
+                        if value is not None }
+    emulator_kwargs['speed'] = args.speed
+    if args.speed == 0 :
+        emulator_kwargs['baud'] = 0
+    session = MultiArduinoSession(args.ports, args.baud, emulate=args.emulate, emulator_kwargs=emulator_kwargs,
+                                  R=args.R, C=args.C, Vcc=args.Vcc, exp_dur_factor=args.factor,
+                                  pulse_duration=args.pulse_ms, pulse_duty_cycle=args.duty)
+    if args.capture_dir is not None :
+        os.makedirs(args.capture_dir, exist_ok=True)
+    
+    # Ctrl-C ends the experiment on every device, pulse experiments run until stopped
+    signal.signal( signal.SIGINT, lambda signum, frame : session.stop() )
+    results = session.run(args.experiment, prep=not args.no_prep, duration=args.duration,
+                          capture_dir=args.capture_dir, refine_fit=args.lmfit)
+    signal.signal( signal.SIGINT, signal.default_int_handler )
+    
+    rates = session.throughput()
+    for label, device in session.devices.items() :
+        line = f'{label}: {device.status}'
+        if device.error is not None :
+            line += f', {device.error}'
+        result = device.result
+        if result is not None :
+            line += ( f', {len(result.t)} samples ({rates[label]:.0f}/s), {result.dropped_samples} dropped, '
+                      f'{result.missing_samples} missing' )
+            if np.isfinite(result.clock_drift_ppm) :
+                line += f', clock drift {result.clock_drift_ppm:+.0f} ppm'
+            if result.fit_result is not None :
+                line += f', TC: {result.fit_result.tc:.4f} +/- {result.fit_result.tc_err:.4f} s'
+        print(line)
+    print( f'Total: {rates["total"]:.0f} samples/s from {len(results)} of {len(session.devices)} devices' )
+    
+    if args.output is not None :
+        session.save_csv(args.output)
+        print( f'Results written to {args.output}' )
+    return 0 if len(results) == len(session.devices) else 1
+
+if __name__ == '__main__' :
+    sys.exit( main() )
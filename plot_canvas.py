@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Matplotlib canvas used by the experiment tabs.
+Kept out of the main GUI module so matplotlib is only imported once an
+experiment tab is built.
+"""
+
+import numpy as np
+
+import matplotlib
+matplotlib.use('Qt5Agg')
+
+from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
+from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
+from matplotlib.figure import Figure
+
+from instrumentation import stage as instrument_stage
+
+class MplCanvas(FigureCanvas) :
+    """
+    """
+    def __init__(self, parent=None, width=5, height=4, dpi=100):
+        """
+
+        Parameters
+        ----------
+        parent : object, optional
+            This is for the parent object. The default is None.
+        width : int, optional
+            Sets the width of the canvas. The default is 5.
+        height : int, optional
+            Sets the height of the canvas. The default is 4.
+        dpi : int, optional
+            Sets the dpi of the canvas. The default is 100.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.fig = Figure(figsize=(width, height), dpi=dpi)
+        self.axes = self.fig.add_subplot(111)
+        super(MplCanvas, self).__init__(self.fig)
+        
+        self.live_line = None
+        self.live_text = None
+        self.live_background = None
+        self.live_x_window = None
+        self.live_draw_cid = None
+        self.instrumentation = None # optional Instrumentation, times each live draw
+    
+    def clear_axes(self) :
+        """
+        Clears the main axes and removes any secondary (twinx) axes.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.stop_live(redraw=False)
+        if self.axes not in self.fig.axes :
+            # the figure was cleared for another layout, ex. a Bode plot
+            self.fig.clear()
+            self.axes = self.fig.add_subplot(111)
+        for ax in self.fig.axes :
+            if ax is not self.axes :
+                ax.remove()
+        self.axes.cla()
+    
+    def show_message(self, text, font_size=25) :
+        """
+        Clears the canvas and displays a single message.
+
+        Parameters
+        ----------
+        text : str
+            Message to display.
+        font_size : int, optional
+            Font size of the message. The default is 25.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.clear_axes()
+        self.axes.text(0.3, 0.45, text, fontsize=font_size)
+        self.draw()
+    
+    def start_live(self, xlabel='', ylabel='', font_size=25, style='-', 
+                   label=None, xlim=(0, 1), ylim=(0, 1), x_window=None) :
+        """
+        Prepares the canvas for live plotting.
+        A single persistent line is updated with set_data and blitted on a 
+        cached background. The layout is computed once here. Full redraws 
+        only happen when the data leaves the current axes limits.
+        Must be called from the GUI thread.
+
+        Parameters
+        ----------
+        xlabel : str, optional
+            x-axis label. The default is ''.
+        ylabel : str, optional
+            y-axis label. The default is ''.
+        font_size : int, optional
+            Font size of the labels. The default is 25.
+        style : str, optional
+            Matplotlib format string of the line. The default is '-'.
+        label : str, optional
+            Legend label of the line. The default is None.
+        xlim : tuple, optional
+            Initial x-axis limits. The default is (0, 1).
+        ylim : tuple, optional
+            Initial y-axis limits. The default is (0, 1).
+        x_window : float, optional
+            Width of the scrolling x-axis window, None to grow the x-axis 
+            instead. The default is None.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.clear_axes()
+        
+        (self.live_line,) = self.axes.plot([], [], style, label=label, animated=True)
+        self.live_text = self.axes.text(0.02, 0.97, '', transform=self.axes.transAxes, 
+                                        fontsize=font_size-5, va='top', animated=True)
+        self.live_x_window = x_window
+        
+        self.axes.set_xlabel(xlabel, fontsize=font_size)
+        self.axes.set_ylabel(ylabel, fontsize=font_size)
+        self.axes.tick_params(axis='x', labelsize=font_size-2)
+        self.axes.tick_params(axis='y', labelsize=font_size-2)
+        self.axes.set_xlim(xlim)
+        self.axes.set_ylim(ylim)
+        
+        self.fig.tight_layout()
+        self.live_draw_cid = self.mpl_connect('draw_event', self._on_live_draw)
+        self.draw()
+    
+    def axes_pixel_width(self) :
+        """
+        Width of the axes in pixels, used to size plot decimation.
+
+        Returns
+        -------
+        int
+            Number of horizontal pixels.
+
+        """
+        return max( int(self.axes.bbox.width), 100 )
+    
+    def _on_live_draw(self, event) :
+        # any full redraw (resize, rescale, toolbar) invalidates the background
+        self.live_background = self.copy_from_bbox(self.fig.bbox)
+        self.axes.draw_artist(self.live_line)
+        self.axes.draw_artist(self.live_text)
+    
+    def update_live(self, x, y, text=None) :
+        """
+        Updates the live line with new data.
+        Must be called from the GUI thread, connect it to a signal when the 
+        data is produced in a worker thread.
+
+        Parameters
+        ----------
+        x : np.ndarray
+            x data to display.
+        y : np.ndarray
+            y data to display.
+        text : str, optional
+            Text shown in the upper left corner of the axes. The default is None.
+
+        Returns
+        -------
+        None.
+
+        """
+        if self.live_line is None :
+            return
+        
+        with instrument_stage(self.instrumentation, 'draw') :
+            self._draw_live(x, y, text)
+    
+    def _draw_live(self, x, y, text) :
+        self.live_line.set_data(x, y)
+        if text is not None :
+            self.live_text.set_text(text)
+        
+        if self._update_live_limits(x, y) or self.live_background is None :
+            self.draw()
+            return
+        
+        self.restore_region(self.live_background)
+        self.axes.draw_artist(self.live_line)
+        self.axes.draw_artist(self.live_text)
+        self.blit(self.fig.bbox)
+    
+    def _update_live_limits(self, x, y) :
+        if len(x) == 0 :
+            return False
+        
+        changed = False
+        (x_min, x_max) = self.axes.get_xlim()
+        x_last = x[-1]
+        if x_last > x_max :
+            if self.live_x_window is None :
+                x_max = x_min + 1.5*(x_last-x_min)
+            else :
+                x_min = x_last - 0.75*self.live_x_window
+                x_max = x_last + 0.25*self.live_x_window
+            self.axes.set_xlim([x_min, x_max])
+            changed = True
+        
+        (y_min, y_max) = self.axes.get_ylim()
+        y_lo = np.min(y)
+        y_hi = np.max(y)
+        if y_lo < y_min or y_hi > y_max :
+            margin = 0.05 * max(y_hi-y_lo, 1e-3)
+            self.axes.set_ylim([min(y_min, y_lo-margin), max(y_max, y_hi+margin)])
+            changed = True
+        
+        return changed
+    
+    def stop_live(self, redraw=True) :
+        """
+        Ends live plotting. The live line becomes a normal artist so it 
+        remains part of the figure.
+
+        Parameters
+        ----------
+        redraw : bool, optional
+            Perform a full redraw of the canvas. The default is True.
+
+        Returns
+        -------
+        None.
+
+        """
+        if self.live_draw_cid is not None :
+            self.mpl_disconnect(self.live_draw_cid)
+            self.live_draw_cid = None
+        if self.live_line is not None :
+            self.live_line.set_animated(False)
+            self.live_text.set_animated(False)
+        self.live_line = None
+        self.live_text = None
+        self.live_background = None
+        if redraw :
+            self.draw()
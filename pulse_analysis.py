@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Per cycle analysis of the pulse experiment.
+The firmware switches the pin HIGH when the experiment starts, stays HIGH
+for duty_cycle % of pulse_duration and LOW for the rest, so the cycles are
+known from the time axis alone.
+"""
+
+import math
+
+import numpy as np
+
+class PulseAnalyzer() :
+    """
+    Incremental min, max, mean and ripple of each pulse cycle.
+    Cycle k covers t_offset + k*period <= t < t_offset + (k+1)*period,
+    compared in whole microseconds as micros() counts them, so a sample on
+    an edge always starts the next cycle. Only running totals of the cycle
+    still being filled are carried between batches, each batch costs work
+    proportional to its own length. Completed cycles are kept in a ring of
+    the most recent max_cycles.
+
+    Steady state is reached when the mean over the latest "window" cycles
+    differs from the mean over the "window" cycles before them by no more
+    than steady_tol. Averaging over blocks of cycles hides the noise of
+    single cycles. The window spans at least one time constant when tc is
+    given, the mean approaches its final value exponentially with that time
+    constant. A running sum of the cycle means makes each comparison O(1).
+    """
+    def __init__(self, pulse_duration, duty_cycle, Vcc=None, tc=None, steady_tol=0.02,
+                 steady_cycles=10, max_cycles=10000, t_offset=0.) :
+        """
+        Constructs the PulseAnalyzer class.
+
+        Parameters
+        ----------
+        pulse_duration : float
+            Period of a cycle in ms, as uController.pulse_duration.
+        duty_cycle : float
+            Percent of the period the pin is HIGH.
+        Vcc : float, optional
+            Supply voltage, used for the expected steady state mean. The
+            default is None.
+        tc : float, optional
+            R*C in seconds. The default is None, the window is steady_cycles.
+        steady_tol : float, optional
+            Allowed change of the cycle mean across the window [V]. The
+            default is 0.02, about 4 adc counts at 5 V.
+        steady_cycles : int, optional
+            Minimum window length in cycles. The default is 10.
+        max_cycles : int, optional
+            Number of completed cycles kept. The default is 10000.
+        t_offset : float, optional
+            Time of the first rising edge [s]. The default is 0., the first
+            sample.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.period = pulse_duration / 1000
+        self.period_us = max( int(round(1000*pulse_duration)), 1 )
+        self.duty_cycle = duty_cycle
+        self.Vcc = Vcc
+        self.t_offset = t_offset
+        self.t_offset_us = int(round(1e6*t_offset))
+        self.steady_tol = steady_tol
+        window = steady_cycles if tc is None else max(steady_cycles, math.ceil(tc / self.period))
+        self.window = min(window, max_cycles//2 - 1) # both blocks must still be kept
+        
+        self.capacity = max_cycles
+        self.ids = np.empty(max_cycles, dtype=np.int64)
+        self.v_min = np.empty(max_cycles)
+        self.v_max = np.empty(max_cycles)
+        self.v_mean = np.empty(max_cycles)
+        self.count = np.empty(max_cycles, dtype=np.int64)
+        self.mean_cumsum = np.empty(max_cycles) # sum of the means of all cycles up to this one
+        self.reset()
+    
+    def reset(self) :
+        self.ids.fill(-1)
+        self.num_cycles = 0 # completed cycles, including those no longer kept
+        self.last_id = None
+        self.last_cumsum = 0.
+        
+        # running totals of the cycle being filled
+        self.open_id = None
+        self.open_min = np.inf
+        self.open_max = -np.inf
+        self.open_sum = 0.
+        self.open_count = 0
+        
+        self.steady = False
+        self.steady_since = None # first cycle of the current steady stretch, by cycle id
+        self._reset_steady_totals()
+    
+    def _reset_steady_totals(self) :
+        self.steady_num = 0
+        self.steady_mean_sum = 0.
+        self.steady_ripple_sum = 0.
+        self.steady_min = np.inf
+        self.steady_max = -np.inf
+    
+    @property
+    def expected_mean(self) :
+        """
+        Steady state mean of an ideal RC circuit, Vcc * duty cycle.
+        """
+        if self.Vcc is None :
+            return np.nan
+        return self.Vcc * self.duty_cycle / 100
+    
+    def cycle_start(self, cycle_id) :
+        """
+        Time of the rising edge starting a cycle [s].
+        """
+        return self.t_offset + cycle_id * self.period
+    
+    def update(self, x, v) :
+        """
+        Adds a batch of new samples.
+
+        Parameters
+        ----------
+        x : np.ndarray
+            Sample times [s], increasing and after any previous sample.
+        v : np.ndarray
+            Voltage across the capacitor.
+
+        Returns
+        -------
+        int
+            Number of cycles completed by this batch.
+
+        """
+        if len(x) == 0 :
+            return 0
+        v = np.asarray(v, dtype=float)
+        
+        # x is micros() converted to s, rounding recovers the exact integer
+        # times and avoids float error deciding which side of an edge a
+        # sample is on
+        t_us = np.rint( 1e6*np.asarray(x, dtype=float) ).astype(np.int64)
+        cycle_ids = (t_us - self.t_offset_us) // self.period_us
+        starts = np.flatnonzero( np.r_[True, cycle_ids[1:] != cycle_ids[:-1]] )
+        seg_id = cycle_ids[starts]
+        seg_min = np.minimum.reduceat(v, starts)
+        seg_max = np.maximum.reduceat(v, starts)
+        seg_sum = np.add.reduceat(v, starts)
+        seg_count = np.diff( np.r_[starts, len(v)] )
+        
+        if self.open_id is not None :
+            if seg_id[0] == self.open_id :
+                seg_min[0] = min(seg_min[0], self.open_min)
+                seg_max[0] = max(seg_max[0], self.open_max)
+                seg_sum[0] += self.open_sum
+                seg_count[0] += self.open_count
+            else :
+                # the batch starts a new cycle, the open one is complete
+                seg_id = np.r_[self.open_id, seg_id]
+                seg_min = np.r_[self.open_min, seg_min]
+                seg_max = np.r_[self.open_max, seg_max]
+                seg_sum = np.r_[self.open_sum, seg_sum]
+                seg_count = np.r_[self.open_count, seg_count]
+        
+        # the cycle of the last sample may still receive samples
+        self.open_id = int(seg_id[-1])
+        self.open_min = seg_min[-1]
+        self.open_max = seg_max[-1]
+        self.open_sum = seg_sum[-1]
+        self.open_count = int(seg_count[-1])
+        
+        num_complete = len(seg_id) - 1
+        if num_complete > 0 :
+            self._add_cycles( seg_id[:-1], seg_min[:-1], seg_max[:-1],
+                              seg_sum[:-1] / seg_count[:-1], seg_count[:-1] )
+        return num_complete
+    
+    def _add_cycles(self, ids, v_min, v_max, v_mean, count) :
+        # cycles are stored by completion order, cycle ids skip over gaps
+        seq = self.num_cycles + np.arange(len(ids))
+        cumsum = self.last_cumsum + np.cumsum(v_mean)
+        self.num_cycles += len(ids)
+        self.last_id = int(ids[-1])
+        self.last_cumsum = cumsum[-1]
+        if len(ids) > self.capacity :
+            (seq, ids, v_min, v_max, v_mean, count, cumsum) = [ arr[-self.capacity:] 
+                    for arr in (seq, ids, v_min, v_max, v_mean, count, cumsum) ]
+        
+        pos = seq % self.capacity
+        self.ids[pos] = ids
+        self.v_min[pos] = v_min
+        self.v_max[pos] = v_max
+        self.v_mean[pos] = v_mean
+        self.count[pos] = count
+        self.mean_cumsum[pos] = cumsum
+        
+        # mean of the latest window cycles against the window before, for
+        # the blocks ending at each new cycle
+        W = self.window
+        valid = (seq - 2*W >= -1) & (seq - 2*W >= self.num_cycles - self.capacity - 1)
+        mid = self._cumsum_at(seq - W)
+        drift = np.abs( (cumsum - mid) - (mid - self._cumsum_at(seq - 2*W)) ) / W
+        flags = valid & (drift <= self.steady_tol)
+        
+        if not flags[-1] :
+            self.steady = False
+            self.steady_since = None
+            self._reset_steady_totals()
+            return
+        
+        not_steady = np.flatnonzero(~flags)
+        if len(not_steady) > 0 or not self.steady :
+            # a new steady stretch starting with the blocks of its first cycle
+            first = not_steady[-1] + 1 if len(not_steady) > 0 else 0
+            first_seq = int(seq[first]) - 2*W + 1
+            self.steady = True
+            self.steady_since = int( self.ids[first_seq % self.capacity] )
+            self._reset_steady_totals()
+            self._add_steady( np.arange(first_seq, self.num_cycles) % self.capacity )
+        else :
+            self._add_steady( pos )
+    
+    def _cumsum_at(self, seq) :
+        """
+        Sum of the cycle means up to and including cycle number seq, 0 for
+        seq -1. Positions that are no longer kept are returned as is and
+        must be masked by the caller.
+        """
+        return np.where( seq >= 0, self.mean_cumsum[seq % self.capacity], 0. )
+    
+    def _add_steady(self, pos) :
+        if len(pos) == 0 :
+            return
+        self.steady_num += len(pos)
+        self.steady_mean_sum += float( self.v_mean[pos].sum() )
+        self.steady_ripple_sum += float( (self.v_max[pos] - self.v_min[pos]).sum() )
+        self.steady_min = min( self.steady_min, float(self.v_min[pos].min()) )
+        self.steady_max = max( self.steady_max, float(self.v_max[pos].max()) )
+    
+    def latest(self) :
+        """
+        Statistics of the most recently completed cycle, None before the
+        first cycle is complete.
+        """
+        if self.last_id is None :
+            return None
+        pos = (self.num_cycles - 1) % self.capacity
+        return {
+            'cycle': self.last_id,
+            't_start': self.cycle_start(self.last_id),
+            'min': self.v_min[pos],
+            'max': self.v_max[pos],
+            'mean': self.v_mean[pos],
+            'ripple': self.v_max[pos] - self.v_min[pos],
+            'samples': int(self.count[pos]),
+            }
+    
+    def steady_state(self) :
+        """
+        Statistics over every cycle of the current steady stretch, None if
+        the signal isn't steady.
+        """
+        if not self.steady or self.steady_num == 0 :
+            return None
+        return {
+            'since_cycle': self.steady_since,
+            't_start': self.cycle_start(self.steady_since),
+            'cycles': self.steady_num,
+            'mean': self.steady_mean_sum / self.steady_num,
+            'ripple': self.steady_ripple_sum / self.steady_num,
+            'min': self.steady_min,
+            'max': self.steady_max,
+            }
+    
+    def cycles(self) :
+        """
+        Every kept cycle in time order.
+
+        Returns
+        -------
+        dict of np.ndarray
+            cycle, t_start, min, max, mean, ripple and samples of each cycle.
+
+        """
+        pos = np.flatnonzero(self.ids >= 0)
+        pos = pos[ np.argsort(self.ids[pos]) ]
+        return {
+            'cycle': self.ids[pos].copy(),
+            't_start': self.cycle_start(self.ids[pos]),
+            'min': self.v_min[pos].copy(),
+            'max': self.v_max[pos].copy(),
+            'mean': self.v_mean[pos].copy(),
+            'ripple': self.v_max[pos] - self.v_min[pos],
+            'samples': self.count[pos].copy(),
+            }
+    
+    def summary_text(self) :
+        """
+        Short multi-line summary for live displays.
+        """
+        latest = self.latest()
+        if latest is None :
+            return "Cycle: waiting for the first full cycle"
+        lines = [ f"Cycle {latest['cycle']+1}: mean {latest['mean']:.3f} V, ripple {latest['ripple']:.3f} V" ]
+        steady = self.steady_state()
+        if steady is None :
+            lines.append( "Steady state: not reached" )
+        else :
+            lines.append( f"Steady since {steady['t_start']:.2f} s: mean {steady['mean']:.3f} V, "
+                          f"ripple {steady['ripple']:.3f} V" )
+            lines.append( f"Steady min/max: {steady['min']:.3f} / {steady['max']:.3f} V" )
+        if np.isfinite(self.expected_mean) :
+            lines.append( f"Ideal mean: {self.expected_mean:.3f} V" )
+        return '\n'.join(lines)
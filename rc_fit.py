@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Fits of the RC charge and discharge curves.
+"""
+
+import numpy as np
+
+def cap_charge(t, Vcc, tc, offset=0) :
+    return Vcc * (1 - np.exp(-(t-offset)/tc) )
+
+def cap_discharge(t, Vcc, tc) :
+    return Vcc * np.exp(-t/tc)
+
+def theoretical_current(t, I_max, tc, offset=0) :
+    return I_max * np.exp(-(t-offset)/tc)
+
+class RCFitResult() :
+    """
+    Results of fitting an RC charge or discharge curve.
+    Parameters not used by the model (offset for a discharge) are 0 with an
+    uncertainty of 0.
+    """
+    def __init__(self, mode, Vcc, tc, offset=0, Vcc_err=np.nan, tc_err=np.nan,
+                 offset_err=np.nan, best_fit=None, residual=None,
+                 success=True, method='gauss-newton') :
+        self.mode = mode
+        self.Vcc = Vcc
+        self.tc = tc
+        self.offset = offset
+        self.Vcc_err = Vcc_err
+        self.tc_err = tc_err
+        self.offset_err = offset_err
+        self.best_fit = best_fit
+        self.residual = residual
+        self.success = success
+        self.method = method
+    
+    @property
+    def rms_residual(self) :
+        if self.residual is None or len(self.residual) == 0 :
+            return np.nan
+        return np.sqrt( np.mean(self.residual**2) )
+    
+    def evaluate(self, t) :
+        """
+        Fitted curve at times t. best_fit only covers the finite samples
+        that were fitted.
+        """
+        t = np.asarray(t, dtype=float)
+        if self.mode == 'charge' :
+            return cap_charge(t, self.Vcc, self.tc, self.offset)
+        return cap_discharge(t, self.Vcc, self.tc)
+
+def _check_mode(mode) :
+    if mode in ['charge', 'c', 1] :
+        return 'charge'
+    if mode in ['discharge', 'd', 0] :
+        return 'discharge'
+    raise ValueError(f'Unknown fit mode: {mode}')
+
+def _model_and_jacobian(t, params, mode) :
+    if mode == 'charge' :
+        (Vcc, tc, offset) = params
+        dt = t - offset
+        e = np.exp(-dt/tc)
+        model = Vcc * (1 - e)
+        jac = np.column_stack(( 1 - e, -Vcc * e * dt / tc**2, -Vcc * e / tc ))
+    else :
+        (Vcc, tc) = params
+        e = np.exp(-t/tc)
+        model = Vcc * e
+        jac = np.column_stack(( e, Vcc * e * t / tc**2 ))
+    return model, jac
+
+def _linearized_guess(t, v, mode, tc_guess=None) :
+    """
+    Initial parameters from a weighted least-squares line through the log
+    of the exponential part of the curve.
+    """
+    v_max = np.max(v)
+    if mode == 'charge' :
+        Vcc = 1.01 * v_max
+        u = Vcc - v
+    else :
+        Vcc = v[0] if v[0] > 0 else v_max
+        u = v
+    
+    # the log amplifies noise where the exponential has decayed, skip that part
+    use = u > 0.05 * v_max
+    if np.count_nonzero(use) >= 3 and np.ptp(t[use]) > 0 :
+        # weights u^2 undo the noise amplification of the log
+        (slope, intercept) = np.polyfit(t[use], np.log(u[use]), 1, w=u[use])
+        tc = -1 / slope if slope < 0 else np.nan
+    else :
+        intercept = np.nan
+        tc = np.nan
+    
+    if not np.isfinite(tc) or tc <= 0 :
+        tc = tc_guess if tc_guess is not None else max(np.ptp(t), 1e-6) / 5
+        intercept = np.log(Vcc)
+    
+    if mode == 'charge' :
+        # intercept = ln(Vcc) + offset/tc
+        offset = tc * (intercept - np.log(Vcc))
+        return np.array([Vcc, tc, offset])
+    
+    return np.array([np.exp(intercept), tc])
+
+def fit_rc_response(t, v, mode, tc_guess=None, max_iterations=50) :
+    """
+    Fits an RC charge or discharge curve.
+    A weighted log-linear least-squares fit provides the initial parameters
+    which are then refined with Levenberg-Marquardt damped Gauss-Newton steps
+    using the analytic Jacobian. Everything is vectorized with numpy.
+        charge --> V = Vcc * (1 - exp(-(t-offset)/tc))
+        discharge --> V = Vcc * exp(-t/tc)
+
+    Parameters
+    ----------
+    t : np.ndarray
+        Sample times in seconds.
+    v : np.ndarray
+        Voltage across the capacitor.
+    mode : str
+        'charge' or 'discharge'. The dis_charge_choice values 1 and 0 are
+        also accepted.
+    tc_guess : float, optional
+        Time constant used if the linearized fit fails, ex. R*C.
+        The default is None.
+    max_iterations : int, optional
+        Maximum number of Gauss-Newton steps. The default is 50.
+
+    Returns
+    -------
+    RCFitResult
+        Fitted Vcc, tc and offset with their standard errors.
+
+    """
+    mode = _check_mode(mode)
+    t = np.asarray(t, dtype=float)
+    v = np.asarray(v, dtype=float)
+    
+    finite = np.isfinite(t) & np.isfinite(v)
+    t = t[finite]
+    v = v[finite]
+    
+    num_params = 3 if mode == 'charge' else 2
+    if len(t) <= num_params :
+        return RCFitResult(mode, np.nan, np.nan, np.nan if mode == 'charge' else 0,
+                           success=False)
+    
+    params = _linearized_guess(t, v, mode, tc_guess)
+    
+    model, jac = _model_and_jacobian(t, params, mode)
+    residual = v - model
+    ssr = residual @ residual
+    damping = 1e-3
+    # a failed step, damping running away or max_iterations all end the 
+    # loop without converging
+    converged = False
+    for _ in range(max_iterations) :
+        jtj = jac.T @ jac
+        jtr = jac.T @ residual
+        try :
+            step = np.linalg.solve( jtj + damping*np.diag(np.diag(jtj)), jtr )
+        except np.linalg.LinAlgError :
+            # flat data, ex. an already discharged capacitor, has no curvature
+            break
+        new_params = params + step
+        if new_params[1] <= 0 :
+            damping *= 10
+            continue
+        
+        new_model, new_jac = _model_and_jacobian(t, new_params, mode)
+        new_residual = v - new_model
+        new_ssr = new_residual @ new_residual
+        if new_ssr <= ssr :
+            converged = (ssr - new_ssr) <= 1e-12 * max(ssr, 1e-300)
+            (params, model, jac, residual, ssr) = (new_params, new_model, new_jac, new_residual, new_ssr)
+            damping = max(damping / 10, 1e-12)
+            if converged :
+                break
+        else :
+            damping *= 10
+            if damping > 1e12 :
+                break
+    
+    # standard errors from the covariance, s^2 * (J^T J)^-1
+    try :
+        cov = np.linalg.inv(jac.T @ jac) * ssr / (len(t) - num_params)
+        errors = np.sqrt(np.abs(np.diag(cov)))
+    except np.linalg.LinAlgError :
+        errors = np.full(num_params, np.nan)
+    
+    if mode == 'charge' :
+        return RCFitResult(mode, params[0], params[1], params[2],
+                           errors[0], errors[1], errors[2],
+                           best_fit=model, residual=residual, success=converged)
+    return RCFitResult(mode, params[0], params[1], 0, errors[0], errors[1], 0,
+                       best_fit=model, residual=residual, success=converged)
+
+def refine_with_lmfit(t, v, mode, seed, Vcc_nominal=None, tc_nominal=None) :
+    """
+    Optional refinement of a fit_rc_response result with lmfit.
+    lmfit, and with it scipy, is only imported when this is called.
+    Bounds follow the nominal circuit values when they are provided,
+    Vcc >= 0.8 Vcc_nominal and tc within 20% of tc_nominal.
+
+    Parameters
+    ----------
+    t : np.ndarray
+        Sample times in seconds.
+    v : np.ndarray
+        Voltage across the capacitor.
+    mode : str
+        'charge' or 'discharge'.
+    seed : RCFitResult
+        Initial parameters, usually from fit_rc_response.
+    Vcc_nominal : float, optional
+        Vcc set on the Arduino. The default is None.
+    tc_nominal : float, optional
+        R*C of the circuit in seconds. The default is None.
+
+    Returns
+    -------
+    RCFitResult
+        Refined fit results.
+
+    """
+    import lmfit
+    
+    mode = _check_mode(mode)
+    t = np.asarray(t, dtype=float)
+    v = np.asarray(v, dtype=float)
+    
+    params = lmfit.Parameters()
+    Vcc_min = -np.inf if Vcc_nominal is None else 0.8*Vcc_nominal
+    params.add('Vcc', value=max(seed.Vcc, Vcc_min), min=Vcc_min, vary=True)
+    if tc_nominal is None :
+        params.add('tc', value=seed.tc, min=0, vary=True)
+    else :
+        tc = min(max(seed.tc, 0.8*tc_nominal), 1.2*tc_nominal)
+        params.add('tc', value=tc, min=0.8*tc_nominal, max=1.2*tc_nominal, vary=True)
+    if mode == 'discharge' :
+        model = lmfit.Model( cap_discharge )
+    else :
+        params.add('offset', value=seed.offset, vary=True)
+        model = lmfit.Model( cap_charge )
+    
+    fit = model.fit(v, params, t=t, nan_policy='omit')
+    
+    def value_err(name) :
+        if name not in fit.params :
+            return 0, 0
+        err = fit.params[name].stderr
+        return fit.params[name].value, np.nan if err is None else err
+    
+    (Vcc, Vcc_err) = value_err('Vcc')
+    (tc, tc_err) = value_err('tc')
+    (offset, offset_err) = value_err('offset')
+    return RCFitResult(mode, Vcc, tc, offset, Vcc_err, tc_err, offset_err,
+                       best_fit=fit.best_fit, residual=v-fit.best_fit,
+                       success=fit.success, method='lmfit')
+
+class OnlineRCEstimator() :
+    """
+    Live time constant estimate, updated as samples arrive.
+    The curve is linearized about the configured Vcc,
+        charge --> ln(Vcc - V) = ln(Vcc) + offset/tc - t/tc
+        discharge --> ln(V) = ln(Vcc) - t/tc
+    and fit by weighted least squares. Only the running weighted sums are
+    kept, so each new sample costs O(1) and the estimate is available at any
+    point during the experiment.
+    """
+    def __init__(self, mode, Vcc, min_fraction=0.05) :
+        """
+        Constructs the OnlineRCEstimator class.
+
+        Parameters
+        ----------
+        mode : str
+            'charge' or 'discharge'. The dis_charge_choice values 1 and 0 are
+            also accepted.
+        Vcc : float
+            Vcc set on the Arduino.
+        min_fraction : float, optional
+            Samples within min_fraction*Vcc of their final value are ignored,
+            the log amplifies their noise. The default is 0.05.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.mode = _check_mode(mode)
+        self.Vcc = Vcc
+        self.min_fraction = min_fraction
+        
+        self.t0 = None
+        self.num_samples = 0
+        # weighted sums of 1, t, y, t^2, t*y, y^2
+        self.sums = np.zeros(6)
+    
+    def update(self, t, v) :
+        """
+        Adds a batch of samples to the estimate.
+
+        Parameters
+        ----------
+        t : np.ndarray
+            Sample times in seconds.
+        v : np.ndarray
+            Voltage across the capacitor.
+
+        Returns
+        -------
+        None.
+
+        """
+        t = np.asarray(t, dtype=float)
+        v = np.asarray(v, dtype=float)
+        if len(t) == 0 :
+            return
+        if self.t0 is None :
+            self.t0 = t[0]
+        
+        if self.mode == 'charge' :
+            u = self.Vcc - v
+        else :
+            u = v
+        use = u > self.min_fraction * self.Vcc
+        if not np.any(use) :
+            return
+        
+        t = t[use] - self.t0
+        u = u[use]
+        y = np.log(u)
+        # the noise of ln(u) scales as 1/u, weight by u^2
+        w = u**2
+        wt = w * t
+        wy = w * y
+        self.sums += ( np.sum(w), np.sum(wt), np.sum(wy), 
+                       np.sum(wt*t), np.sum(wt*y), np.sum(wy*y) )
+        self.num_samples += len(t)
+    
+    def estimate(self) :
+        """
+        Current time constant estimate.
+
+        Returns
+        -------
+        tc : float
+            Time constant in seconds, nan if not enough samples are available.
+        tc_err : float
+            Standard error of the time constant.
+
+        """
+        if self.num_samples < 3 :
+            return np.nan, np.nan
+        
+        (W, St, Sy, Stt, Sty, Syy) = self.sums
+        det = W*Stt - St**2
+        if det <= 0 :
+            return np.nan, np.nan
+        slope = (W*Sty - St*Sy) / det
+        if slope >= 0 :
+            return np.nan, np.nan
+        intercept = (Sy - slope*St) / W
+        
+        ssr = max( Syy - intercept*Sy - slope*Sty, 0 )
+        slope_var = ssr / (self.num_samples - 2) * W / det
+        
+        tc = -1 / slope
+        return tc, tc**2 * np.sqrt(slope_var)
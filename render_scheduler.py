@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Paces the live plot updates of the experiment threads from the GUI thread.
+"""
+
+import threading
+from time import perf_counter
+
+from PyQt5.QtCore import QObject, QTimer
+
+DEFAULT_MAX_FPS = 10 # frames per second while drawing is cheap
+DEFAULT_MIN_FPS = 1 # frames per second however slow drawing is
+DEFAULT_CPU_SHARE = 0.25 # fraction of the GUI thread's time spent drawing
+
+class RenderScheduler(QObject) :
+    """
+    Frame pacing for live plots.
+    A single shot QTimer in the GUI thread asks the experiment thread for a
+    frame, the experiment thread hands one over with its next batch and the
+    following tick draws it. Data arriving in between is only accumulated
+    by the experiment thread, so there is at most one frame in flight and
+    frames can't pile up behind a slow draw.
+    Progress is coalesced the same way, the latest value is delivered once
+    per tick.
+    The cost of each draw is measured and the next tick is delayed until
+    drawing uses no more than cpu_share of the GUI thread, between max_fps
+    and min_fps.
+    Must be constructed and started in the GUI thread, submit and
+    set_progress may be called from any thread.
+    """
+    def __init__(self, render=None, on_progress=None, max_fps=DEFAULT_MAX_FPS,
+                 min_fps=DEFAULT_MIN_FPS, cpu_share=DEFAULT_CPU_SHARE, parent=None) :
+        """
+        Constructs the RenderScheduler class.
+
+        Parameters
+        ----------
+        render : callable, optional
+            Called in the GUI thread as render(*frame) with each frame given
+            to submit. The default is None, progress only.
+        on_progress : callable, optional
+            Called in the GUI thread as on_progress(value) with the latest
+            value given to set_progress. The default is None.
+        max_fps : float, optional
+            Highest frame rate. The default is DEFAULT_MAX_FPS.
+        min_fps : float, optional
+            Lowest frame rate, reached when drawing is slow. The default is
+            DEFAULT_MIN_FPS.
+        cpu_share : float, optional
+            Largest fraction of time spent drawing. The default is
+            DEFAULT_CPU_SHARE.
+        parent : QObject, optional
+            Qt parent. The default is None.
+
+        Returns
+        -------
+        None.
+
+        """
+        super().__init__(parent)
+        self.render = render
+        self.on_progress = on_progress
+        self.min_interval = 1 / max_fps
+        self.max_interval = 1 / min_fps
+        self.cpu_share = cpu_share
+        
+        self.lock = threading.Lock()
+        self.frame = None # latest frame from submit, not drawn yet
+        self.frame_wanted = False # set by a tick, cleared by submit
+        self.progress = None # latest value from set_progress, not delivered yet
+        
+        self.draw_cost = 0. # smoothed seconds per draw
+        self.interval = self.min_interval # seconds from the end of a draw to the next tick
+        self.frames_drawn = 0
+        
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self._tick)
+    
+    @property
+    def fps(self) :
+        """
+        Current frame rate limit.
+        """
+        return 1 / (self.interval + self.draw_cost)
+    
+    def start(self) :
+        self.frame_wanted = self.render is not None
+        self.timer.start(0)
+    
+    def stop(self) :
+        """
+        Stops the timer. Pending progress is delivered, a pending frame is
+        dropped as a full redraw normally follows.
+        """
+        self.timer.stop()
+        with self.lock :
+            self.frame = None
+            self.frame_wanted = False
+            progress, self.progress = self.progress, None
+        if progress is not None and self.on_progress is not None :
+            self.on_progress( progress )
+    
+    def wants_frame(self) :
+        """
+        True if the next tick has no frame to draw yet. Frames are expensive
+        to build, the experiment thread checks this before building one.
+        """
+        return self.frame_wanted
+    
+    def submit(self, *frame) :
+        """
+        Hands over the arguments of the next render call.
+        """
+        with self.lock :
+            self.frame = frame
+            self.frame_wanted = False
+    
+    def set_progress(self, value) :
+        self.progress = value
+    
+    def _tick(self) :
+        with self.lock :
+            frame, self.frame = self.frame, None
+            progress, self.progress = self.progress, None
+        
+        if progress is not None and self.on_progress is not None :
+            self.on_progress( progress )
+        
+        if frame is not None :
+            t_start = perf_counter()
+            self.render( *frame )
+            cost = perf_counter() - t_start
+            # slower draws are followed at once, faster ones are averaged in so
+            # the frame rate recovers gradually after ex. a rescale
+            self.draw_cost = cost if cost > self.draw_cost else 0.7*self.draw_cost + 0.3*cost
+            self.frames_drawn += 1
+            # cost / (cost + interval) <= cpu_share
+            interval = self.draw_cost * (1/self.cpu_share - 1)
+            self.interval = min( max(interval, self.min_interval), self.max_interval )
+        
+        if self.render is not None :
+            self.frame_wanted = True
+        self.timer.start( int(1000*self.interval) )
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Preallocated numpy buffers for acquired samples.
+"""
+
+import numpy as np
+
+def samples_for_duration(duration, sample_period=1e-3, margin=1.1) :
+    """
+    Number of samples the Arduino sends over a duration of time.
+
+    Parameters
+    ----------
+    duration : float
+        Duration in seconds, ex. exp_dur_factor * R * C or display_dur.
+    sample_period : float, optional
+        Time between samples in seconds. The default is 1e-3.
+    margin : float, optional
+        Fractional head room for timing jitter. The default is 1.1.
+
+    Returns
+    -------
+    int
+        Number of samples.
+
+    """
+    return max( int(np.ceil(margin * duration / sample_period)), 1 )
+
+class SampleRingBuffer() :
+    """
+    Preallocated (time, voltage) sample storage.
+    Samples are stored as float64 pairs, 16 bytes per sample, in a single
+    (N, 2) array so views can be plotted or saved without copying.
+
+    wrap=False : The buffer grows, doubling its capacity, when full. Every
+                 sample appended is kept.
+    wrap=True  : Only the most recent "capacity" samples are kept. Each
+                 sample is written twice, at i and i+capacity, so the most
+                 recent samples are always a contiguous view.
+    """
+    def __init__(self, capacity, wrap=False) :
+        """
+        Constructs the SampleRingBuffer class.
+
+        Parameters
+        ----------
+        capacity : int
+            Number of samples to preallocate.
+        wrap : bool, optional
+            Overwrite the oldest samples once full. The default is False.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.capacity = max( int(capacity), 1 )
+        self.wrap = wrap
+        
+        num_rows = 2*self.capacity if self.wrap else self.capacity
+        self.data = np.empty( (num_rows, 2) )
+        
+        self.num_appended = 0 # total number of samples ever appended
+    
+    def __len__(self) :
+        if self.wrap :
+            return min( self.num_appended, self.capacity )
+        return self.num_appended
+    
+    def clear(self) :
+        self.num_appended = 0
+    
+    def append(self, x, y) :
+        """
+        Appends a batch of samples.
+
+        Parameters
+        ----------
+        x : np.ndarray
+            Sample times.
+        y : np.ndarray
+            Sample voltages.
+
+        Returns
+        -------
+        None.
+
+        """
+        x = np.asarray(x, dtype=float).ravel()
+        y = np.asarray(y, dtype=float).ravel()
+        num_new = len(x)
+        if num_new == 0 :
+            return
+        
+        if not self.wrap :
+            num_needed = self.num_appended + num_new
+            if num_needed > self.capacity :
+                self.capacity = max( 2*self.capacity, num_needed )
+                data = np.empty( (self.capacity, 2) )
+                data[:self.num_appended] = self.data[:self.num_appended]
+                self.data = data
+            self.data[self.num_appended:num_needed, 0] = x
+            self.data[self.num_appended:num_needed, 1] = y
+            self.num_appended = num_needed
+            return
+        
+        # only the most recent "capacity" samples can be kept
+        skipped = max( num_new - self.capacity, 0 )
+        x = x[skipped:]
+        y = y[skipped:]
+        idx = (self.num_appended + skipped + np.arange(len(x))) % self.capacity
+        self.data[idx, 0] = x
+        self.data[idx, 1] = y
+        self.data[idx+self.capacity, 0] = x
+        self.data[idx+self.capacity, 1] = y
+        self.num_appended += num_new
+    
+    def view(self, num_samples=None) :
+        """
+        Zero-copy view of the most recent samples in time order.
+
+        Parameters
+        ----------
+        num_samples : int, optional
+            Number of samples to return. The default is None, all stored samples.
+
+        Returns
+        -------
+        np.ndarray
+            (n, 2) array, column 0 is time and column 1 is voltage.
+
+        """
+        num_stored = len(self)
+        if num_samples is None or num_samples > num_stored :
+            num_samples = num_stored
+        num_samples = max( int(num_samples), 0 )
+        
+        if not self.wrap :
+            return self.data[num_stored-num_samples:num_stored]
+        
+        end = self.num_appended % self.capacity + self.capacity
+        return self.data[end-num_samples:end]
+    
+    @property
+    def x(self) :
+        return self.view()[:,0]
+    
+    @property
+    def y(self) :
+        return self.view()[:,1]
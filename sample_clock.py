@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Converts the firmware's micros() timestamps into an experiment time axis.
+micros() is a uint32 and wraps every 2**32 us, about 71.6 minutes, so long
+pulse experiments need the counter unwrapped before it can be used as time.
+"""
+
+from collections import deque
+
+import numpy as np
+
+MICROS_WRAP = 2**32 # micros() wraps back to 0 after this many us
+
+class SampleClock() :
+    """
+    Streaming timestamp stage.
+    Each batch of raw micros() values is unwrapped, checked for gaps larger
+    than the sample period and converted to seconds since the first sample.
+    Everything is vectorized over the batch, state carried between batches
+    is the last timestamp and the number of wraps so far.
+    The device clock rate is estimated against host time from the arrival
+    time of each batch.
+    """
+    def __init__(self, sample_period=1e-3, gap_tolerance=0.5, max_gaps=1000) :
+        """
+        Constructs the SampleClock class.
+
+        Parameters
+        ----------
+        sample_period : float, optional
+            Time between samples in seconds. The default is 1e-3, as the
+            firmware.
+        gap_tolerance : float, optional
+            A delta longer than (1 + gap_tolerance) * sample_period is a
+            gap. The default is 0.5.
+        max_gaps : int, optional
+            Number of most recent gaps kept in gaps. The default is 1000.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.sample_period_us = 1e6 * sample_period
+        self.gap_threshold_us = (1 + gap_tolerance) * self.sample_period_us
+        self.gaps = deque(maxlen=max_gaps) # (start [s], duration [s], missing samples)
+        self.reset()
+    
+    def reset(self) :
+        """
+        Forgets all state, the next sample starts a new time axis.
+        """
+        self.t0_us = None # unwrapped micros() of the first sample
+        self.last_raw = None
+        self.last_us = None
+        self.num_wraps = 0
+        self.num_samples = 0
+        self.num_gaps = 0
+        self.missing_samples = 0
+        self.gaps.clear()
+        self.sync_first = None # (host time, device time) of the first batch
+        self.sync_last = None # (host time, device time) of the latest batch
+    
+    def process(self, t_raw, t_host=None) :
+        """
+        Converts a batch of micros() timestamps.
+
+        Parameters
+        ----------
+        t_raw : np.ndarray
+            micros() of each sample, uint32 or the same values as floats.
+        t_host : float, optional
+            Host time the batch arrived, ex. time.time(), used to estimate
+            the device clock rate. The default is None.
+
+        Returns
+        -------
+        np.ndarray
+            Seconds since the first sample.
+
+        """
+        raw = np.asarray(t_raw, dtype=np.float64)
+        if len(raw) == 0 :
+            return np.empty(0)
+        
+        # a large backwards step is a wrap, counted cumulatively over the batch
+        prev_raw = raw[0] if self.last_raw is None else self.last_raw
+        wrapped = np.diff(raw, prepend=prev_raw) < -MICROS_WRAP/2
+        wraps = self.num_wraps + np.cumsum(wrapped)
+        t_us = raw + MICROS_WRAP * wraps
+        self.num_wraps = int(wraps[-1])
+        self.last_raw = raw[-1]
+        
+        if self.t0_us is None :
+            self.t0_us = t_us[0]
+        
+        prev_us = t_us[0] if self.last_us is None else self.last_us
+        dt = np.diff(t_us, prepend=prev_us)
+        gap_idx = np.flatnonzero( dt > self.gap_threshold_us )
+        if gap_idx.size > 0 :
+            missing = np.maximum( np.rint(dt[gap_idx] / self.sample_period_us).astype(np.int64) - 1, 0 )
+            self.missing_samples += int( missing.sum() )
+            self.num_gaps += gap_idx.size
+            starts = (t_us[gap_idx] - dt[gap_idx] - self.t0_us) / 1e6
+            self.gaps.extend( zip(starts.tolist(), (dt[gap_idx]/1e6).tolist(), missing.tolist()) )
+        self.last_us = t_us[-1]
+        self.num_samples += len(raw)
+        
+        x = (t_us - self.t0_us) / 1e6
+        if t_host is not None :
+            self.sync_last = (t_host, x[-1])
+            if self.sync_first is None :
+                self.sync_first = self.sync_last
+        return x
+    
+    @property
+    def clock_rate(self) :
+        """
+        Device seconds per host second, nan until the batches span 1 s.
+        The arrival time of a batch includes the serial latency, the
+        estimate improves as the run gets longer.
+        """
+        if self.sync_first is None :
+            return np.nan
+        host_span = self.sync_last[0] - self.sync_first[0]
+        if host_span < 1 :
+            return np.nan
+        return (self.sync_last[1] - self.sync_first[1]) / host_span
+    
+    @property
+    def clock_drift_ppm(self) :
+        """
+        Device clock error relative to the host in parts per million.
+        """
+        return 1e6 * (self.clock_rate - 1)
+    
+    @property
+    def duration(self) :
+        """
+        Seconds from the first to the latest sample.
+        """
+        if self.t0_us is None :
+            return 0.
+        return (self.last_us - self.t0_us) / 1e6
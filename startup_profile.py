@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Records how long each phase of the GUI start up takes so the time until the
+window is usable can be tracked.
+Only the standard library is used so this can be imported before anything
+else.
+"""
+
+import json
+from time import perf_counter
+
+class StartupProfile() :
+    """
+    Phase timer for the start up of the GUI.
+    Each call to mark closes the current phase, the phases are consecutive
+        and sum to the total time since the profile was created.
+    Work that is done later, ex. building a tab when it is first shown, is
+        recorded separately with record so it does not count towards start up.
+    """
+    def __init__(self) :
+        """
+        Constructs the StartupProfile class and starts the clock.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.t_start = perf_counter()
+        self.t_last = self.t_start
+        self.phases = [] # [ (name, duration) ], consecutive start up phases
+        self.deferred = [] # [ (name, duration) ], work done after start up
+        self.milestones = {} # name: time since start
+    
+    def mark(self, phase, milestone=None) :
+        """
+        Ends the current phase.
+
+        Parameters
+        ----------
+        phase : str
+            Name of the phase that just completed.
+        milestone : str, optional
+            If provided, the current time since the start is also stored
+            under this name, ex. "window shown". The default is None.
+
+        Returns
+        -------
+        duration : float
+            Duration of the phase in seconds.
+
+        """
+        now = perf_counter()
+        duration = now - self.t_last
+        self.phases.append( (phase, duration) )
+        self.t_last = now
+        if milestone is not None :
+            self.milestones[milestone] = now - self.t_start
+        return duration
+    
+    def record(self, name, duration) :
+        """
+        Records work done outside of the start up sequence.
+
+        Parameters
+        ----------
+        name : str
+            Name of the work, ex. "build Pulse Experiment tab".
+        duration : float
+            Duration in seconds.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.deferred.append( (name, duration) )
+    
+    @property
+    def total(self) :
+        """
+        Time from the start of the profile to the end of the last phase.
+        """
+        return self.t_last - self.t_start
+    
+    def as_dict(self) :
+        """
+        Returns the profile as a json serializable dictionary, times in ms.
+        """
+        return {
+            'phases_ms': { name: 1000*dur for name, dur in self.phases },
+            'milestones_ms': { name: 1000*t for name, t in self.milestones.items() },
+            'deferred_ms': { name: 1000*dur for name, dur in self.deferred },
+            'total_ms': 1000*self.total,
+            }
+    
+    def report(self) :
+        """
+        Returns a human readable table of the phases.
+        """
+        width = max( [len(name) for name, _ in self.phases + self.deferred] + [len('total')] )
+        lines = ["Start up time:"]
+        for name, dur in self.phases :
+            lines.append( f"    {name:<{width}}  {1000*dur:8.1f} ms" )
+        lines.append( f"    {'total':<{width}}  {1000*self.total:8.1f} ms" )
+        for name, t in self.milestones.items() :
+            lines.append( f"    {name} after {1000*t:.1f} ms" )
+        if len(self.deferred) > 0 :
+            lines.append("Deferred:")
+            for name, dur in self.deferred :
+                lines.append( f"    {name:<{width}}  {1000*dur:8.1f} ms" )
+        return "\n".join(lines)
+    
+    def save(self, fil) :
+        """
+        Writes the profile to a json file.
+
+        Parameters
+        ----------
+        fil : str
+            File to write.
+
+        Returns
+        -------
+        None.
+
+        """
+        with open(fil, 'w') as f :
+            json.dump( self.as_dict(), f, indent=2 )
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of the serial protocol handling in Arduino.py, against stand-ins for
+the serial port.
+"""
+
+import numpy as np
+
+from Arduino import Arduino, parse_sample_lines, FRAME_DTYPE, END_FRAME_ADC, SERIAL_RX_BUFFER
+from arduino_controller import arduino
+
+class FirmwareSerial() :
+    """
+    Answers set ("x;value") commands with "1" and get commands with their
+    stored value, as the firmware does. Commands in "drop" go unanswered
+    the first time they are sent, commands in "nack" are always refused and
+    commands in "unknown" are never answered, as by older firmware.
+    """
+    def __init__(self, drop=(), nack=(), unknown=()) :
+        self.values = {}
+        self.drop = set(drop)
+        self.nack = set(nack)
+        self.unknown = set(unknown)
+        self.rx = b''
+        self.writes = []
+        self.timeout = 1
+    
+    def write(self, data) :
+        self.writes.append( data )
+        for cmd in data.decode('utf-8').split('/')[:-1] :
+            if cmd in self.drop :
+                self.drop.remove(cmd)
+                continue
+            if cmd in self.unknown :
+                continue
+            if cmd in self.nack :
+                self.rx += b'0\r\n'
+            elif ';' in cmd :
+                (name, value) = cmd.split(';')
+                self.values[name] = value
+                self.rx += b'1\r\n'
+            else :
+                self.rx += self.values.get(cmd, '0').encode('utf-8') + b'\r\n'
+    
+    def readline(self) :
+        # b'' once nothing is left, as a read timing out
+        idx = self.rx.find(b'\n') + 1
+        (line, self.rx) = (self.rx[:idx], self.rx[idx:]) if idx > 0 else (self.rx, b'')
+        return line
+    
+    def reset_input_buffer(self) :
+        self.rx = b''
+
+class ChunkedSerial() :
+    """
+    Delivers a fixed byte stream in chunks of at most chunk_size bytes per
+    read, so frames and lines are split across reads.
+    """
+    def __init__(self, data, chunk_size) :
+        self.data = data
+        self.chunk_size = chunk_size
+    
+    @property
+    def in_waiting(self) :
+        return min( len(self.data), self.chunk_size )
+    
+    def read(self, size) :
+        size = min( size, self.chunk_size )
+        (chunk, self.data) = (self.data[:size], self.data[size:])
+        return chunk
+
+def attached(serial) :
+    board = Arduino(eol='/')
+    board.arduino = serial
+    return board
+
+def test_transact_matches_responses_in_order() :
+    serial = FirmwareSerial()
+    board = attached(serial)
+    cmds = [f'f;{1000+idx}.000' for idx in range(12)] + ['f', 'h;2.2e-5', 'i']
+    serial.values['i'] = '22.00'
+    results = board.transact(cmds)
+    
+    assert all( success for (success, _) in results )
+    assert results[0] == (True, '1')
+    assert results[12] == (True, '1011.000')
+    assert results[14] == (True, '22.00')
+    # pipelined in writes that fit the firmware's receive buffer
+    assert 1 < len(serial.writes) < len(cmds)
+    assert all( len(data) <= SERIAL_RX_BUFFER for data in serial.writes )
+
+def test_transact_resends_write_with_missing_response() :
+    serial = FirmwareSerial(drop=['h;2.2e-5'])
+    board = attached(serial)
+    results = board.transact(['f;2200', 'h;2.2e-5', 'l;5'])
+    
+    assert results == [(True, '1')] * 3
+    # the failed write is resent one command per write
+    assert serial.writes[1:] == [b'f;2200/', b'h;2.2e-5/', b'l;5/']
+
+def test_transact_reports_refused_commands() :
+    serial = FirmwareSerial(nack=['l;0'])
+    board = attached(serial)
+    results = board.transact(['f;2200', 'l;0'], attempts=3)
+    
+    assert results == [(True, '1'), (False, '0')]
+    # only the refused command is sent again
+    assert serial.writes[1:] == [b'l;0/', b'l;0/']
+
+def test_transact_without_connection() :
+    assert Arduino(eol='/').transact(['f;2200', 'g']) == [(False, None), (False, None)]
+
+def frames_bytes(t, adc) :
+    frames = np.empty( len(t), dtype=FRAME_DTYPE )
+    frames['t'] = t
+    frames['adc'] = adc
+    return frames.tobytes()
+
+def test_wait_until_ready_probes_after_boot() :
+    serial = FirmwareSerial()
+    serial.values['test_connection'] = 'good_connection'
+    board = attached(serial)
+    latency = board.wait_until_ready(deadline=1.0, probe_after=0.05)
+    
+    # a board without the banner is only probed once a reset would have finished
+    assert latency >= 0.05
+    assert serial.writes == [b'test_connection/']
+    assert serial.timeout == 1
+
+def test_parameter_dump_probed_once() :
+    serial = FirmwareSerial(unknown=['C'])
+    serial.values.update( {'k': '5.00', 'g': '2200.00', 'i': '100.00', 'm': '5', 's': '50', 'u': '50'} )
+    controller = arduino()
+    controller.serial = attached(serial)
+    
+    assert controller.update_all_parameters(force=True)
+    assert controller.dump_supported is False
+    assert (controller.R, controller.pulse_duration) == (2200., 50)
+    assert controller.update_all_parameters(force=True)
+    # a single "C" attempt, later refreshes read the parameters one at a time
+    assert sum( data.count(b'C/') for data in serial.writes ) == 1
+    assert serial.timeout == 1
+
+def test_stream_frames_across_split_reads() :
+    t = 1000 * np.arange(50) + 2**32 - 20000
+    adc = np.arange(50) * 20
+    data = frames_bytes(t % 2**32, adc) + frames_bytes([0], [END_FRAME_ADC]) + b'garbage'
+    # 7 byte reads never line up with the 6 byte frames
+    board = attached( ChunkedSerial(data, 7) )
+    
+    (t_all, adc_all, ended) = ([], [], False)
+    while not ended :
+        (t_read, adc_read, ended) = board.stream_frames()
+        t_all.append(t_read)
+        adc_all.append(adc_read)
+    
+    np.testing.assert_array_equal( np.concatenate(t_all), t % 2**32 )
+    np.testing.assert_array_equal( np.concatenate(adc_all), adc )
+    assert board.frame_buffer == b''
+
+def test_stream_frames_max_frames() :
+    data = frames_bytes(np.arange(10), np.arange(10)) + frames_bytes([10], [END_FRAME_ADC])
+    board = attached( ChunkedSerial(data, len(data)) )
+    
+    (t, adc, ended) = board.stream_frames(max_frames=4)
+    np.testing.assert_array_equal( t, np.arange(4) )
+    assert not ended
+    (t, adc, ended) = board.stream_frames()
+    np.testing.assert_array_equal( adc, np.arange(4, 10) )
+    assert ended
+
+def test_reader_reports_failure() :
+    class UnpluggedSerial(ChunkedSerial) :
+        timeout = 0
+        def read(self, size) :
+            if len(self.data) == 0 :
+                raise OSError('device disconnected')
+            return super().read(size)
+    
+    board = attached( UnpluggedSerial(frames_bytes(np.arange(10), np.arange(10)), 12) )
+    assert board.start_reader(binary=True)
+    (t_all, ended) = ([], False)
+    while not ended :
+        (t, adc, ended) = board.read_batches(timeout=1)
+        t_all.append(t)
+    board.stop_reader()
+    
+    # the samples read before the failure are delivered, then the stream ends
+    np.testing.assert_array_equal( np.concatenate(t_all), np.arange(10) )
+    assert isinstance(board.reader_error, OSError)
+
+def test_parse_sample_lines_across_split_buffers() :
+    t = 1000 * np.arange(200)
+    v = np.round( 5 * (1 - np.exp(-np.arange(200)/50)), 2 )
+    data = b''.join([ b'%d,%.2f\r\n' % (ti, vi) for (ti, vi) in zip(t, v) ]) + b'end\r\n1.00\r\n'
+    
+    (t_all, v_all, remainder, ended) = ([], [], b'', False)
+    for start in range(0, len(data), 13) :
+        (t_read, v_read, ended, remainder) = parse_sample_lines( remainder + data[start:start+13] )
+        t_all.append(t_read)
+        v_all.append(v_read)
+        if ended :
+            break
+    
+    assert ended
+    np.testing.assert_array_equal( np.concatenate(t_all), t )
+    np.testing.assert_allclose( np.concatenate(v_all), v )
+    # bytes after "end" are handed back
+    assert remainder.startswith(b'1.0')
+
+def test_parse_sample_lines_skips_corrupted_lines() :
+    (t, v, ended, remainder) = parse_sample_lines( b'0,1.00\r\n1000,1.0x\r\n\r\n2000,1.20\r\n30' )
+    
+    np.testing.assert_array_equal( t, [0, 2000] )
+    np.testing.assert_array_equal( v, [1.0, 1.2] )
+    assert not ended and remainder == b'30'
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of decimation.py.
+"""
+
+import numpy as np
+
+from decimation import minmax_decimate, MinMaxDecimator
+
+def test_minmax_keeps_extremes_in_time_order() :
+    x = np.array([0, 0.25, 0.5, 0.75, 1.5])
+    y = np.array([1, 5, -2, 0, 3], dtype=float)
+    x_dec, y_dec = minmax_decimate(x, y, bucket_width=1.)
+    
+    # [1, 5, -2, 0] --> max at 0.25 then min at 0.5, a single sample is one point
+    np.testing.assert_array_equal( x_dec, [0.25, 0.5, 1.5] )
+    np.testing.assert_array_equal( y_dec, [5, -2, 3] )
+
+def test_incremental_matches_one_pass() :
+    rng = np.random.default_rng(1)
+    x = np.cumsum( rng.uniform(0.5e-3, 1.5e-3, 5000) )
+    y = rng.normal(size=len(x))
+    
+    decimator = MinMaxDecimator(bucket_width=0.01)
+    splits = np.sort( rng.choice(np.arange(1, len(x)), 40, replace=False) )
+    for (start, end) in zip(np.r_[0, splits], np.r_[splits, len(x)]) :
+        decimator.add(x[start:end], y[start:end])
+    
+    x_inc, y_inc = decimator.get_points()
+    x_all, y_all = minmax_decimate(x, y, 0.01)
+    np.testing.assert_array_equal( x_inc, x_all )
+    np.testing.assert_array_equal( y_inc, y_all )
+
+def test_max_buckets_scrolls() :
+    x = 0.1 * np.arange(1000)
+    decimator = MinMaxDecimator(bucket_width=1., max_buckets=10)
+    for start in range(0, 1000, 37) :
+        decimator.add(x[start:start+37], np.sin(x[start:start+37]))
+    
+    x_dec, y_dec = decimator.get_points()
+    # the last 10 complete buckets and the open one
+    assert x_dec[0] >= 89. and x_dec[-1] == x[-1]
+    x_min, _ = decimator.get_points(x_min=95.)
+    assert x_min[0] >= 95.
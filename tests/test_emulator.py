@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Round trip through the host stack against the emulated Arduino.
+"""
+
+import sys
+
+import numpy as np
+import pytest
+
+pytestmark = pytest.mark.skipif(sys.platform == 'win32', reason='the emulator needs a pseudo-terminal')
+
+from arduino_controller import arduino
+from experiment_runner import ExperimentRunner
+from frequency_sweep import FrequencySweep
+
+@pytest.fixture
+def emulator() :
+    from arduino_emulator import ArduinoEmulator
+    emulator = ArduinoEmulator(R=2200, C=22, Vcc=5., noise=0.005, speed=0, baud=0, seed=4)
+    emulator.start()
+    yield emulator
+    emulator.stop()
+
+def test_connect_configure_charge(emulator) :
+    uController = arduino(emulator.port)
+    assert uController.connect()
+    try :
+        runner = ExperimentRunner(uController)
+        assert runner.configure(R=2200, C=22, Vcc=5., exp_dur_factor=5)
+        # the parameters were read back from the firmware
+        assert (uController.R, uController.C, uController.Vcc, uController.exp_dur_factor) == (2200, 22, 5, 5)
+        
+        runner.prep(charged=False)
+        result = runner.charge()
+    finally :
+        uController.disconnect()
+    
+    tc = 2200 * 22e-6
+    assert len(result.t) == pytest.approx(5*tc / 1e-3, abs=2)
+    assert np.all( np.diff(result.t) > 0 )
+    assert result.dropped_samples == 0 and result.missing_samples == 0
+    assert result.fit_result.success
+    assert result.fit_result.tc == pytest.approx(tc, rel=0.02)
+    assert result.fit_result.Vcc == pytest.approx(5., abs=0.05)
+
+def test_frequency_sweep(emulator) :
+    uController = arduino(emulator.port)
+    assert uController.connect()
+    try :
+        runner = ExperimentRunner(uController)
+        assert runner.configure(R=2200, C=22, Vcc=5.)
+        sweep = FrequencySweep(runner, [100, 20, 10])
+        
+        def on_step(step) :
+            if len(sweep.steps) == 2 :
+                sweep.request_stop()
+        steps = sweep.run(on_step=on_step)
+    finally :
+        uController.disconnect()
+    
+    # stopped after the second step
+    assert [ step.pulse_duration for step in steps ] == [100, 20]
+    for step in steps :
+        assert step.steady
+        H_ideal = sweep.theoretical_response(step.frequency)
+        assert step.gain_db == pytest.approx(20*np.log10(np.abs(H_ideal)), abs=0.5)
+        assert step.phase_deg == pytest.approx(np.degrees(np.angle(H_ideal)), abs=2)
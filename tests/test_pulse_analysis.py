@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of pulse_analysis.py.
+"""
+
+import numpy as np
+
+from pulse_analysis import PulseAnalyzer
+from sample_clock import SampleClock
+
+def rc_pulse(num_samples, pulse_ms=20, duty_cycle=50, Vcc=5., tc=0.01, dt_us=1000) :
+    """
+    Capacitor voltage sampled every dt_us while a square wave drives the RC circuit.
+    """
+    t_us = dt_us * np.arange(num_samples)
+    pin = (t_us % (1000*pulse_ms)) < 10*pulse_ms*duty_cycle
+    v = np.empty(num_samples)
+    decay = np.exp(-dt_us/1e6 / tc)
+    level = 0.
+    for (idx, high) in enumerate(pin) :
+        level = Vcc*high + (level - Vcc*high) * decay
+        v[idx] = level
+    return t_us / 1e6, v
+
+def feed(analyzer, x, v, splits) :
+    for (start, end) in zip(np.r_[0, splits], np.r_[splits, len(x)]) :
+        analyzer.update(x[start:end], v[start:end])
+
+def test_batches_match_one_pass() :
+    (x, v) = rc_pulse(4000)
+    one_pass = PulseAnalyzer(20, 50, Vcc=5., tc=0.01)
+    one_pass.update(x, v)
+    
+    rng = np.random.default_rng(2)
+    batched = PulseAnalyzer(20, 50, Vcc=5., tc=0.01)
+    feed( batched, x, v, np.sort(rng.choice(np.arange(1, len(x)), 150, replace=False)) )
+    
+    expected = one_pass.cycles()
+    result = batched.cycles()
+    for key in expected :
+        np.testing.assert_allclose( result[key], expected[key] )
+    (expected, result) = (one_pass.steady_state(), batched.steady_state())
+    assert result.keys() == expected.keys()
+    for key in expected :
+        assert np.isclose( result[key], expected[key] )
+
+def test_ring_keeps_latest_cycles() :
+    (x, v) = rc_pulse(20*200)
+    analyzer = PulseAnalyzer(20, 50, steady_cycles=5, max_cycles=50)
+    feed( analyzer, x, v, np.arange(333, len(x), 333) )
+    
+    # the last cycle is still open
+    assert analyzer.num_cycles == 199
+    cycles = analyzer.cycles()
+    np.testing.assert_array_equal( cycles['cycle'], np.arange(149, 199) )
+    assert analyzer.latest()['cycle'] == 198
+    np.testing.assert_allclose( cycles['t_start'], 0.02*np.arange(149, 199) )
+
+def test_steady_state_of_rc_circuit() :
+    (x, v) = rc_pulse(20*300, duty_cycle=25)
+    analyzer = PulseAnalyzer(20, 25, Vcc=5., tc=0.01, steady_cycles=5)
+    analyzer.update(x, v)
+    
+    steady = analyzer.steady_state()
+    assert steady is not None
+    # the exponential settles within a few cycles of tc = half a cycle
+    assert steady['since_cycle'] < 20
+    assert steady['cycles'] == analyzer.num_cycles - steady['since_cycle']
+    # the mean of the sampled cycle is close to Vcc * duty cycle
+    assert abs( steady['mean'] - analyzer.expected_mean ) < 0.1
+    assert steady['min'] < steady['mean'] < steady['max']
+
+def test_samples_on_edges_start_the_next_cycle() :
+    # 1 ms samples land exactly on every edge of a 20 ms period
+    raw = (2**32 - 3_000_000 + 1000*np.arange(20*250)) % 2**32
+    x = SampleClock().process(raw)
+    analyzer = PulseAnalyzer(20, 50)
+    feed( analyzer, x, np.ones(len(x)), np.arange(777, len(x), 777) )
+    
+    cycles = analyzer.cycles()
+    assert len(cycles['cycle']) == 249
+    np.testing.assert_array_equal( cycles['samples'], 20 )
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of rc_fit.py.
+"""
+
+import numpy as np
+import pytest
+
+from rc_fit import cap_charge, cap_discharge, fit_rc_response
+
+@pytest.mark.parametrize('mode', ['charge', 'discharge'])
+def test_fit_recovers_parameters(mode) :
+    rng = np.random.default_rng(3)
+    t = 1e-3 * np.arange(1500)
+    if mode == 'charge' :
+        v = cap_charge(t, 4.95, 0.3, offset=0.01)
+    else :
+        v = cap_discharge(t, 4.95, 0.3)
+    v = v + rng.normal(0, 0.01, len(t))
+    result = fit_rc_response(t, v, mode)
+    
+    assert result.success
+    assert abs(result.Vcc - 4.95) < 5 * result.Vcc_err
+    assert abs(result.tc - 0.3) < 5 * result.tc_err
+    assert result.tc_err < 1e-3
+    assert len(result.best_fit) == len(t)
+    assert result.rms_residual == pytest.approx(0.01, rel=0.1)
+
+def test_fit_ignores_non_finite_samples() :
+    t = 1e-3 * np.arange(500)
+    v = cap_discharge(t, 5., 0.1)
+    v[::50] = np.nan
+    result = fit_rc_response(t, v, 0)
+    
+    assert result.success
+    assert result.tc == pytest.approx(0.1, rel=1e-6)
+    assert len(result.best_fit) == np.count_nonzero( np.isfinite(v) )
+    # the model covers every sample time
+    np.testing.assert_allclose( result.evaluate(t), cap_discharge(t, 5., 0.1), rtol=1e-6 )
+
+def test_fit_too_few_samples() :
+    result = fit_rc_response([0, 1e-3, 2e-3], [0, 1, 2], 'charge')
+    
+    assert not result.success
+    assert result.best_fit is None
+    assert np.isnan(result.tc)
+
+@pytest.mark.filterwarnings('ignore:divide by zero')
+def test_fit_flat_data_does_not_converge() :
+    # an already discharged capacitor, nothing to fit, log(0) in the initial guess
+    t = 1e-3 * np.arange(500)
+    result = fit_rc_response(t, np.zeros(len(t)), 'discharge', tc_guess=0.1)
+    
+    assert not result.success
+
+def test_unknown_mode() :
+    with pytest.raises(ValueError) :
+        fit_rc_response([0, 1], [1, 0], 'pulse')
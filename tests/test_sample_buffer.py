@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of sample_buffer.py.
+"""
+
+import numpy as np
+
+from sample_buffer import SampleRingBuffer
+
+def test_growing_buffer_keeps_everything() :
+    samples = SampleRingBuffer(4)
+    for start in range(0, 30, 7) :
+        x = np.arange(start, min(start+7, 30))
+        samples.append(x, -x)
+    
+    assert len(samples) == 30
+    np.testing.assert_array_equal( samples.x, np.arange(30) )
+    np.testing.assert_array_equal( samples.y, -np.arange(30) )
+
+def test_wrap_keeps_latest_samples_contiguous() :
+    samples = SampleRingBuffer(10, wrap=True)
+    x = np.arange(47)
+    for (start, end) in [(0, 3), (3, 12), (12, 13), (13, 31), (31, 47)] :
+        samples.append(x[start:end], 2*x[start:end])
+        expected = x[max(end-10, 0):end]
+        view = samples.view()
+        assert len(samples) == len(expected)
+        np.testing.assert_array_equal( view[:,0], expected )
+        np.testing.assert_array_equal( view[:,1], 2*expected )
+    
+    np.testing.assert_array_equal( samples.view(4)[:,0], x[-4:] )
+    # a view is a slice of the storage, not a copy
+    assert samples.view().base is samples.data
+
+def test_wrap_batch_larger_than_capacity() :
+    samples = SampleRingBuffer(8, wrap=True)
+    samples.append(np.arange(5), np.arange(5))
+    samples.append(np.arange(5, 30), np.arange(5, 30))
+    
+    np.testing.assert_array_equal( samples.x, np.arange(22, 30) )
+    samples.append([30], [30])
+    np.testing.assert_array_equal( samples.x, np.arange(23, 31) )
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of sample_clock.py.
+"""
+
+import numpy as np
+
+from sample_clock import SampleClock, MICROS_WRAP
+
+def test_wrap_within_and_between_batches() :
+    # micros() wraps 5.5 ms after the first sample
+    raw = (MICROS_WRAP - 5500 + 1000*np.arange(20)) % MICROS_WRAP
+    clock = SampleClock()
+    x = np.concatenate([ clock.process(raw[:4]), clock.process(raw[4:7]), clock.process(raw[7:]) ])
+    
+    np.testing.assert_allclose( x, 1e-3*np.arange(20) )
+    assert clock.num_wraps == 1
+    assert clock.num_gaps == 0
+    assert clock.duration == 19e-3
+
+def test_wrap_on_batch_boundary() :
+    raw = (MICROS_WRAP - 3000 + 1000*np.arange(6)) % MICROS_WRAP
+    clock = SampleClock()
+    x = np.concatenate([ clock.process(raw[:3]), clock.process(raw[3:]) ])
+    
+    np.testing.assert_allclose( x, 1e-3*np.arange(6) )
+    assert clock.num_wraps == 1
+
+def test_gaps_are_counted() :
+    raw = np.r_[ 1000*np.arange(5), 1000*np.arange(8, 12) ].astype(np.uint32)
+    clock = SampleClock()
+    x = clock.process(raw)
+    
+    np.testing.assert_allclose( x[-1], 11e-3 )
+    assert clock.num_gaps == 1
+    assert clock.missing_samples == 3
+    (start, duration, missing) = clock.gaps[0]
+    assert np.isclose(start, 4e-3) and np.isclose(duration, 4e-3) and missing == 3
@@ -71,6 +71,8 @@ tests = [
          ["r;456", "s", '456'], 
          ["t;123", "u", '123'], 
          ["t;456", "u", '456'], 
+         ["A;1", "B", '1'], 
+         ["A;0", "B", '0'], 
         ]
 
 print( '\nstarting tests\n' )